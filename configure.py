@@ -1,32 +1,87 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-import glob
+import hashlib
+import io
+import json
 import os
 from pathlib import Path
+import shlex
 import sys
+import time
 from typing import OrderedDict, TextIO
 import ninja
 
+from tools.build_cache import DEFAULT_MAX_SIZE, BuildCacheException, get_default_cache_dir, parse_size
+from tools.fileutil import write_depfile, write_if_changed
 from tools.fs_packer import FS_MAP
+from tools.make_prelude import format_prelude, get_prelude_includes
 
 SCRIPT_DIR = Path(os.path.dirname(os.path.realpath(__file__)))
 DECOMP_DIR = Path("../dinosaur-planet").absolute().resolve()
-
-class BuildConfig:
-    def __init__(self, release_build: bool):
+BUILD_DIR = Path("build")
+# Written to each variant's build directory
+ASSET_SOURCES_FILENAME = "asset_sources.json"
+DLL_SOURCES_FILENAME = "dll_sources.json"
+CORE_PRELUDE_FILENAME = "pch/core/prelude.h"
+DLL_PRELUDE_FILENAME = "pch/dll/prelude.h"
+VARIANT_NINJA_FILENAME = "build.ninja"
+SCAN_CACHE = BUILD_DIR.joinpath("configure_cache.json")
+SCAN_CACHE_VERSION = 1
+CONFIGURE_DEPFILE = Path("build.ninja.d")
+
+# Assets that we rebuild ourselves
+BUILT_ASSETS = set([
+    "DLLS.bin", # 46
+    "DLLS_tab.bin", # 47
+    "DLLSIMPORTTAB.bin", # 48
+])
+# Built assets that are the same for every variant (built once, in the shared build directory)
+SHARED_BUILT_ASSETS = set([
+    "DLLSIMPORTTAB.bin",
+])
+
+class BuildVariant:
+    def __init__(self, name: str, release_build: bool):
+        self.name = name
         self.release_build = release_build
+        # Outputs that depend on the variant are built in a directory of their own, so that
+        # variants can be built side by side and switching between them doesn't rebuild
+        self.build_dir = BUILD_DIR.joinpath(name)
 
-class AssetFileCopy:
-    def __init__(self, asset_path: Path, build_path: Path):
+VARIANTS = [
+    BuildVariant("debug", release_build=False),
+    BuildVariant("release", release_build=True),
+]
+
+class BuildConfig:
+    def __init__(self, default_variants: "list[str]", patch_shards: int, keep_patched_elfs: bool, use_worker: bool,
+                 use_pch: bool, build_cache_dir: "str | None", build_cache_max_size: str, configure_args: "list[str]"):
+        # Names of the variants built by a plain `ninja` (all variants can be built by name)
+        self.default_variants = default_variants
+        # Number of batched DLL patch/convert steps the DLLs are split between (0 = one per DLL)
+        self.patch_shards = patch_shards
+        # Whether to also write out each DLL's patched ELF (for debugging)
+        self.keep_patched_elfs = keep_patched_elfs
+        # Whether to run Python tools in a resident worker process (tools/build_worker.py)
+        self.use_worker = use_worker
+        # Whether to precompile the headers every C file of a group starts with (tools/make_prelude.py)
+        self.use_pch = use_pch
+        # Directory of the build step cache (tools/build_cache.py), None if it isn't used
+        self.build_cache_dir = build_cache_dir
+        self.build_cache_max_size = build_cache_max_size
+        # Arguments to re-run configure.py with when build.ninja needs regenerating
+        self.configure_args = configure_args
+
+class AssetFile:
+    def __init__(self, asset_path: Path):
         self.asset_path = asset_path
-        self.build_path = build_path
 
-class DecompFileCopy:
-    def __init__(self, decomp_path: Path, build_path: Path):
+class DecompFile:
+    def __init__(self, decomp_path: Path):
         self.decomp_path = decomp_path
-        self.build_path = build_path
 
 class BuildFileType(Enum):
     C = 1
@@ -48,40 +103,55 @@ class DLL:
 class BuildFiles:
     def __init__(self, 
                  core_files: "list[BuildFile]",
-                 asset_copies: "list[DecompFileCopy | AssetFileCopy]",
-                 dll_copies: "list[DecompFileCopy]",
-                 dlls: "list[DLL]"):
+                 asset_sources: "dict[str, DecompFile | AssetFile]",
+                 unmodified_dlls: "dict[int, DecompFile]",
+                 dlls: "list[DLL]",
+                 configure_deps: "list[Path]"):
         self.core_files = core_files
-        self.asset_copies = asset_copies
-        self.dll_copies = dll_copies
+        self.asset_sources = asset_sources
+        self.unmodified_dlls = unmodified_dlls
         self.dlls = dlls
+        # Files and directories that the scan depends on (a change means build.ninja is stale)
+        self.configure_deps = configure_deps
+        # Includes that every core/DLL C file starts with (see find_preludes)
+        self.core_prelude: "list[str]" = []
+        self.dll_prelude: "list[str]" = []
+
+    def get_core_c_files(self) -> "list[BuildFile]":
+        return [file for file in self.core_files if file.type == BuildFileType.C]
+
+    def get_dll_c_files(self) -> "list[BuildFile]":
+        return [file for dll in self.dlls for file in dll.files if file.type == BuildFileType.C]
+
+    # Finds the includes each group of C files shares, which are only precompiled if there are any
+    def find_preludes(self):
+        self.core_prelude = get_prelude_includes([Path(file.src_path) for file in self.get_core_c_files()])
+        self.dll_prelude = get_prelude_includes([Path(file.src_path) for file in self.get_dll_c_files()])
 
 class BuildNinjaWriter:
     def __init__(self, writer: ninja.Writer, input: BuildFiles, config: BuildConfig):
         self.writer = writer
         self.input = input
         self.config = config
-        self.link_deps: "list[str]" = []
+        self.uses_core_pch = config.use_pch and len(input.core_prelude) > 0
+        self.uses_dll_pch = config.use_pch and len(input.dll_prelude) > 0
 
     def write(self):
         # Write prelude (variables, rules)
         self.__write_prelude()
 
-        # Write builds for core source compilation
-        self.__write_core_file_builds()
-        
-        # Write DLL builds/linking/packing
-        self.__write_dll_builds()
+        # Write builds shared by all variants
+        self.__write_shared_builds()
 
-        # Write asset build/packing
-        self.__write_asset_build()
+        # Write the variants (each in its own file, see VariantNinjaWriter)
+        self.__write_variants()
 
-        # Write main linker step
-        self.__write_linking()
+        # Write build.ninja regeneration
+        self.__write_configure()
 
         # Write default target
-        self.writer.default(["$BUILD_DIR/$TARGET.z64"])
-    
+        self.writer.default(self.config.default_variants)
+
     def __write_prelude(self):
         # Config
         self.writer.comment("Config (don't edit this directly!)")
@@ -94,7 +164,7 @@ class BuildNinjaWriter:
         # Write variables
         self.writer.comment("Variables")
 
-        self.writer.variable("BUILD_DIR", "build")
+        self.writer.variable("BUILD_DIR", BUILD_DIR.as_posix())
         
         self.writer.variable("LD_SCRIPT", "$TARGET.ld")
         self.writer.variable("DLL_LD_SCRIPT", "dll.ld")
@@ -103,39 +173,8 @@ class BuildNinjaWriter:
 
         self.writer.variable("ELF_IN", "$DECOMP_DIR/build/dino.elf")
 
-        self.writer.variable("ELF", "$BUILD_DIR/$TARGET.elf")
-        self.writer.variable("Z64", "$BUILD_DIR/$TARGET.z64")
-
-        self.writer.variable("Z64_IN", "$BUILD_DIR/${TARGET}_in.bin")
         self.writer.variable("Z64_IN_OBJ", "$BUILD_DIR/${TARGET}_in.o")
 
-        self.writer.variable("ASSETS_BIN", "$BUILD_DIR/${TARGET}_assets.bin")
-        self.writer.variable("ASSETS_OBJ", "$BUILD_DIR/${TARGET}_assets.o")
-
-        common_defines = [
-            "-D_MIPS_SZLONG=32",
-            "-DF3DEX_GBI_2",
-        ]
-
-        if not self.config.release_build:
-            common_defines.append("-DDEBUG")
-
-        self.writer.variable("GCC_DEFINES", " ".join(common_defines))
-
-        gcc_as_defines = []
-
-        if not self.config.release_build:
-            gcc_as_defines.append("-DDEBUG")
-
-        self.writer.variable("GCC_AS_DEFINES", " ".join(gcc_as_defines))
-
-        as_defines = []
-
-        if not self.config.release_build:
-            as_defines.append("--defsym DEBUG=1")
-
-        self.writer.variable("AS_DEFINES", " ".join(as_defines))
-
         self.writer.variable("INCLUDES", " ".join([
             "-I include",
             "-I $DECOMP_DIR/include",
@@ -198,13 +237,6 @@ class BuildNinjaWriter:
             "-EB",
         ]))
 
-        self.writer.variable("LDFLAGS", " ".join([
-            "-T $BUILD_DIR/$LD_SCRIPT",
-            "-mips3",
-            "--accept-unknown-input-arch",
-            "--no-check-sections",
-        ]))
-
         self.writer.variable("DLL_LDFLAGS", " ".join([
             "-r",
             #"-m elf32btsmip",
@@ -217,29 +249,15 @@ class BuildNinjaWriter:
             "--no-strip-discarded",
         ]))
 
-        cpp_ldflags = [
-            "-P",
-            "-Wno-trigraphs",
-            "-DBUILD_DIR=$BUILD_DIR",
-            "-Umips",
-            "-DBASEROM=$Z64_IN_OBJ",
-            "-DASSETS=$ASSETS_OBJ",
-            "-I include",
-        ]
-
-        if not self.config.release_build:
-            cpp_ldflags.append("-DDEBUG")
-
-        self.writer.variable("CPP_LDFLAGS", " ".join(cpp_ldflags))
-
         self.writer.variable("OPTFLAGS", " ".join(["-Os"]))
-        self.writer.variable("ELF_IN_TO_Z64_IN_FLAGS", " ".join([
-            "-O binary",
+        self.writer.variable("BASEROM_OBJ_FLAGS", " ".join([
             # We link in a repacked assets segment
             "--remove-section .assets",
             # Strip out data not used by the game to make room for new custom code
             "--remove-section .leftovers",
             "--remove-section .trailer",
+            # Name the _binary_* symbols after the ROM image, like objcopy -I binary would
+            "--name $BUILD_DIR/${TARGET}_in.bin",
         ]))
         self.writer.variable("BIN_TO_O_FLAGS", " ".join([
             "-I binary",
@@ -256,65 +274,299 @@ class BuildNinjaWriter:
         self.writer.variable("LD", f"{cross}ld")
         self.writer.variable("CPP", f"{cross}cpp")
         self.writer.variable("OBJCOPY", f"{cross}objcopy")
-        self.writer.variable("CKSUM", f"{sys.executable} tools/n64cksum.py")
-        self.writer.variable("FS_PACKER", f"{sys.executable} tools/fs_packer.py")
-        self.writer.variable("ELF_PATCHER", f"{sys.executable} tools/elf_patcher.py")
-        self.writer.variable("MAKE_DLLSIMPORTTAB", f"{sys.executable} tools/make_dllsimporttab.py")
-        self.writer.variable("DINO_DLL", f"{sys.executable} $DECOMP_DIR/tools/dino_dll.py")
-        self.writer.variable("ELF2DLL", f"{sys.executable} $DECOMP_DIR/tools/elf2dll.py")
+        if self.config.use_worker:
+            # Tools are run by a resident worker process, started on first use
+            self.writer.variable("RUN_TOOL", " ".join([
+                f"{sys.executable} -m tools.build_worker run",
+                "--socket $BUILD_DIR/worker.sock",
+                "--preload-elf $ELF_IN",
+                "--symbol-cache $BUILD_DIR/symbol_index",
+            ]))
+        else:
+            self.writer.variable("RUN_TOOL", f"{sys.executable} -m")
+        self.writer.variable("CKSUM", "$RUN_TOOL tools.n64cksum")
+        self.writer.variable("MAKE_Z64", "$RUN_TOOL tools.make_z64")
+        self.writer.variable("MAKE_BASEROM_OBJ", "$RUN_TOOL tools.make_baserom_obj")
+        self.writer.variable("PYTHON", sys.executable)
+        self.writer.variable("CONFIGURE_ARGS", shlex.join(self.config.configure_args))
+        self.writer.variable("FS_PACKER", "$RUN_TOOL tools.fs_packer")
+        self.writer.variable("DLL_PACKER", "$RUN_TOOL tools.dll_packer")
+        self.writer.variable("PATCH_DLL", "$RUN_TOOL tools.patch_dll --elf2dll $DECOMP_DIR/tools/elf2dll.py")
+        self.writer.variable("PATCH_DLL_FLAGS", "--keep-patched-elf" if self.config.keep_patched_elfs else "")
+        self.writer.variable("MAKE_DLLSIMPORTTAB", "$RUN_TOOL tools.make_dllsimporttab")
+        self.writer.variable("MAKE_PRELUDE", "$RUN_TOOL tools.make_prelude")
+        if self.config.build_cache_dir != None:
+            self.writer.variable("BUILD_CACHE", " ".join([
+                f"{sys.executable} -m tools.build_cache run",
+                f"--dir {shlex.quote(self.config.build_cache_dir)}",
+                f"--max-size {self.config.build_cache_max_size}",
+            ]))
+            # Files (other than the ELF) that the output of patch_dll depends on. The decomp tools
+            # modules elf2dll imports and pyelftools are listed in the depfile patch_dll writes.
+            self.writer.variable("PATCH_DLL_SOURCES", " ".join([
+                "tools/patch_dll.py",
+                "tools/elf_patcher.py",
+                "tools/fileutil.py",
+                "$DECOMP_DIR/tools/elf2dll.py",
+            ]))
 
         self.writer.newline()
 
         # Write rules
         self.writer.comment("Rules")
+        # Cached steps only rewrite outputs that changed when restored from the cache
+        cached = self.config.build_cache_dir != None
+        # GCC leaves the headers of a precompiled header out of the depfile of files using it,
+        # so the cache takes them from the precompiled header's own depfile
         self.writer.rule("gcc", 
-            "$GCC $GCC_DEFINES $INCLUDES $CFLAGS $OPTFLAGS -MD -MF $out.d -o $out $in", 
+            self.__cached_command("$GCC $GCC_DEFINES $INCLUDES $CFLAGS $OPTFLAGS $CORE_PCH_FLAGS -MD -MF $out.d -o $out $in", 
+                                  "$in", "$out", depfile="$out.d",
+                                  input_depfiles="$CORE_PRELUDE.gch.d" if self.uses_core_pch else None),
             "Compiling $in...",
-            depfile="$out.d")
+            depfile="$out.d",
+            restat=cached)
         self.writer.rule("gcc_dll", 
-            "$GCC $GCC_DEFINES $INCLUDES $DLL_CFLAGS $OPTFLAGS -MD -MF $out.d -o $out $in", 
+            self.__cached_command("$GCC $GCC_DEFINES $INCLUDES $DLL_CFLAGS $OPTFLAGS $DLL_PCH_FLAGS -MD -MF $out.d -o $out $in", 
+                                  "$in", "$out", depfile="$out.d",
+                                  input_depfiles="$DLL_PRELUDE.gch.d" if self.uses_dll_pch else None),
             "Compiling $in...",
+            depfile="$out.d",
+            restat=cached)
+        # Precompiled headers aren't reproducible (GCC output differs between runs), so they
+        # aren't cached
+        self.writer.rule("gcc_pch", 
+            "$GCC $GCC_DEFINES $INCLUDES $CFLAGS $OPTFLAGS -x c-header -MD -MF $out.d -o $out $in", 
+            "Precompiling $in...",
+            depfile="$out.d")
+        self.writer.rule("gcc_dll_pch", 
+            "$GCC $GCC_DEFINES $INCLUDES $DLL_CFLAGS $OPTFLAGS -x c-header -MD -MF $out.d -o $out $in", 
+            "Precompiling $in...",
             depfile="$out.d")
+        self.writer.rule("make_prelude", "$MAKE_PRELUDE -o $out @$out.rsp", "Writing $out...",
+            rspfile="$out.rsp",
+            rspfile_content="$in_newline",
+            restat=True)
         self.writer.rule("gcc_as", 
-            "$GCC $ASFLAGS $GCC_AS_DEFINES $INCLUDES -MD -MF $out.d -o $out $in", 
+            self.__cached_command("$GCC $ASFLAGS $GCC_AS_DEFINES $INCLUDES -MD -MF $out.d -o $out $in", 
+                                  "$in", "$out", depfile="$out.d"),
             "Assembling $in...",
-            depfile="$out.d")
+            depfile="$out.d",
+            restat=cached)
         self.writer.rule("as_dll", 
-            "$AS $DLL_ASFLAGS $AS_DEFINES $INCLUDES -MD $out.d -o $out $in", 
+            self.__cached_command("$AS $DLL_ASFLAGS $AS_DEFINES $INCLUDES -MD $out.d -o $out $in", 
+                                  "$in", "$out", depfile="$out.d"),
             "Assembling $in...",
-            depfile="$out.d")
+            depfile="$out.d",
+            restat=cached)
         self.writer.rule("ld", 
             "$LD -R $ELF_IN $LDFLAGS -Map $MAPFILE -o $out", 
             "Linking...")
         self.writer.rule("ld_dll", 
-            "$LD $DLL_LDFLAGS -Map $MAPFILE -o $out $in", 
-            "Linking...")
+            self.__cached_command("$LD $DLL_LDFLAGS -Map $MAPFILE -o $out $in", 
+                                  "$in $DLL_LD_SCRIPT", "$out $MAPFILE"),
+            "Linking...",
+            restat=cached)
         self.writer.rule("cpp_ld", "$CPP $CPP_LDFLAGS -o $out $in", "Preprocessing $in...")
         self.writer.rule("to_bin", "$OBJCOPY $in $out -O binary", "Converting $in to $out...")
-        # TODO: won't work on windows
-        self.writer.rule("make_z64", "$OBJCOPY $in $out -O binary && $CKSUM $out", "Creating $out...")
+        self.writer.rule("make_z64", "$MAKE_Z64 -o $out $in", "Creating $out...",
+            restat=True)
         self.writer.rule("n64cksum", "$CKSUM $in", "Recomputing checksum...")
-        self.writer.rule("elf_in_to_z64_in", "$OBJCOPY $in $out $ELF_IN_TO_Z64_IN_FLAGS", 
-                         "Converting $in to $out...")
+        self.writer.rule("make_baserom_obj", "$MAKE_BASEROM_OBJ $BASEROM_OBJ_FLAGS -o $out $in", "Converting $in to $out...",
+            restat=True)
         self.writer.rule("bin_to_o", "$OBJCOPY $in $out $BIN_TO_O_FLAGS", 
                          "Converting $in to $out...")
-        self.writer.rule("file_copy", "cp $in $out", "Copying $in to $out...")
-        self.writer.rule("patch_elf", "$ELF_PATCHER -o $out $in", "Apply patches in $in...")
-        self.writer.rule("elf2dll", "$ELF2DLL -o $out -b $DLL_BSS_TXT -s $DLL_SYMS_MAP $in", "Converting $in to DP DLL $out...")
-        self.writer.rule("pack_fs", "$FS_PACKER -o $out $BUILD_DIR/assets", "Repacking assets...")
+        # Patched ELFs kept for debugging aren't restored from the cache, so don't cache then
+        patch_dll_command = "$PATCH_DLL $PATCH_DLL_FLAGS --depfile $out.d -o $out $in"
+        if not self.config.keep_patched_elfs:
+            patch_dll_command = self.__cached_command(patch_dll_command, 
+                                                      "$in $PATCH_DLL_SOURCES", "$out $out.bss.txt $out.syms.txt",
+                                                      depfile="$out.d")
+        self.writer.rule("patch_dll", patch_dll_command, "Patching and converting $in to DP DLL $out...",
+            depfile="$out.d",
+            restat=True)
+        self.writer.rule("patch_dll_batch", "$PATCH_DLL $PATCH_DLL_FLAGS --batch $RSPFILE -j $PATCH_JOBS", "Patching and converting $PATCH_COUNT DLLs...",
+            rspfile="$RSPFILE",
+            rspfile_content="$PATCH_PAIRS",
+            restat=True)
+        self.writer.rule("pack_fs", "$FS_PACKER --incremental -o $out --sources $in", "Repacking assets...",
+            restat=True)
         self.writer.rule("pack_dlls", 
-                         "$DINO_DLL pack $BUILD_DIR/assets/dlls $BUILD_DIR/assets/DLLS.bin $DECOMP_DIR/bin/assets/DLLS_tab.bin "
-                            + "--tab_out $BUILD_DIR/assets/DLLS_tab.bin --quiet", 
-                         "Repacking DLLs...")
+                         "$DLL_PACKER pack --incremental -o $BUILD_DIR/assets/DLLS.bin --tab-out $BUILD_DIR/assets/DLLS_tab.bin $in", 
+                         "Repacking DLLs...",
+                         restat=True)
+        self.writer.rule("configure", "$PYTHON configure.py $CONFIGURE_ARGS", "Regenerating build.ninja...",
+            depfile=CONFIGURE_DEPFILE.as_posix(),
+            generator=True,
+            restat=True)
         self.writer.rule("make_dllsimporttab", 
-                         "$MAKE_DLLSIMPORTTAB -e $ELF_IN -s $CORE_EXPORTS_TXT -l $EXPORTS_LD_SCRIPT -o $out $in", 
-                         "Rebuilding DLLSIMPORTTAB...")
+                         "$MAKE_DLLSIMPORTTAB -e $ELF_IN --symbol-cache $BUILD_DIR/symbol_index -s $CORE_EXPORTS_TXT -l $EXPORTS_LD_SCRIPT -o $out $in", 
+                         "Rebuilding DLLSIMPORTTAB...",
+                         restat=True)
+
+        self.writer.newline()
+
+    # Runs a command through the build step cache, if enabled
+    def __cached_command(self, command: str, inputs: str, outputs: str, depfile: "str | None" = None,
+                         input_depfiles: "str | None" = None) -> str:
+        if self.config.build_cache_dir == None:
+            return command
+        cache_args = f"--inputs {inputs} --outputs {outputs}"
+        if depfile != None:
+            cache_args += f" --depfile {depfile}"
+        if input_depfiles != None:
+            cache_args += f" --input-depfiles {input_depfiles}"
+        return f"$BUILD_CACHE {cache_args} -- {command}"
+
+    def __write_shared_builds(self):
+        self.writer.comment("DLL imports")
+        self.writer.build(
+            "$BUILD_DIR/assets/DLLSIMPORTTAB.bin",
+            "make_dllsimporttab",
+            f"$DECOMP_DIR/bin/assets/DLLSIMPORTTAB.bin",
+            implicit=["$ELF_IN", "$CORE_EXPORTS_TXT"],
+            implicit_outputs=["$EXPORTS_LD_SCRIPT"])
+
+        # Pre-process decomp elf (the object is only rewritten if the ROM image changed)
+        self.writer.comment("Base ROM")
+        self.writer.build("$Z64_IN_OBJ", "make_baserom_obj", "$ELF_IN")
 
         self.writer.newline()
 
+    def __write_variants(self):
+        # Each variant's file shadows BUILD_DIR (and its other variables) with its own, while
+        # using the rules and shared outputs above
+        for variant in VARIANTS:
+            self.writer.comment(f"Variant: {variant.name}")
+            self.writer.subninja(variant.build_dir.joinpath(VARIANT_NINJA_FILENAME).as_posix())
+            self.writer.build(variant.name, "phony", f"{variant.build_dir.as_posix()}/$TARGET.z64")
+            self.writer.newline()
+
+    def __write_configure(self):
+        self.writer.comment("Regenerate this file when the inputs of configure.py change")
+
+        # Source directories, dlls.txt files and the assets directory are listed in the
+        # depfile written alongside this file, since they change as files are added/removed.
+        # Every tools/ module configure.py imported (directly or not) is an input too.
+        tool_paths = sorted(Path(module.__file__).resolve().relative_to(SCRIPT_DIR).as_posix()
+                            for (name, module) in list(sys.modules.items())
+                            if name.startswith("tools.") and getattr(module, "__file__", None) != None)
+        self.writer.build("build.ninja", "configure", [],
+                          implicit=["configure.py"] + tool_paths,
+                          implicit_outputs=[variant.build_dir.joinpath(VARIANT_NINJA_FILENAME).as_posix() 
+                                            for variant in VARIANTS])
+
+# Writes the build of one variant, included by build.ninja
+class VariantNinjaWriter:
+    def __init__(self, writer: ninja.Writer, input: BuildFiles, config: BuildConfig, variant: BuildVariant):
+        self.writer = writer
+        self.input = input
+        self.config = config
+        self.variant = variant
+        self.uses_core_pch = config.use_pch and len(input.core_prelude) > 0
+        self.uses_dll_pch = config.use_pch and len(input.dll_prelude) > 0
+        self.link_deps: "list[str]" = []
+        # DLLS_tab.bin template and the DLL/BSS size files to pack
+        self.dll_sources: "dict" = {}
+        # FS_MAP entry -> path of the file to pack
+        self.asset_sources: "dict[str, str | None]" = {}
+
+    def write(self):
+        # Write variables specific to this variant
+        self.__write_variables()
+
+        # Write builds for core source compilation
+        self.__write_core_file_builds()
+
+        # Write DLL builds/linking/packing
+        self.__write_dll_builds()
+
+        # Write asset build/packing
+        self.__write_asset_build()
+
+        # Write main linker step
+        self.__write_linking()
+
+    def __write_variables(self):
+        self.writer.comment(f"Variant {self.variant.name} (don't edit this directly!)")
+        self.writer.variable("BUILD_DIR", self.variant.build_dir.as_posix())
+
+        self.writer.variable("ELF", "$BUILD_DIR/$TARGET.elf")
+        self.writer.variable("Z64", "$BUILD_DIR/$TARGET.z64")
+
+        self.writer.variable("ASSETS_BIN", "$BUILD_DIR/${TARGET}_assets.bin")
+        self.writer.variable("ASSETS_OBJ", "$BUILD_DIR/${TARGET}_assets.o")
+
+        common_defines = [
+            "-D_MIPS_SZLONG=32",
+            "-DF3DEX_GBI_2",
+        ]
+
+        if not self.variant.release_build:
+            common_defines.append("-DDEBUG")
+
+        self.writer.variable("GCC_DEFINES", " ".join(common_defines))
+
+        gcc_as_defines = []
+
+        if not self.variant.release_build:
+            gcc_as_defines.append("-DDEBUG")
+
+        self.writer.variable("GCC_AS_DEFINES", " ".join(gcc_as_defines))
+
+        as_defines = []
+
+        if not self.variant.release_build:
+            as_defines.append("--defsym DEBUG=1")
+
+        self.writer.variable("AS_DEFINES", " ".join(as_defines))
+
+        self.writer.variable("LDFLAGS", " ".join([
+            "-T $BUILD_DIR/$LD_SCRIPT",
+            "-mips3",
+            "--accept-unknown-input-arch",
+            "--no-check-sections",
+        ]))
+
+        cpp_ldflags = [
+            "-P",
+            "-Wno-trigraphs",
+            "-DBUILD_DIR=$BUILD_DIR",
+            "-Umips",
+            "-DBASEROM=$Z64_IN_OBJ",
+            "-DASSETS=$ASSETS_OBJ",
+            "-I include",
+        ]
+
+        if not self.variant.release_build:
+            cpp_ldflags.append("-DDEBUG")
+
+        self.writer.variable("CPP_LDFLAGS", " ".join(cpp_ldflags))
+
+        # Precompiled prelude headers, force included into each C file of their group
+        self.writer.variable("CORE_PRELUDE", f"$BUILD_DIR/{CORE_PRELUDE_FILENAME}")
+        self.writer.variable("DLL_PRELUDE", f"$BUILD_DIR/{DLL_PRELUDE_FILENAME}")
+        self.writer.variable("CORE_PCH_FLAGS", "-include $CORE_PRELUDE -Winvalid-pch" if self.uses_core_pch else "")
+        self.writer.variable("DLL_PCH_FLAGS", "-include $DLL_PRELUDE -Winvalid-pch" if self.uses_dll_pch else "")
+
+        self.writer.newline()
+
+    # Writes the prelude header of a group of C files and its precompiled header, returning
+    # the precompiled header (which compiling the group depends on)
+    def __write_pch(self, prelude_path: str, pch_rule: str, files: "list[BuildFile]") -> str:
+        pch_path = f"{prelude_path}.gch"
+        self.writer.build(prelude_path, "make_prelude", [Path(file.src_path).as_posix() for file in files])
+        self.writer.build(pch_path, pch_rule, prelude_path)
+        return pch_path
+
     def __write_core_file_builds(self):
         self.writer.comment("Core source compilation")
 
+        # GCC doesn't list the headers of a precompiled header in the depfiles of files using
+        # it, so they depend on it directly instead of only being ordered after it
+        pch_deps: "list[str]" = []
+        if self.uses_core_pch:
+            pch_deps.append(self.__write_pch("$CORE_PRELUDE", "gcc_pch", self.input.get_core_c_files()))
+
         for file in self.input.core_files:
             # Determine command
             command: str
@@ -328,23 +580,24 @@ class BuildNinjaWriter:
             # Write command
             obj_build_path = f"$BUILD_DIR/{Path(file.obj_path).as_posix()}"
             src_build_path = Path(file.src_path).as_posix()
-            self.writer.build(obj_build_path, command, src_build_path)
+            self.writer.build(obj_build_path, command, src_build_path,
+                              implicit=pch_deps if file.type == BuildFileType.C else [])
             self.link_deps.append(obj_build_path)
 
         self.writer.newline()
 
     def __write_dll_builds(self):
         pack_deps: "list[str]" = []
-
-        self.writer.comment("DLL imports")
-        self.writer.build(
-            "$BUILD_DIR/assets/DLLSIMPORTTAB.bin",
-            "make_dllsimporttab",
-            f"$DECOMP_DIR/bin/assets/DLLSIMPORTTAB.bin",
-            implicit=["$ELF_IN", "$CORE_EXPORTS_TXT"],
-            implicit_outputs=["$EXPORTS_LD_SCRIPT"])
+        # DLL number -> (DLL path, BSS size path)
+        built_dlls: "dict[int, tuple[str, str]]" = {}
+        # (linked ELF, DLL) of each DLL, for batched patching/conversion
+        dll_pairs: "list[tuple[str, str]]" = []
 
         self.writer.comment("DLL compilation")
+        pch_deps: "list[str]" = []
+        if self.uses_dll_pch:
+            pch_deps.append(self.__write_pch("$DLL_PRELUDE", "gcc_dll_pch", self.input.get_dll_c_files()))
+
         for dll in self.input.dlls:
             self.writer.comment(f"DLL {dll.number}")
             obj_dir = f"$BUILD_DIR/{dll.dir.as_posix()}"
@@ -368,7 +621,8 @@ class BuildNinjaWriter:
                 # Write command
                 obj_build_path = f"$BUILD_DIR/{Path(file.obj_path).as_posix()}"
                 src_build_path = Path(file.src_path).as_posix()
-                self.writer.build(obj_build_path, command, src_build_path)
+                self.writer.build(obj_build_path, command, src_build_path,
+                                  implicit=pch_deps if file.type == BuildFileType.C else [])
                 dll_link_deps.append(obj_build_path)
             
             # Link
@@ -379,63 +633,97 @@ class BuildNinjaWriter:
                               variables={"MAPFILE": mapfile_path},
                               implicit_outputs=[mapfile_path])
 
-            # Apply patches
-            patched_elf_patch = f"{obj_dir}/{dll.number}.patched.elf"
-            self.writer.build(patched_elf_patch, "patch_elf", elf_path)
-
-            # Convert ELF to Dinosaur Planet DLL
+            # Apply patches and convert ELF to Dinosaur Planet DLL
             dll_asset_path = f"$BUILD_DIR/assets/dlls/{dll.number}.dll"
             dll_bss_asset_path = f"$BUILD_DIR/assets/dlls/{dll.number}.dll.bss.txt"
             dll_syms_map_asset_path = f"$BUILD_DIR/assets/dlls/{dll.number}.dll.syms.txt"
-            self.writer.build(dll_asset_path, "elf2dll", patched_elf_patch,
-                variables={
-                    "DLL_BSS_TXT": dll_bss_asset_path,
-                    "DLL_SYMS_MAP": dll_syms_map_asset_path
-                },
-                implicit_outputs=[dll_bss_asset_path, dll_syms_map_asset_path])
+            if self.config.patch_shards == 0:
+                self.writer.build(dll_asset_path, "patch_dll", elf_path,
+                    implicit_outputs=[dll_bss_asset_path, dll_syms_map_asset_path])
+            else:
+                dll_pairs.append((elf_path, dll_asset_path))
             pack_deps.append(dll_asset_path)
             pack_deps.append(dll_bss_asset_path)
+            built_dlls[int(dll.number)] = (
+                self.variant.build_dir.joinpath(f"assets/dlls/{dll.number}.dll").as_posix(),
+                self.variant.build_dir.joinpath(f"assets/dlls/{dll.number}.dll.bss.txt").as_posix())
 
         self.writer.newline()
 
-        self.writer.comment("DLL copies (unmodified DLLs)")
-        for copy in self.input.dll_copies:
-            decomp_path = f"$DECOMP_DIR/{copy.decomp_path.as_posix()}"
-            build_path = f"$BUILD_DIR/{copy.build_path.as_posix()}"
-            self.writer.build(build_path, "file_copy", decomp_path)
-            pack_deps.append(build_path)
+        if len(dll_pairs) > 0:
+            self.__write_batched_dll_conversion(dll_pairs)
 
-        self.writer.newline()
+        # DLLs are packed straight from where they live, as listed in the DLL sources
+        # file written by configure
+        dlls: "list[dict]" = []
+        for number in range(1, len(built_dlls) + len(self.input.unmodified_dlls) + 1):
+            if number in built_dlls:
+                (dll_path, bss_path) = built_dlls[number]
+                dlls.append({ "path": dll_path, "bss": bss_path })
+            else:
+                decomp_path = self.input.unmodified_dlls[number].decomp_path
+                pack_deps.append(f"$DECOMP_DIR/{decomp_path.as_posix()}")
+                dlls.append({ "path": DECOMP_DIR.joinpath(decomp_path).as_posix(), "bss": None })
+        self.dll_sources = {
+            "tab": DECOMP_DIR.joinpath("bin/assets/DLLS_tab.bin").as_posix(),
+            "dlls": dlls
+        }
+        pack_deps.append("$DECOMP_DIR/bin/assets/DLLS_tab.bin")
 
         self.writer.comment("DLL packing")
         self.writer.build(
             ["$BUILD_DIR/assets/DLLS.bin", "$BUILD_DIR/assets/DLLS_tab.bin"], 
-            "pack_dlls", implicit=pack_deps)
+            "pack_dlls", f"$BUILD_DIR/{DLL_SOURCES_FILENAME}", implicit=pack_deps)
+
+        self.writer.newline()
+
+    def __write_batched_dll_conversion(self, dll_pairs: "list[tuple[str, str]]"):
+        # Patch/convert DLLs in a few batches instead of starting an interpreter per DLL. Each
+        # batch only rewrites the DLLs that changed, so unchanged ones don't trigger repacking.
+        self.writer.comment("DLL patching/conversion")
+
+        shard_count = min(self.config.patch_shards, len(dll_pairs))
+        for shard in range(shard_count):
+            pairs = dll_pairs[shard::shard_count]
+            self.writer.build(
+                [dll for (_, dll) in pairs],
+                "patch_dll_batch",
+                [elf for (elf, _) in pairs],
+                implicit_outputs=[f"{dll}{suffix}" for (_, dll) in pairs for suffix in (".bss.txt", ".syms.txt")],
+                variables={
+                    "RSPFILE": f"$BUILD_DIR/patch_dll_{shard}.rsp",
+                    "PATCH_PAIRS": " ".join(f"{elf} {dll}" for (elf, dll) in pairs),
+                    "PATCH_COUNT": str(len(pairs)),
+                    # A single batch can use every core, otherwise ninja runs the batches in parallel
+                    "PATCH_JOBS": "0" if shard_count == 1 else "1"
+                })
 
         self.writer.newline()
 
     def __write_asset_build(self):
         self.writer.comment("Asset packing")
 
-        pack_deps: "list[str]" = [
-            "$BUILD_DIR/assets/DLLS.bin", 
-            "$BUILD_DIR/assets/DLLS_tab.bin"
-        ]
-        for copy in self.input.asset_copies:
-            if isinstance(copy, DecompFileCopy):
-                decomp_path = f"$DECOMP_DIR/{copy.decomp_path.as_posix()}"
-                build_path = f"$BUILD_DIR/{copy.build_path.as_posix()}"
-                self.writer.build(build_path, "file_copy", decomp_path)
-                pack_deps.append(build_path)
-            elif isinstance(copy, AssetFileCopy):
-                asset_path = f"assets/{copy.asset_path.as_posix()}"
-                build_path = f"$BUILD_DIR/{copy.build_path.as_posix()}"
-                self.writer.build(build_path, "file_copy", asset_path)
-                pack_deps.append(build_path)
+        # Assets are packed straight from where they live, as listed in the asset sources
+        # file written by configure
+        pack_deps: "list[str]" = []
+        for asset in FS_MAP:
+            source = self.input.asset_sources.get(asset)
+            if asset in BUILT_ASSETS:
+                build_dir = BUILD_DIR if asset in SHARED_BUILT_ASSETS else self.variant.build_dir
+                pack_deps.append(build_dir.joinpath("assets", asset).as_posix())
+                self.asset_sources[asset] = build_dir.joinpath("assets", asset).as_posix()
+            elif isinstance(source, DecompFile):
+                pack_deps.append(f"$DECOMP_DIR/{source.decomp_path.as_posix()}")
+                self.asset_sources[asset] = DECOMP_DIR.joinpath(source.decomp_path).as_posix()
+            elif isinstance(source, AssetFile):
+                pack_deps.append(f"assets/{source.asset_path.as_posix()}")
+                self.asset_sources[asset] = f"assets/{source.asset_path.as_posix()}"
+            elif source == None:
+                self.asset_sources[asset] = None
             else:
                 raise NotImplementedError()
 
-        self.writer.build("$ASSETS_BIN", "pack_fs", implicit=pack_deps)
+        self.writer.build("$ASSETS_BIN", "pack_fs", f"$BUILD_DIR/{ASSET_SOURCES_FILENAME}", implicit=pack_deps)
 
         self.writer.build("$ASSETS_OBJ", "bin_to_o", "$ASSETS_BIN")
         self.link_deps.append("$ASSETS_OBJ")
@@ -446,9 +734,6 @@ class BuildNinjaWriter:
     def __write_linking(self):
         self.writer.comment("Linking")
 
-        # Pre-process decomp elf
-        self.writer.build("$Z64_IN", "elf_in_to_z64_in", "$ELF_IN")
-        self.writer.build("$Z64_IN_OBJ", "bin_to_o", "$Z64_IN")
         self.link_deps.append("$Z64_IN_OBJ")
 
         # Pre-process linker script
@@ -464,62 +749,168 @@ class BuildNinjaWriter:
         # Convert .elf to .z64
         self.writer.build("$BUILD_DIR/$TARGET.z64", "make_z64", "$BUILD_DIR/$TARGET.elf")
 
+        self.writer.newline()
+
 class InputScanner:
-    def __init__(self):
-        pass
+    # Directories modified this recently (in ns) might still be changing, don't cache them
+    RACY_WINDOW_NS = 2_000_000_000
+
+    def __init__(self, cache_path: "Path | None"):
+        self.cache_path = cache_path
 
     def scan(self) -> BuildFiles:
         self.core_files: "list[BuildFile]" = []
-        self.asset_copies: "list[DecompFileCopy]" = []
-        self.dll_copies: "list[DecompFileCopy]" = []
+        self.asset_sources: "dict[str, DecompFile | AssetFile]" = {}
+        self.unmodified_dlls: "dict[int, DecompFile]" = {}
         self.dlls: "list[DLL]" = []
 
+        self.scan_time_ns = time.time_ns()
+        self.__load_cache()
+
+        self.__read_dlls_txts()
+
+        # Walk all source directories concurrently (reusing cached results for
+        # directories that haven't changed)
+        roots = [Path("src/core")] + [dir for (_, dir) in self.dll_dirs]
+        with ThreadPoolExecutor() as executor:
+            self.trees: "dict[Path, dict]" = dict(zip(roots, executor.map(self.__scan_tree, roots)))
+
         self.__scan_core_files()
         self.__scan_dlls()
         self.__scan_assets()
 
-        return BuildFiles(self.core_files, self.asset_copies, self.dll_copies, self.dlls)
-
-    def __scan_core_files(self):
-        c_paths = [Path(path) for path in glob.glob("src/core/**/*.c", recursive=True)]
-        for src_path in c_paths:
-            obj_path = self.__make_obj_path(src_path)
-            self.core_files.append(BuildFile(src_path, obj_path, BuildFileType.C))
+        self.__save_cache()
+
+        return BuildFiles(self.core_files, self.asset_sources, self.unmodified_dlls, self.dlls,
+                          self.__get_configure_deps())
+
+    def __get_configure_deps(self) -> "list[Path]":
+        deps: "list[Path]" = [DECOMP_DIR.joinpath("src/dlls/dlls.txt"), Path("src/dlls/dlls.txt")]
+
+        # Adding/removing files changes the mtime of the directory they're in. Directories
+        # that don't exist can't be depended on (ninja would consider them always dirty),
+        # so creating one of those still requires re-running configure.py manually.
+        for tree in self.trees.values():
+            for (dir, mtime) in tree["dirs"].items():
+                if mtime != None:
+                    deps.append(Path(dir))
+        if self.assets_scan["mtime_ns"] != None:
+            deps.append(Path("assets"))
+
+        return deps
+
+    def __load_cache(self):
+        self.cache: dict = { "trees": {}, "assets": None }
+        if self.cache_path == None:
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        if cache.get("version") == SCAN_CACHE_VERSION:
+            self.cache = cache
+
+    def __save_cache(self):
+        if self.cache_path == None:
+            return
         
-        s_paths = [Path(path) for path in glob.glob("src/core/**/*.s", recursive=True)]
-        for src_path in s_paths:
-            obj_path = self.__make_obj_path(src_path)
-            self.core_files.append(BuildFile(src_path, obj_path, BuildFileType.ASM))
-    
-    def __scan_dlls(self):
+        # Don't cache anything that might be modified again within the same mtime tick
+        def is_settled(mtimes: "list[int | None]") -> bool:
+            return all(m == None or m < (self.scan_time_ns - self.RACY_WINDOW_NS) for m in mtimes)
+
+        trees = { root.as_posix(): tree for (root, tree) in self.trees.items()
+                  if is_settled(list(tree["dirs"].values())) }
+        assets = self.assets_scan if is_settled([self.assets_scan["mtime_ns"]]) else None
+
+        cache = {
+            "version": SCAN_CACHE_VERSION,
+            "dlls_txt": self.dlls_txt_hash,
+            "trees": trees,
+            "assets": assets
+        }
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_if_changed(self.cache_path, json.dumps(cache, indent=0).encode())
+
+    def __scan_tree(self, root: Path) -> dict:
+        # Reuse the cached scan if none of the directories in the tree have changed
+        cached = self.cache["trees"].get(root.as_posix())
+        if cached != None and all(self.__get_mtime(Path(dir)) == mtime for (dir, mtime) in cached["dirs"].items()):
+            return cached
+        
+        # Directory mtimes are recorded so that added/removed files invalidate the cache
+        dirs: "dict[str, int | None]" = { root.as_posix(): self.__get_mtime(root) }
+        c_paths: "list[str]" = []
+        s_paths: "list[str]" = []
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            dirs[Path(dirpath).as_posix()] = self.__get_mtime(Path(dirpath))
+            for filename in sorted(filenames):
+                if filename.endswith(".c"):
+                    c_paths.append(Path(dirpath, filename).as_posix())
+                elif filename.endswith(".s"):
+                    s_paths.append(Path(dirpath, filename).as_posix())
+
+        return { "dirs": dirs, "c": c_paths, "s": s_paths }
+
+    def __get_mtime(self, path: Path) -> "int | None":
+        try:
+            return path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def __read_dlls_txts(self):
         src_dlls_path = Path("src/dlls")
 
-        # TODO: support for custom *new* DLLs (this would need to just skip the decomp dlls.txt lookup) 
-
         # Parse the decomp's dlls.txt
         decomp_dlls_txt_path = DECOMP_DIR.joinpath("src/dlls/dlls.txt")
         assert decomp_dlls_txt_path.exists(), f"Missing dlls.txt file at {decomp_dlls_txt_path.absolute()}"
         
         with open(decomp_dlls_txt_path, "r", encoding="utf-8") as decomp_dlls_txt_file:
-            decomp_dlls_txt = self.__parse_dlls_txt(decomp_dlls_txt_file)
+            decomp_dlls_txt_contents = decomp_dlls_txt_file.read()
+            self.decomp_dlls_txt = self.__parse_dlls_txt(io.StringIO(decomp_dlls_txt_contents))
 
         # Parse our dlls.txt
         dlls_txt_path = src_dlls_path.joinpath("dlls.txt")
         assert dlls_txt_path.exists(), f"Missing dlls.txt file at {dlls_txt_path.absolute()}"
         
         with open(dlls_txt_path, "r", encoding="utf-8") as dlls_txt_file:
-            dlls_txt = self.__parse_dlls_txt(dlls_txt_file)
+            dlls_txt_contents = dlls_txt_file.read()
+            dlls_txt = self.__parse_dlls_txt(io.StringIO(dlls_txt_contents))
 
-        dll_dirs = [(n, src_dlls_path.joinpath(path)) for (n, path) in dlls_txt.items()]
+        self.dll_dirs = [(n, src_dlls_path.joinpath(path)) for (n, path) in dlls_txt.items()]
+
+        # Cached DLL directory scans are only valid for the same dlls.txt files
+        self.dlls_txt_hash = hashlib.sha1((decomp_dlls_txt_contents + "\0" + dlls_txt_contents).encode()).hexdigest()
+        if self.cache.get("dlls_txt") != self.dlls_txt_hash:
+            core_tree = self.cache["trees"].get("src/core")
+            self.cache["trees"] = { "src/core": core_tree } if core_tree != None else {}
+
+    def __scan_core_files(self):
+        tree = self.trees[Path("src/core")]
+
+        c_paths = [Path(path) for path in tree["c"]]
+        for src_path in c_paths:
+            obj_path = self.__make_obj_path(src_path)
+            self.core_files.append(BuildFile(src_path, obj_path, BuildFileType.C))
+        
+        s_paths = [Path(path) for path in tree["s"]]
+        for src_path in s_paths:
+            obj_path = self.__make_obj_path(src_path)
+            self.core_files.append(BuildFile(src_path, obj_path, BuildFileType.ASM))
+    
+    def __scan_dlls(self):
+        # TODO: support for custom *new* DLLs (this would need to just skip the decomp dlls.txt lookup) 
 
         # Find DLL patches/custom code
         to_compile: "set[int]" = set()
-        for (number, dir) in dll_dirs:
-            decomp_dir = decomp_dlls_txt[number]
+        for (number, dir) in self.dll_dirs:
+            decomp_dir = self.decomp_dlls_txt[number]
             assert decomp_dir != None
 
-            c_paths = [Path(path) for path in glob.glob(f"{dir}/**/*.c", recursive=True)]
-            asm_paths = [Path(path) for path in glob.glob(f"{dir}/**/*.s", recursive=True)]
+            tree = self.trees[dir]
+            c_paths = [Path(path) for path in tree["c"]]
+            asm_paths = [Path(path) for path in tree["s"]]
 
             files: "list[BuildFile]" = []
 
@@ -534,39 +925,47 @@ class InputScanner:
             self.dlls.append(DLL(str(number), dir, decomp_dir, files))
             to_compile.add(number)
 
-        # Copy over remaining unmodified DLLs
+        # Pack remaining unmodified DLLs as-is
         for i in range(796):
             if (i + 1) in to_compile:
                 continue
 
-            self.dll_copies.append(DecompFileCopy(
-                Path(f"bin/assets/dlls/{i + 1}.dll"), Path(f"assets/dlls/{i + 1}.dll")))
+            self.unmodified_dlls[i + 1] = DecompFile(Path(f"bin/assets/dlls/{i + 1}.dll"))
 
     def __scan_assets(self):
-        SKIP_ASSETS = set([
-            # Rebuild ourselves
-            "DLLS.bin", # 46
-            "DLLS_tab.bin", # 47
-            "DLLSIMPORTTAB.bin", # 48
+        SKIP_ASSETS = BUILT_ASSETS | set([
             # Zero size assets don't exist
             "CACHEFON.bin", # 11
             "CACHEFON2.bin", # 12
             "VOXOBJ.bin", # 3A
         ])
 
+        # The set of custom assets only changes if the assets directory does
+        assets_mtime = self.__get_mtime(Path("assets"))
+        cached = self.cache.get("assets")
+        if cached != None and cached["mtime_ns"] == assets_mtime:
+            custom_filenames = set(cached["custom"])
+        else:
+            custom_filenames = None
+
+        found_custom: "list[str]" = []
         for asset in FS_MAP:
             if asset in SKIP_ASSETS:
                 continue
             # The decomp uses _tab.bin for tab files but nothing else does, so convert it
             # when looking for custom asset files.
             custom_filename = asset.replace("_tab.bin", ".tab")
-            custom_path = Path(f"assets/{custom_filename}")
-            if custom_path.exists():
-                self.asset_copies.append(AssetFileCopy(
-                    Path(custom_filename), Path(f"assets/{asset}")))
+            if custom_filenames != None:
+                is_custom = custom_filename in custom_filenames
+            else:
+                is_custom = Path(f"assets/{custom_filename}").exists()
+            if is_custom:
+                found_custom.append(custom_filename)
+                self.asset_sources[asset] = AssetFile(Path(custom_filename))
             else:
-                self.asset_copies.append(DecompFileCopy(
-                    Path(f"bin/assets/{asset}"), Path(f"assets/{asset}")))
+                self.asset_sources[asset] = DecompFile(Path(f"bin/assets/{asset}"))
+
+        self.assets_scan = { "mtime_ns": assets_mtime, "custom": found_custom }
     
     def __make_obj_path(self, path: Path) -> Path:
         return path.with_suffix('.o')
@@ -587,10 +986,31 @@ class InputScanner:
         
         return path_map
 
+def write_json_manifest(path: Path, manifest):
+    # Only write if changed, these are inputs of build steps
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_if_changed(path, json.dumps(manifest, indent=0).encode())
+
 def main():
     parser = argparse.ArgumentParser(description="Creates the Ninja build script for Dinosaur Planet precomp.")
     parser.add_argument("--base-dir", type=str, dest="base_dir", help="The root of the project.", default=str(SCRIPT_DIR))
-    parser.add_argument("-r", "--release", action="store_true", help="Configure a release build (without 'DEBUG' defined).", default=False)
+    parser.add_argument("-r", "--release", action="store_true", help="Build the release variant (without 'DEBUG' defined) by default instead of the debug one.", default=False)
+    parser.add_argument("--patch-shards", dest="patch_shards", type=int, default=None,
+                        help="Number of batched steps to patch and convert DLLs in (0 = one step per DLL). Default: 1, or 0 with --build-cache")
+    parser.add_argument("--keep-patched-elfs", dest="keep_patched_elfs", action="store_true", default=False,
+                        help="Also write each DLL's patched ELF to the build directory (for debugging).")
+    parser.add_argument("--no-scan-cache", dest="no_scan_cache", action="store_true", default=False,
+                        help="Rescan all source directories instead of reusing results for unchanged directories.")
+    parser.add_argument("--build-cache", dest="build_cache", action="store_true", default=False,
+                        help="Reuse outputs of compile, link and DLL conversion steps whose inputs were built before (from a cache shared between checkouts).")
+    parser.add_argument("--build-cache-dir", dest="build_cache_dir", type=str, default=None,
+                        help=f"Directory of the build cache. Default: {get_default_cache_dir()}")
+    parser.add_argument("--build-cache-max-size", dest="build_cache_max_size", type=str, default=DEFAULT_MAX_SIZE,
+                        help=f"Size the build cache is kept under (e.g. 500M, 5G). Default: {DEFAULT_MAX_SIZE}")
+    parser.add_argument("--no-pch", dest="no_pch", action="store_true", default=False,
+                        help="Don't precompile the headers shared by C files.")
+    parser.add_argument("--worker", dest="worker", action="store_true", default=False,
+                        help="Run the Python build tools in a resident worker process to skip their startup cost (not supported on Windows).")
     
     args = parser.parse_args()
 
@@ -598,17 +1018,81 @@ def main():
     os.chdir(Path(args.base_dir).resolve())
 
     # Make config
-    config = BuildConfig(release_build=args.release)
+    configure_args: "list[str]" = []
+    if args.release:
+        configure_args.append("--release")
+    if args.patch_shards != None:
+        configure_args.append(f"--patch-shards={args.patch_shards}")
+    if args.keep_patched_elfs:
+        configure_args.append("--keep-patched-elfs")
+    if args.no_scan_cache:
+        configure_args.append("--no-scan-cache")
+    if args.worker:
+        configure_args.append("--worker")
+    if args.no_pch:
+        configure_args.append("--no-pch")
+    build_cache_dir: "str | None" = None
+    if args.build_cache:
+        try:
+            parse_size(args.build_cache_max_size)
+        except BuildCacheException as ex:
+            print(f"ERROR: {ex}")
+            exit(1)
+        build_cache_dir = str(Path(args.build_cache_dir).absolute()) if args.build_cache_dir != None \
+            else str(get_default_cache_dir())
+        configure_args.append("--build-cache")
+        if args.build_cache_dir != None:
+            configure_args.append(f"--build-cache-dir={build_cache_dir}")
+        if args.build_cache_max_size != DEFAULT_MAX_SIZE:
+            configure_args.append(f"--build-cache-max-size={args.build_cache_max_size}")
+    # Batched patch steps can't be cached per DLL, so caching defaults to one step per DLL
+    if args.patch_shards != None:
+        patch_shards = max(args.patch_shards, 0)
+    else:
+        patch_shards = 0 if args.build_cache else 1
+    config = BuildConfig(default_variants=["release" if args.release else "debug"], 
+                         patch_shards=patch_shards,
+                         keep_patched_elfs=args.keep_patched_elfs,
+                         use_worker=args.worker,
+                         use_pch=not args.no_pch,
+                         build_cache_dir=build_cache_dir,
+                         build_cache_max_size=args.build_cache_max_size,
+                         configure_args=configure_args)
 
     # Gather input files
-    scanner = InputScanner()
+    scanner = InputScanner(None if args.no_scan_cache else SCAN_CACHE)
     input = scanner.scan()
-
-    # Write ninja build file
-    with open("build.ninja", "w") as ninja_file:
-        writer = BuildNinjaWriter(ninja.Writer(ninja_file), input, config)
-        writer.write()
-
+    if config.use_pch:
+        input.find_preludes()
+
+    # Write ninja build files (only if changed, so ninja doesn't see a spurious regeneration)
+    variants_changed = False
+    for variant in VARIANTS:
+        variant_file = io.StringIO()
+        variant_writer = VariantNinjaWriter(ninja.Writer(variant_file), input, config, variant)
+        variant_writer.write()
+        variant.build_dir.mkdir(parents=True, exist_ok=True)
+        if write_if_changed(variant.build_dir.joinpath(VARIANT_NINJA_FILENAME), variant_file.getvalue().encode()):
+            variants_changed = True
+
+        # Write manifests for the pack_dlls and pack_fs steps
+        write_json_manifest(variant.build_dir.joinpath(DLL_SOURCES_FILENAME), variant_writer.dll_sources)
+        write_json_manifest(variant.build_dir.joinpath(ASSET_SOURCES_FILENAME), variant_writer.asset_sources)
+
+        # Write the preludes to precompile up front (make_prelude keeps them up to date as the
+        # C files change)
+        for (filename, includes) in [(CORE_PRELUDE_FILENAME, input.core_prelude), (DLL_PRELUDE_FILENAME, input.dll_prelude)]:
+            if len(includes) > 0:
+                prelude_path = variant.build_dir.joinpath(filename)
+                prelude_path.parent.mkdir(parents=True, exist_ok=True)
+                write_if_changed(prelude_path, format_prelude(includes).encode())
+
+    ninja_file = io.StringIO()
+    BuildNinjaWriter(ninja.Writer(ninja_file), input, config).write()
+    # Ninja only reloads its build files after regenerating them if build.ninja itself changed
+    if not write_if_changed("build.ninja", ninja_file.getvalue().encode()) and variants_changed:
+        os.utime("build.ninja")
+    write_depfile(CONFIGURE_DEPFILE, "build.ninja", input.configure_deps)
 
 if __name__ == "__main__":
     main()
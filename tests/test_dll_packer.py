@@ -0,0 +1,62 @@
+import json
+import os
+from pathlib import Path
+
+from tools.dll_packer import TAB_ENTRY, pack
+
+DLL_SIZES = [0x40, 0x13, 0x100, 0x2D, 0x08]
+
+def make_dll(path: Path, size: int, fill: int):
+    path.write_bytes(bytes((fill + i) & 0xFF for i in range(size)))
+    # Make sure a rewrite is noticed even if it lands within the same mtime tick
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+def make_sources(dir: Path) -> Path:
+    tab = bytearray(b"TABH" * 4)
+    for i in range(len(DLL_SIZES) + 1):
+        tab.extend(TAB_ENTRY.pack(0, 0x10 * i))
+    tab.extend(b"\xFF\xFF\xFF\xFF")
+    dir.joinpath("tab.bin").write_bytes(tab)
+
+    dlls = []
+    for i, size in enumerate(DLL_SIZES):
+        path = dir.joinpath(f"{i + 1}.dll")
+        make_dll(path, size, i)
+        dlls.append({ "path": str(path) })
+
+    sources_path = dir.joinpath("dlls.json")
+    sources_path.write_text(json.dumps({ "tab": str(dir.joinpath("tab.bin")), "dlls": dlls }))
+    return sources_path
+
+# Updates the incremental pack and checks that it matches a full pack of the same DLLs
+def assert_update_matches_full_pack(dir: Path, sources_path: Path):
+    pack(sources_path, dir.joinpath("DLLS.bin"), dir.joinpath("DLLS_tab.bin"), incremental=True)
+    pack(sources_path, dir.joinpath("full.bin"), dir.joinpath("full_tab.bin"), incremental=False)
+
+    assert dir.joinpath("DLLS.bin").read_bytes() == dir.joinpath("full.bin").read_bytes()
+    assert dir.joinpath("DLLS_tab.bin").read_bytes() == dir.joinpath("full_tab.bin").read_bytes()
+
+def test_same_size_change(tmp_path: Path):
+    sources_path = make_sources(tmp_path)
+    pack(sources_path, tmp_path.joinpath("DLLS.bin"), tmp_path.joinpath("DLLS_tab.bin"), incremental=True)
+
+    make_dll(tmp_path.joinpath("3.dll"), DLL_SIZES[2], 0x80)
+
+    assert_update_matches_full_pack(tmp_path, sources_path)
+
+def test_growing_dll_moves_the_ones_after_it(tmp_path: Path):
+    sources_path = make_sources(tmp_path)
+    pack(sources_path, tmp_path.joinpath("DLLS.bin"), tmp_path.joinpath("DLLS_tab.bin"), incremental=True)
+
+    make_dll(tmp_path.joinpath("2.dll"), 0x135, 0x80)
+
+    assert_update_matches_full_pack(tmp_path, sources_path)
+
+def test_shrinking_dll_moves_the_ones_after_it(tmp_path: Path):
+    sources_path = make_sources(tmp_path)
+    pack(sources_path, tmp_path.joinpath("DLLS.bin"), tmp_path.joinpath("DLLS_tab.bin"), incremental=True)
+
+    make_dll(tmp_path.joinpath("3.dll"), 0x24, 0x80)
+
+    assert_update_matches_full_pack(tmp_path, sources_path)
@@ -0,0 +1,57 @@
+from elftools.construct.lib.container import Container
+from elftools.elf.relocation import Relocation
+
+from tools.elf_patcher import replace_relocation_ranges
+
+R_MIPS_26 = 4
+R_MIPS_HI16 = 5
+R_MIPS_LO16 = 6
+
+def make_reloc(offset: int, type: int) -> Relocation:
+    return Relocation(Container(r_offset=offset, r_info_type=type, r_info_sym=1), None)
+
+def get_table(relocations: list[Relocation]) -> list[tuple[int, int]]:
+    return [(reloc.entry["r_offset"], reloc.entry["r_info_type"]) for reloc in relocations]
+
+# As gas writes it: each HI16 is moved to just before the LO16 it pairs with
+ORIGINAL = [
+    (0x00, R_MIPS_26),
+    (0x10, R_MIPS_HI16),
+    (0x08, R_MIPS_HI16),
+    (0x14, R_MIPS_LO16),
+    (0x20, R_MIPS_26),
+    (0x30, R_MIPS_HI16),
+    (0x28, R_MIPS_HI16),
+    (0x34, R_MIPS_LO16),
+    (0x40, R_MIPS_26),
+]
+
+def test_keeps_order_outside_replaced_range():
+    relocations = [make_reloc(offset, type) for (offset, type) in ORIGINAL]
+    patch = [make_reloc(0x2C, R_MIPS_HI16), make_reloc(0x24, R_MIPS_HI16), make_reloc(0x30, R_MIPS_LO16)]
+
+    result = replace_relocation_ranges(relocations, [(0x24, 0x38, patch)])
+
+    assert get_table(result) == ORIGINAL[:5] + get_table(patch) + ORIGINAL[8:]
+
+def test_replacements_go_where_their_first_overwritten_relocation_was():
+    relocations = [make_reloc(offset, type) for (offset, type) in ORIGINAL]
+    first = [make_reloc(0x0C, R_MIPS_HI16), make_reloc(0x10, R_MIPS_LO16)]
+    second = [make_reloc(0x40, R_MIPS_26)]
+
+    result = replace_relocation_ranges(relocations, [(0x08, 0x18, first), (0x40, 0x44, second)])
+
+    assert get_table(result) == ORIGINAL[:1] + get_table(first) + ORIGINAL[4:8] + get_table(second)
+
+def test_replacement_without_overwritten_relocations_goes_before_the_next_one():
+    relocations = [make_reloc(offset, type) for (offset, type) in ORIGINAL]
+    patch = [make_reloc(0x1C, R_MIPS_26)]
+
+    result = replace_relocation_ranges(relocations, [(0x18, 0x20, patch), (0x100, 0x104, [make_reloc(0x100, R_MIPS_26)])])
+
+    assert get_table(result) == ORIGINAL[:4] + [(0x1C, R_MIPS_26)] + ORIGINAL[4:] + [(0x100, R_MIPS_26)]
+
+def test_no_replacements_leaves_table_unchanged():
+    relocations = [make_reloc(offset, type) for (offset, type) in ORIGINAL]
+
+    assert get_table(replace_relocation_ranges(relocations, [])) == ORIGINAL
@@ -0,0 +1,48 @@
+import os
+from pathlib import Path
+
+from tools.fs_packer import FS_MAP, repack, repack_incremental
+
+# Entries to give contents, the rest are packed as empty
+ASSET_SIZES = { "AUDIO_tab.bin": 0x20, "SFX.bin": 0x35, "MAPS.bin": 0x100, "ENVFXACT.bin": 0x0C }
+
+def make_asset(path: Path, size: int, fill: int):
+    path.write_bytes(bytes((fill + i) & 0xFF for i in range(size)))
+    # Make sure a rewrite is noticed even if it lands within the same mtime tick
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+def make_assets(dir: Path) -> "list[Path | None]":
+    asset_paths: "list[Path | None]" = []
+    for i, filename in enumerate(FS_MAP):
+        if filename in ASSET_SIZES:
+            path = dir.joinpath(filename)
+            make_asset(path, ASSET_SIZES[filename], i)
+            asset_paths.append(path)
+        else:
+            asset_paths.append(None)
+    return asset_paths
+
+# Updates the incremental repack and checks that it matches a full repack of the same assets
+def assert_update_matches_full_repack(dir: Path, asset_paths: "list[Path | None]"):
+    repack_incremental(asset_paths, dir.joinpath("fs.bin"))
+    with open(dir.joinpath("full.bin"), "wb") as output_writer:
+        repack(asset_paths, output_writer)
+
+    assert dir.joinpath("fs.bin").read_bytes() == dir.joinpath("full.bin").read_bytes()
+
+def test_same_size_change(tmp_path: Path):
+    asset_paths = make_assets(tmp_path)
+    repack_incremental(asset_paths, tmp_path.joinpath("fs.bin"))
+
+    make_asset(tmp_path.joinpath("SFX.bin"), ASSET_SIZES["SFX.bin"], 0x80)
+
+    assert_update_matches_full_repack(tmp_path, asset_paths)
+
+def test_resized_entry_rewrites_the_ones_after_it(tmp_path: Path):
+    asset_paths = make_assets(tmp_path)
+    repack_incremental(asset_paths, tmp_path.joinpath("fs.bin"))
+
+    make_asset(tmp_path.joinpath("SFX.bin"), 0x47, 0x80)
+
+    assert_update_matches_full_repack(tmp_path, asset_paths)
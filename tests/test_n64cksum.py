@@ -0,0 +1,27 @@
+import random
+
+import pytest
+
+from tools import n64cksum
+from tools.n64cksum import CHECKSUM_END, CIC_SEEDS, sm64_calc_checksums, sm64_calc_checksums_reference
+
+ROM_SIZE = CHECKSUM_END
+
+def make_random_rom() -> bytearray:
+    return bytearray(random.Random(0x6102).randbytes(ROM_SIZE))
+
+def make_zero_rom() -> bytearray:
+    return bytearray(ROM_SIZE)
+
+@pytest.mark.parametrize("use_numpy", [True, False], ids=["numpy", "no-numpy"])
+@pytest.mark.parametrize("make_rom", [make_random_rom, make_zero_rom], ids=["random", "zero"])
+@pytest.mark.parametrize("cic", sorted(CIC_SEEDS.keys()))
+def test_matches_reference(monkeypatch: pytest.MonkeyPatch, cic: int, make_rom, use_numpy: bool):
+    if use_numpy:
+        if n64cksum.numpy == None:
+            pytest.skip("NumPy is not installed")
+    else:
+        monkeypatch.setattr(n64cksum, "numpy", None)
+
+    rom = make_rom()
+    assert tuple(sm64_calc_checksums(rom, cic)) == tuple(sm64_calc_checksums_reference(rom, cic))
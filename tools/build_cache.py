@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+# Content-addressed cache of build step outputs (like ccache, but for any build step)
+#
+# `run` wraps a build command. The step is keyed on the command line, the executable it
+# runs and the contents of its inputs. On a hit, the outputs (and the command's console
+# output) are restored from the cache instead of running the command. On a miss, the
+# command is run and its outputs are stored.
+#
+# Steps with a depfile also depend on the files listed in it (e.g. headers), which are only
+# known after the step ran. For those, the cache keeps a manifest per command and inputs
+# key, listing the depfile dependencies (and their hashes) of each stored result. Inputs
+# with a depfile of their own (such as a precompiled header, whose headers the compiler
+# leaves out of the step's depfile) can pass it too, adding its dependencies to the step's.
+#
+# Cache layout:
+#   manifests/<xx>/<key>.json: [{ "deps": [[path, hash], ...], "result": <result key> }, ...]
+#   results/<xx>/<key>/: one file per output (named by its index), stdout and stderr
+#   stats.json: approximate total size, hit and miss counts
+# Results and manifests are evicted least recently used first once the cache grows
+# past its maximum size.
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Iterator
+
+from tools.fileutil import file_equals, hash_file, write_if_changed
+
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = "5G"
+# Manifest entries kept per command and inputs key (one per distinct set of dependencies)
+MAX_MANIFEST_ENTRIES = 16
+# The cache is trimmed down to this fraction of the maximum size
+TRIM_RATIO = 0.9
+
+SIZE_SUFFIXES = { "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4 }
+
+class BuildCacheException(Exception):
+    pass
+
+def parse_size(size: str) -> int:
+    size = size.strip().upper()
+    try:
+        if size[-1:] in SIZE_SUFFIXES:
+            return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+        return int(size)
+    except ValueError:
+        raise BuildCacheException(f"Invalid size: {size}")
+
+def format_size(size: int) -> str:
+    for suffix in ["T", "G", "M", "K"]:
+        if size >= SIZE_SUFFIXES[suffix]:
+            return f"{size / SIZE_SUFFIXES[suffix]:.1f}{suffix}"
+    return str(size)
+
+def get_default_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    base = Path(cache_home) if cache_home else Path.home().joinpath(".cache")
+    return base.joinpath("dp-precomp")
+
+def parse_depfile(path: str) -> "list[str]":
+    with open(path, "r", encoding="utf-8") as depfile:
+        text = depfile.read().replace("\\\n", " ")
+
+    deps: "list[str]" = []
+    for line in text.splitlines():
+        # Skip the target, up to the first colon followed by whitespace (so that
+        # Windows drive letters aren't mistaken for it)
+        colon = line.find(": ")
+        if colon == -1:
+            if not line.rstrip().endswith(":"):
+                continue
+            colon = len(line.rstrip()) - 1
+        # Split on whitespace that isn't escaped with a backslash
+        dep = ""
+        escaped = False
+        for c in line[colon + 1:]:
+            if escaped:
+                dep += c
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c.isspace():
+                if dep:
+                    deps.append(dep)
+                dep = ""
+            else:
+                dep += c
+        if dep:
+            deps.append(dep)
+    return deps
+
+def get_tree_size(path: Path) -> int:
+    size = 0
+    for (dirpath, _, filenames) in os.walk(path):
+        for filename in filenames:
+            with contextlib.suppress(FileNotFoundError):
+                size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+class BuildCache:
+    def __init__(self, cache_dir: Path, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hashes: "dict[str, str]" = {}
+
+    def get_direct_key(self, command: "list[str]", inputs: "list[str]", outputs: "list[str]") -> str:
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps([CACHE_VERSION, command, outputs]).encode())
+
+        # The program being run, identified by its size and mtime like ccache does
+        executable = shutil.which(command[0])
+        if executable == None:
+            raise BuildCacheException(f"Command not found: {command[0]}")
+        stat = os.stat(executable)
+        sha1.update(json.dumps([executable, stat.st_size, stat.st_mtime_ns]).encode())
+
+        for path in inputs:
+            sha1.update(json.dumps([path, self.hash_file(path)]).encode())
+
+        return sha1.hexdigest()
+
+    def hash_file(self, path: str) -> str:
+        hash = self.hashes.get(path)
+        if hash == None:
+            hash = hash_file(Path(path))
+            self.hashes[path] = hash
+        return hash
+
+    def get_result_key(self, direct_key: str, deps: "list[tuple[str, str]]") -> str:
+        return hashlib.sha1(json.dumps([direct_key, deps]).encode()).hexdigest()
+
+    def get_manifest_path(self, key: str) -> Path:
+        return self.cache_dir.joinpath("manifests", key[:2], f"{key}.json")
+
+    def get_result_path(self, key: str) -> Path:
+        return self.cache_dir.joinpath("results", key[:2], key)
+
+    def load_manifest(self, direct_key: str) -> "list[dict]":
+        try:
+            with open(self.get_manifest_path(direct_key), "r", encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            return []
+        return manifest if isinstance(manifest, list) else []
+
+    # Finds the result stored for a step, or None if there is none
+    def find_result(self, direct_key: str, has_depfile: bool) -> "str | None":
+        if not has_depfile:
+            return direct_key if self.get_result_path(direct_key).is_dir() else None
+
+        for entry in self.load_manifest(direct_key):
+            try:
+                if all(self.hash_file(path) == hash for (path, hash) in entry["deps"]):
+                    if self.get_result_path(entry["result"]).is_dir():
+                        return entry["result"]
+            except FileNotFoundError:
+                continue
+        return None
+
+    # Copies a stored result to the outputs, leaving outputs that are already identical alone.
+    # Returns False if the result is incomplete.
+    def restore(self, result_key: str, outputs: "list[str]") -> bool:
+        result_path = self.get_result_path(result_key)
+        cached = [result_path.joinpath(str(i)) for i in range(len(outputs))]
+        if not all(path.is_file() for path in cached):
+            return False
+
+        for (src, dst) in zip(cached, outputs):
+            with open(src, "rb") as src_file:
+                if file_equals(src_file, dst):
+                    continue
+            Path(dst).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{dst}.tmp"
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, dst)
+
+        # Replay what the command printed (e.g. compiler warnings)
+        for (name, stream) in [("stdout", sys.stdout), ("stderr", sys.stderr)]:
+            with contextlib.suppress(FileNotFoundError):
+                data = result_path.joinpath(name).read_bytes()
+                if data:
+                    stream.flush()
+                    stream.buffer.write(data)
+                    stream.flush()
+
+        # Mark as recently used
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(result_path)
+        return True
+
+    def store(self, direct_key: str, deps: "list[str] | None", outputs: "list[str]", stdout: bytes, stderr: bytes):
+        if deps != None:
+            dep_hashes = [(path, self.hash_file(path)) for path in deps]
+            result_key = self.get_result_key(direct_key, dep_hashes)
+        else:
+            result_key = direct_key
+
+        # Results are written to a temporary directory first so that other build steps
+        # never see a partial result
+        result_path = self.get_result_path(result_key)
+        size = 0
+        if not result_path.exists():
+            result_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = Path(tempfile.mkdtemp(prefix=".tmp-", dir=result_path.parent))
+            try:
+                for (i, output) in enumerate(outputs):
+                    shutil.copyfile(output, tmp_path.joinpath(str(i)))
+                tmp_path.joinpath("stdout").write_bytes(stdout)
+                tmp_path.joinpath("stderr").write_bytes(stderr)
+                size = get_tree_size(tmp_path)
+                os.rename(tmp_path, result_path)
+            except OSError:
+                # Stored by another build step at the same time, or the copy failed
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                size = 0
+
+        with self.lock():
+            if deps != None:
+                entries = [entry for entry in self.load_manifest(direct_key) if entry.get("result") != result_key]
+                entries.insert(0, { "deps": dep_hashes, "result": result_key })
+                manifest_path = self.get_manifest_path(direct_key)
+                manifest_path.parent.mkdir(parents=True, exist_ok=True)
+                data = json.dumps(entries[:MAX_MANIFEST_ENTRIES]).encode()
+                size += len(data)
+                write_if_changed(manifest_path, data)
+
+            stats = self.load_stats()
+            stats["size"] += size
+            stats["misses"] += 1
+            if stats["size"] > self.max_size:
+                stats["size"] = self.trim(int(self.max_size * TRIM_RATIO))
+            self.save_stats(stats)
+
+    def record_hit(self):
+        with self.lock():
+            stats = self.load_stats()
+            stats["hits"] += 1
+            self.save_stats(stats)
+
+    # Evicts the least recently used results and manifests until the cache is at most
+    # target_size bytes. Returns the new size.
+    def trim(self, target_size: int) -> int:
+        items: "list[tuple[int, int, Path]]" = []
+        for kind in ["results", "manifests"]:
+            kind_path = self.cache_dir.joinpath(kind)
+            if not kind_path.is_dir():
+                continue
+            for prefix in os.scandir(kind_path):
+                if not prefix.is_dir():
+                    continue
+                for entry in os.scandir(prefix.path):
+                    if entry.name.startswith(".tmp-"):
+                        continue
+                    path = Path(entry.path)
+                    size = get_tree_size(path) if entry.is_dir() else entry.stat().st_size
+                    items.append((entry.stat().st_mtime_ns, size, path))
+
+        total = sum(size for (_, size, _) in items)
+        items.sort()
+        for (_, size, path) in items:
+            if total <= target_size:
+                break
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    path.unlink()
+            total -= size
+        return total
+
+    @contextlib.contextmanager
+    def lock(self) -> Iterator[None]:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            import fcntl
+        except ImportError:
+            # No file locking (Windows), stats may be slightly off
+            yield
+            return
+        with open(self.cache_dir.joinpath("lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def load_stats(self) -> dict:
+        stats = { "size": 0, "hits": 0, "misses": 0 }
+        try:
+            with open(self.cache_dir.joinpath("stats.json"), "r", encoding="utf-8") as stats_file:
+                stats.update(json.load(stats_file))
+        except (FileNotFoundError, ValueError):
+            pass
+        return stats
+
+    def save_stats(self, stats: dict):
+        write_if_changed(self.cache_dir.joinpath("stats.json"), json.dumps(stats).encode())
+
+def run_command(command: "list[str]") -> "tuple[int, bytes, bytes]":
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as ex:
+        return (127, b"", f"{command[0]}: {ex}\n".encode())
+    return (process.returncode, process.stdout, process.stderr)
+
+def write_output(stdout: bytes, stderr: bytes):
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(stderr)
+    sys.stderr.flush()
+
+# Runs a build step through the cache, returning its exit code
+def run_cached(cache: BuildCache, command: "list[str]", inputs: "list[str]", outputs: "list[str]",
+               depfile: "str | None", input_depfiles: "list[str]" = []) -> int:
+    if depfile != None:
+        outputs = outputs + [depfile]
+    has_deps = depfile != None or len(input_depfiles) > 0
+
+    # Problems with the cache itself never fail the build step, it just runs uncached
+    direct_key: "str | None" = None
+    try:
+        direct_key = cache.get_direct_key(command, inputs, outputs)
+        result_key = cache.find_result(direct_key, has_deps)
+        if result_key != None and cache.restore(result_key, outputs):
+            cache.record_hit()
+            return 0
+    except (OSError, BuildCacheException) as ex:
+        print(f"WARNING: Build cache lookup failed: {ex}", file=sys.stderr)
+
+    (code, stdout, stderr) = run_command(command)
+    write_output(stdout, stderr)
+
+    if code == 0 and direct_key != None:
+        try:
+            deps: "list[str] | None" = None
+            if has_deps:
+                depfiles = input_depfiles + ([depfile] if depfile != None else [])
+                deps = list(dict.fromkeys(dep for path in depfiles for dep in parse_depfile(path)))
+            cache.store(direct_key, deps, outputs, stdout, stderr)
+        except (OSError, BuildCacheException) as ex:
+            print(f"WARNING: Couldn't store build step in the cache: {ex}", file=sys.stderr)
+
+    return code
+
+def main():
+    # Everything after -- is the command to run
+    argv = sys.argv[1:]
+    command: "list[str]" = []
+    if "--" in argv:
+        split = argv.index("--")
+        (argv, command) = (argv[:split], argv[split + 1:])
+
+    parser = argparse.ArgumentParser(description="Caches the outputs of build steps by the contents of their inputs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_cache_args(subparser: argparse.ArgumentParser):
+        subparser.add_argument("--dir", type=str, help="The cache directory.", default=str(get_default_cache_dir()))
+        subparser.add_argument("--max-size", dest="max_size", type=str, default=DEFAULT_MAX_SIZE,
+                               help=f"Size the cache is kept under (e.g. 500M, 5G). Default: {DEFAULT_MAX_SIZE}")
+
+    run_parser = subparsers.add_parser("run", help="Run a build step through the cache: run [options] -- command...")
+    add_cache_args(run_parser)
+    run_parser.add_argument("--inputs", type=str, nargs="*", default=[], help="Files the step reads.")
+    run_parser.add_argument("--outputs", type=str, nargs="+", required=True, help="Files the step writes.")
+    run_parser.add_argument("--depfile", type=str, help="Depfile the step writes, listing additional inputs.")
+    run_parser.add_argument("--input-depfiles", dest="input_depfiles", type=str, nargs="*", default=[],
+                            help="Depfiles of inputs, listing files the step also depends on (e.g. the headers of a precompiled header).")
+
+    stats_parser = subparsers.add_parser("stats", help="Show cache statistics.")
+    add_cache_args(stats_parser)
+
+    trim_parser = subparsers.add_parser("trim", help="Evict old entries until the cache is under its maximum size.")
+    add_cache_args(trim_parser)
+
+    args = parser.parse_args(argv)
+
+    try:
+        cache = BuildCache(Path(args.dir), parse_size(args.max_size))
+    except BuildCacheException as ex:
+        print(f"ERROR: {ex}")
+        exit(1)
+
+    if args.command == "run":
+        if len(command) == 0:
+            parser.error("a command to run is required after --")
+        exit(run_cached(cache, command, args.inputs, args.outputs, args.depfile, args.input_depfiles))
+    elif args.command == "stats":
+        stats = cache.load_stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups * 100 if lookups > 0 else 0
+        print(f"Cache directory: {cache.cache_dir}")
+        print(f"Size: {format_size(stats['size'])} / {format_size(cache.max_size)}")
+        print(f"Hits: {stats['hits']}, misses: {stats['misses']} ({hit_rate:.1f}% hit rate)")
+    else:
+        with cache.lock():
+            stats = cache.load_stats()
+            stats["size"] = cache.trim(int(cache.max_size * TRIM_RATIO))
+            cache.save_stats(stats)
+        print(f"Cache size: {format_size(stats['size'])}")
+
+if __name__ == "__main__":
+    main()
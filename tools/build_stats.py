@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+
+# Reports where the time of the last ninja build went
+#
+# Reads the step timings of the last build from .ninja_log and the build graph from
+# build.ninja (and the files it includes), then reports the time spent per rule and the
+# critical path: the chain of steps that each waited on the previous one, ending with the
+# last step to finish. Each report is appended to a history file, and compared against the
+# median of the previous few builds with the same label to flag regressions.
+#
+# The history also records how far into the log each report read, so that the next report
+# only covers the entries appended since (run it after each build).
+
+import argparse
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+from pathlib import Path
+import statistics
+
+NINJA_LOG_VERSIONS = [5, 6, 7]
+DEFAULT_HISTORY = "build/build_stats_history.jsonl"
+DEFAULT_BASELINE_SIZE = 5
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_MIN_DELTA = 0.25
+CRITICAL_PATH_LIMIT = 20
+# Bytes of the log before the end of a report's range that are hashed to detect rewrites
+LOG_TAIL_SIZE = 256
+
+class BuildStatsException(Exception):
+    pass
+
+class LogEntry:
+    def __init__(self, start_ms: int, end_ms: int, output: str, command_hash: str):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.output = output
+        self.command_hash = command_hash
+
+class Edge:
+    def __init__(self, rule: str, outputs: "list[str]", inputs: "list[str]"):
+        self.rule = rule
+        self.outputs = outputs
+        # Explicit, implicit and order-only inputs
+        self.inputs = inputs
+
+# A step that ran in the last build
+class Step:
+    def __init__(self, rule: str, outputs: "list[str]", start_ms: int, end_ms: int, edge: "Edge | None"):
+        self.rule = rule
+        self.outputs = outputs
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.edge = edge
+
+    def duration(self) -> float:
+        return (self.end_ms - self.start_ms) / 1000
+
+def read_log(log_path: Path) -> bytes:
+    try:
+        with open(log_path, "rb") as log_file:
+            data = log_file.read()
+    except FileNotFoundError:
+        raise BuildStatsException(f"{log_path} not found, run a build first.")
+
+    header = data.split(b"\n", 1)[0].decode("utf-8", errors="replace")
+    if not any(header == f"# ninja log v{version}" for version in NINJA_LOG_VERSIONS):
+        raise BuildStatsException(f"{log_path} is not a supported ninja log.")
+    return data
+
+def get_log_tail_hash(data: bytes, end: int) -> str:
+    return hashlib.sha1(data[max(end - LOG_TAIL_SIZE, 0):end]).hexdigest()
+
+# Gets the byte range of the log to report on, given the range of the previous report on it
+# (None if there wasn't one, in which case it's the whole log). That's what was appended
+# since the previous report, or the same range again if nothing was. Returns None if the
+# log was rewritten since then: ninja recompacts it now and then, leaving its entries in no
+# particular order, so the last build can't be told apart.
+def get_log_range(data: bytes, previous: "dict | None") -> "tuple[int, int] | None":
+    start = data.find(b"\n") + 1
+    # Only complete lines, in case a build is still writing to the log
+    end = data.rfind(b"\n") + 1
+    if previous == None:
+        return (start, end)
+    if previous["end"] > end or get_log_tail_hash(data, previous["end"]) != previous["tail"]:
+        return None
+    if previous["end"] == end:
+        return (previous["start"], previous["end"])
+    return (previous["end"], end)
+
+def make_log_record(path: str, data: bytes, start: int, end: int) -> dict:
+    return { "path": path, "start": start, "end": end, "tail": get_log_tail_hash(data, end) }
+
+# Reads the entries of the last build in a range of a ninja log. Each build appends its
+# entries as steps finish, with times relative to the start of the build, so if more than
+# one build ran, the last one is the trailing run of entries whose end times don't decrease
+# (and that build each output once).
+def read_last_build(data: bytes, start: int, end: int) -> "list[LogEntry]":
+    entries: "list[LogEntry]" = []
+    outputs: "set[str]" = set()
+    for line in data[start:end].decode("utf-8", errors="replace").splitlines():
+        fields = line.split("\t")
+        if len(fields) != 5:
+            continue
+        entry = LogEntry(int(fields[0]), int(fields[1]), fields[3], fields[4])
+        if len(entries) > 0 and (entry.end_ms < entries[-1].end_ms or entry.output in outputs):
+            entries = []
+            outputs = set()
+        entries.append(entry)
+        outputs.add(entry.output)
+    return entries
+
+class NinjaScope:
+    def __init__(self, parent: "NinjaScope | None"):
+        self.parent = parent
+        self.variables: "dict[str, str]" = {}
+
+    def lookup(self, name: str) -> str:
+        scope: "NinjaScope | None" = self
+        while scope != None:
+            value = scope.variables.get(name)
+            if value != None:
+                return value
+            scope = scope.parent
+        return ""
+
+VARIABLE_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-")
+
+# Expands the variables and escapes of a ninja string
+def expand(text: str, lookup) -> str:
+    result: "list[str]" = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c != "$":
+            result.append(c)
+            i += 1
+            continue
+        i += 1
+        if i == len(text):
+            break
+        c = text[i]
+        if c in "$ :\n":
+            result.append(c)
+            i += 1
+        elif c == "{":
+            end = text.index("}", i)
+            result.append(lookup(text[i + 1:end]))
+            i = end + 1
+        else:
+            start = i
+            while i < len(text) and text[i] in VARIABLE_CHARS:
+                i += 1
+            result.append(lookup(text[start:i]))
+    return "".join(result)
+
+# Splits a build line into (unexpanded) paths and the :, |, || and |@ separators
+def split_build_line(text: str) -> "list[str]":
+    tokens: "list[str]" = []
+    token = ""
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "$" and i + 1 < len(text):
+            if text[i + 1] == "{":
+                end = text.index("}", i)
+                token += text[i:end + 1]
+                i = end + 1
+            else:
+                token += text[i:i + 2]
+                i += 2
+            continue
+        if c in " :|":
+            if token:
+                tokens.append(token)
+                token = ""
+            if c == ":":
+                tokens.append(":")
+            elif c == "|":
+                separator = text[i:i + 2] if text[i:i + 2] in ("||", "|@") else "|"
+                tokens.append(separator)
+                i += len(separator) - 1
+        else:
+            token += c
+        i += 1
+    if token:
+        tokens.append(token)
+    return tokens
+
+# Joins lines ending with $ (escaped newlines) and drops comments and blank lines
+def read_logical_lines(path: Path) -> "list[str]":
+    with open(path, "r", encoding="utf-8") as ninja_file:
+        raw_lines = ninja_file.read().splitlines()
+
+    lines: "list[str]" = []
+    pending = ""
+    for raw_line in raw_lines:
+        line = raw_line.lstrip() if pending else raw_line
+        if not pending and line.lstrip().startswith("#"):
+            continue
+        trailing = len(line) - len(line.rstrip("$"))
+        if trailing % 2 == 1:
+            pending += line[:-1]
+            continue
+        line = pending + line
+        pending = ""
+        if line.strip():
+            lines.append(line)
+    if pending.strip():
+        lines.append(pending)
+    return lines
+
+class BuildGraph:
+    def __init__(self):
+        self.edges: "list[Edge]" = []
+        self.edge_by_output: "dict[str, Edge]" = {}
+
+    def get_producer(self, path: str) -> "Edge | None":
+        return self.edge_by_output.get(path)
+
+def canonicalize(path: str) -> str:
+    return os.path.normpath(path).replace(os.sep, "/")
+
+# Reads the build edges of a ninja file, following include and subninja statements
+def read_build_graph(ninja_path: Path) -> BuildGraph:
+    graph = BuildGraph()
+    read_ninja_file(ninja_path, NinjaScope(None), graph)
+    return graph
+
+def read_ninja_file(path: Path, scope: NinjaScope, graph: BuildGraph):
+    try:
+        lines = read_logical_lines(path)
+    except FileNotFoundError:
+        raise BuildStatsException(f"{path} not found, run configure.py first.")
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        # Indented variable bindings belong to the statement before them
+        bindings: "list[tuple[str, str]]" = []
+        while i < len(lines) and lines[i][:1] in (" ", "\t"):
+            (name, _, value) = lines[i].strip().partition("=")
+            bindings.append((name.strip(), value.lstrip()))
+            i += 1
+
+        (keyword, _, rest) = line.partition(" ")
+        if keyword == "build":
+            read_build_statement(rest, bindings, scope, graph)
+        elif keyword in ("include", "subninja"):
+            child_path = Path(expand(rest.strip(), scope.lookup))
+            read_ninja_file(child_path, scope if keyword == "include" else NinjaScope(scope), graph)
+        elif keyword in ("rule", "pool", "default"):
+            continue
+        else:
+            (name, _, value) = line.partition("=")
+            scope.variables[name.strip()] = expand(value.lstrip(), scope.lookup)
+
+def read_build_statement(text: str, bindings: "list[tuple[str, str]]", scope: NinjaScope, graph: BuildGraph):
+    edge_scope = NinjaScope(scope)
+    for (name, value) in bindings:
+        edge_scope.variables[name] = expand(value, scope.lookup)
+
+    tokens = split_build_line(text)
+    if ":" not in tokens:
+        raise BuildStatsException(f"Invalid build statement: build {text}")
+    colon = tokens.index(":")
+    outputs = [canonicalize(expand(token, edge_scope.lookup)) for token in tokens[:colon] if token != "|"]
+    rule = tokens[colon + 1]
+    inputs = [canonicalize(expand(token, edge_scope.lookup)) for token in tokens[colon + 2:]
+              if token not in ("|", "||", "|@")]
+
+    edge = Edge(rule, outputs, inputs)
+    graph.edges.append(edge)
+    for output in outputs:
+        graph.edge_by_output[output] = edge
+
+# Groups the log entries of a build into steps (one per edge, which may have many outputs)
+def get_steps(entries: "list[LogEntry]", graph: BuildGraph) -> "list[Step]":
+    steps: "list[Step]" = []
+    step_by_key: "dict[object, Step]" = {}
+    for entry in entries:
+        edge = graph.get_producer(canonicalize(entry.output))
+        # Outputs no longer in the build graph are grouped by their timing instead
+        key = id(edge) if edge != None else (entry.start_ms, entry.end_ms, entry.command_hash)
+        step = step_by_key.get(key)
+        if step == None:
+            step = Step(edge.rule if edge != None else "(unknown)", [], entry.start_ms, entry.end_ms, edge)
+            step_by_key[key] = step
+            steps.append(step)
+        step.outputs.append(entry.output)
+    return steps
+
+# Follows the steps that each finished last among the inputs of the one after them
+def get_critical_path(steps: "list[Step]", graph: BuildGraph) -> "list[Step]":
+    if len(steps) == 0:
+        return []
+    step_by_edge = { id(step.edge): step for step in steps if step.edge != None }
+
+    def get_input_steps(edge: Edge, visited: "set[int]") -> "list[Step]":
+        found: "list[Step]" = []
+        for path in edge.inputs:
+            producer = graph.get_producer(path)
+            if producer == None or id(producer) in visited:
+                continue
+            visited.add(id(producer))
+            step = step_by_edge.get(id(producer))
+            if step != None:
+                found.append(step)
+            elif producer.rule == "phony":
+                found.extend(get_input_steps(producer, visited))
+        return found
+
+    path = [max(steps, key=lambda step: step.end_ms)]
+    while path[-1].edge != None:
+        inputs = get_input_steps(path[-1].edge, set())
+        if len(inputs) == 0:
+            break
+        path.append(max(inputs, key=lambda step: step.end_ms))
+    path.reverse()
+    return path
+
+def make_record(steps: "list[Step]", critical_path: "list[Step]", label: str) -> dict:
+    rules: "dict[str, dict]" = {}
+    for step in steps:
+        rule = rules.setdefault(step.rule, { "steps": 0, "time": 0.0, "max": 0.0 })
+        rule["steps"] += 1
+        rule["time"] += step.duration()
+        rule["max"] = max(rule["max"], step.duration())
+    for rule in rules.values():
+        rule["time"] = round(rule["time"], 3)
+
+    # Identifies the build, so that reporting on the same build again doesn't add it twice
+    build_id = hashlib.sha1(json.dumps(
+        [(step.outputs[0], step.start_ms, step.end_ms) for step in steps]).encode()).hexdigest()
+
+    wall_ms = max(step.end_ms for step in steps) - min(step.start_ms for step in steps) if len(steps) > 0 else 0
+    return {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "build": build_id,
+        "label": label,
+        "steps": len(steps),
+        "wall_time": wall_ms / 1000,
+        "critical_path_time": round(sum(step.duration() for step in critical_path), 3),
+        "rules": dict(sorted(rules.items(), key=lambda item: -item[1]["time"])),
+    }
+
+def load_history(path: Path) -> "list[dict]":
+    records: "list[dict]" = []
+    try:
+        with open(path, "r", encoding="utf-8") as history_file:
+            for line in history_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+def append_history(path: Path, record: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as history_file:
+        history_file.write(json.dumps(record) + "\n")
+
+# Compares a build against the median of the given previous builds, returning descriptions
+# of the times that got worse by more than the threshold (and the minimum delta in seconds)
+def find_regressions(record: dict, baseline: "list[dict]", threshold: float, min_delta: float) -> "list[str]":
+    if len(baseline) == 0:
+        return []
+
+    def check(name: str, value: float, previous: "list[float]"):
+        median = statistics.median(previous)
+        if value - median >= min_delta and value > median * (1 + threshold):
+            increase = f"+{(value / median - 1) * 100:.0f}%" if median > 0 else "new"
+            regressions.append(f"{name}: {value:.2f}s vs {median:.2f}s baseline ({increase})")
+
+    regressions: "list[str]" = []
+    check("wall time", record["wall_time"], [r["wall_time"] for r in baseline])
+    check("critical path", record["critical_path_time"], [r["critical_path_time"] for r in baseline])
+    for (rule, stats) in record["rules"].items():
+        check(f"rule {rule}", stats["time"], [r["rules"].get(rule, { "time": 0.0 })["time"] for r in baseline])
+    return regressions
+
+def print_report(record: dict, critical_path: "list[Step]"):
+    print(f"Last build: {record['steps']} steps, {record['wall_time']:.2f}s wall time, "
+          f"{sum(rule['time'] for rule in record['rules'].values()):.2f}s total step time")
+    print()
+    print(f"  {'rule':<24} {'steps':>6} {'total':>9} {'max':>8}")
+    for (name, rule) in record["rules"].items():
+        print(f"  {name:<24} {rule['steps']:>6} {rule['time']:>8.2f}s {rule['max']:>7.2f}s")
+    print()
+    print(f"Critical path ({len(critical_path)} steps, {record['critical_path_time']:.2f}s):")
+    shown = critical_path[-CRITICAL_PATH_LIMIT:]
+    if len(shown) < len(critical_path):
+        print(f"  ... {len(critical_path) - len(shown)} more steps")
+    for step in shown:
+        print(f"  {step.duration():>7.2f}s  {step.rule:<20} {step.outputs[0]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports the time per rule and the critical path of the last ninja build, and tracks it over time.")
+    parser.add_argument("-C", dest="dir", type=str, default=None,
+                        help="Directory to run from, like ninja -C (the other paths are relative to it).")
+    parser.add_argument("-f", "--ninja-file", dest="ninja_file", type=str, default="build.ninja", help="The ninja build file.")
+    parser.add_argument("--log", type=str, default=".ninja_log", help="The ninja log.")
+    parser.add_argument("--history", type=str, default=DEFAULT_HISTORY, help=f"JSON lines file to append the report to. Default: {DEFAULT_HISTORY}")
+    parser.add_argument("--no-history", dest="no_history", action="store_true", default=False,
+                        help="Don't read or write the history file (the last build is then found in the whole log).")
+    parser.add_argument("--label", type=str, default="",
+                        help="Kind of build (e.g. 'full' or 'dll-edit'), builds are only compared with builds of the same label.")
+    parser.add_argument("--baseline", type=int, default=DEFAULT_BASELINE_SIZE,
+                        help=f"Number of previous builds the baseline is the median of. Default: {DEFAULT_BASELINE_SIZE}")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Fraction a time may grow by over the baseline before it's a regression. Default: {DEFAULT_THRESHOLD}")
+    parser.add_argument("--min-delta", dest="min_delta", type=float, default=DEFAULT_MIN_DELTA,
+                        help=f"Seconds a time must grow by to be a regression (ignores noise in short steps). Default: {DEFAULT_MIN_DELTA}")
+    parser.add_argument("--fail-on-regression", dest="fail_on_regression", action="store_true", default=False,
+                        help="Exit with an error if a regression was found (for CI).")
+    args = parser.parse_args()
+
+    # Paths in ninja files are relative to the directory ninja runs in
+    if args.dir != None:
+        os.chdir(args.dir)
+
+    log_path = Path(args.log)
+    history_path = Path(args.history)
+    history = load_history(history_path) if not args.no_history else []
+    # The range of the log the previous report on it covered
+    log_key = log_path.resolve().as_posix()
+    previous_log = next((r["log"] for r in reversed(history) if r.get("log", {}).get("path") == log_key), None)
+
+    try:
+        data = read_log(log_path)
+        graph = read_build_graph(Path(args.ninja_file))
+    except BuildStatsException as ex:
+        print(f"ERROR: {ex}")
+        exit(1)
+
+    log_range = get_log_range(data, previous_log)
+    if log_range == None:
+        print(f"WARNING: {log_path} was rewritten since the last report (ninja recompacts it now and then), "
+              "so the steps of the last build can't be told apart. Not reporting on it.")
+        # Start over from the end of the rewritten log
+        end = data.rfind(b"\n") + 1
+        append_history(history_path, { "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                                       "label": args.label, "log": make_log_record(log_key, data, end, end) })
+        return
+    (start, end) = log_range
+
+    steps = get_steps(read_last_build(data, start, end), graph)
+    if len(steps) == 0:
+        print(f"No build steps in {log_path} since the last report.")
+        return
+    critical_path = get_critical_path(steps, graph)
+    record = make_record(steps, critical_path, args.label)
+    record["log"] = make_log_record(log_key, data, start, end)
+    print_report(record, critical_path)
+
+    if args.no_history:
+        return
+
+    # Records without rules are where the log was rewritten
+    previous = [r for r in history if r.get("label") == args.label and "rules" in r and r.get("build") != record["build"]]
+    regressions = find_regressions(record, previous[-args.baseline:], args.threshold, args.min_delta)
+
+    if not any(r.get("build") == record["build"] for r in history):
+        append_history(history_path, record)
+
+    if len(regressions) > 0:
+        print()
+        print(f"Regressions against the last {min(len(previous), args.baseline)} builds:")
+        for regression in regressions:
+            print(f"  {regression}")
+        if args.fail_on_regression:
+            exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+# Resident worker process that runs the build's Python tools, so that build steps don't
+# each pay for interpreter startup and importing pyelftools
+#
+# `serve` listens on a unix socket with every tool already imported and the base ELF's
+# symbol index loaded. `run` is the thin client used by ninja rules: it sends the tool's
+# arguments, working directory, environment and stdio file descriptors to the worker,
+# which forks a child to run the tool's main(), and exits with the tool's exit code.
+#
+# The client starts the worker when it isn't running. The worker exits by itself once
+# it has been idle for a while, or as soon as a request comes in after the tools' source
+# files have changed (the client then starts a fresh one). If no worker can be started,
+# the client runs the tool itself.
+#
+# The client only imports the standard library so that it starts quickly.
+
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+# Tools the worker can run (each has a main() that parses sys.argv)
+WORKER_TOOLS = [
+    "tools.dll_packer",
+    "tools.elf_patcher",
+    "tools.fs_packer",
+    "tools.make_baserom_obj",
+    "tools.make_dllsimporttab",
+    "tools.make_prelude",
+    "tools.make_z64",
+    "tools.n64cksum",
+    "tools.patch_dll",
+    "tools.symbol_index",
+]
+
+PROTOCOL_VERSION = 1
+# Followed by a JSON payload of that size
+REQUEST_HEADER = struct.Struct(">I")
+# (response kind, exit code)
+RESPONSE = struct.Struct(">Bi")
+RESPONSE_EXITED = 0
+# The worker is shutting down without running the tool, the client should start a new one
+RESPONSE_RETRY = 1
+
+DEFAULT_IDLE_TIMEOUT = 600
+# How long the client waits for a worker it started to accept connections (in seconds)
+START_TIMEOUT = 10.0
+START_POLL_INTERVAL = 0.02
+# How often the worker checks its idle time and socket while nothing is happening
+IDLE_POLL_INTERVAL = 1.0
+REQUEST_TIMEOUT = 5.0
+MAX_MESSAGE_SIZE = 64 * 1024
+
+class WorkerException(Exception):
+    pass
+
+def get_exit_code(ex: SystemExit) -> int:
+    if ex.code == None:
+        return 0
+    if isinstance(ex.code, int):
+        return ex.code
+    # Same as the interpreter, exit("message") prints the message and exits with 1
+    print(ex.code, file=sys.stderr)
+    return 1
+
+def recv_until(conn: socket.socket, buffer: bytearray, size: int):
+    while len(buffer) < size:
+        chunk = conn.recv(MAX_MESSAGE_SIZE)
+        if not chunk:
+            raise WorkerException("Connection closed before the message was complete.")
+        buffer.extend(chunk)
+
+# Runs a tool in this process
+def run_local(module: str, tool_args: "list[str]"):
+    import importlib
+    sys.argv = [module] + tool_args
+    importlib.import_module(module).main()
+
+class WorkerArgs:
+    def __init__(self, socket_path: str, idle_timeout: int, preload_elfs: "list[str]", symbol_cache: "str | None"):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        # ELFs whose symbol index is kept loaded (e.g. the decomp's dino.elf)
+        self.preload_elfs = preload_elfs
+        self.symbol_cache = symbol_cache
+
+    def to_argv(self) -> "list[str]":
+        argv = ["--socket", self.socket_path, "--idle-timeout", str(self.idle_timeout)]
+        for elf in self.preload_elfs:
+            argv.extend(["--preload-elf", elf])
+        if self.symbol_cache != None:
+            argv.extend(["--symbol-cache", self.symbol_cache])
+        return argv
+
+class WorkerClient:
+    def __init__(self, args: WorkerArgs):
+        self.args = args
+
+    # Runs a tool in the worker, returning its exit code, or None if no worker is available
+    def run(self, module: str, tool_args: "list[str]") -> "int | None":
+        request = {
+            "version": PROTOCOL_VERSION,
+            "module": module,
+            "argv": tool_args,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }
+
+        # The worker asks for a retry when it shuts down instead of serving a request
+        for _ in range(3):
+            sock = self.__connect_or_start()
+            if sock == None:
+                return None
+            with sock:
+                try:
+                    self.__send(sock, request, [0, 1, 2])
+                except (BrokenPipeError, ConnectionResetError):
+                    # The worker went away before reading the request
+                    continue
+                (kind, code) = self.__receive_response(sock)
+            if kind == RESPONSE_EXITED:
+                return code
+
+        return None
+
+    def stop(self) -> bool:
+        sock = self.__connect()
+        if sock == None:
+            return False
+        with sock:
+            self.__send(sock, { "version": PROTOCOL_VERSION, "command": "stop" }, [])
+            self.__receive_response(sock)
+        return True
+
+    def __connect(self) -> "socket.socket | None":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.args.socket_path)
+        except OSError:
+            # Usually there is no socket or nothing is listening on it
+            sock.close()
+            return None
+        return sock
+
+    def __connect_or_start(self) -> "socket.socket | None":
+        sock = self.__connect()
+        if sock != None:
+            return sock
+
+        process = self.__start_worker()
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(START_POLL_INTERVAL)
+            sock = self.__connect()
+            if sock != None:
+                return sock
+            # The worker exits cleanly if another one got started first, keep waiting for that one
+            code = process.poll()
+            if code != None and code != 0:
+                break
+
+        return None
+
+    def __start_worker(self) -> "subprocess.Popen":
+        import subprocess
+
+        # The worker gets its own session and log file so that it doesn't hold on to
+        # ninja's output pipe or receive its signals
+        socket_path = self.args.socket_path
+        os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+        with open(f"{socket_path}.log", "ab") as log:
+            return subprocess.Popen([sys.executable, "-m", "tools.build_worker", "serve"] + self.args.to_argv(),
+                             stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                             start_new_session=True)
+
+    def __send(self, sock: socket.socket, request: dict, fds: "list[int]"):
+        payload = json.dumps(request).encode()
+        data = REQUEST_HEADER.pack(len(payload)) + payload
+        sent = socket.send_fds(sock, [data[:MAX_MESSAGE_SIZE]], fds)
+        # Even an empty send fails if the worker already replied and closed (e.g. to stop)
+        if sent < len(data):
+            sock.sendall(data[sent:])
+
+    def __receive_response(self, sock: socket.socket) -> "tuple[int, int]":
+        buffer = bytearray()
+        try:
+            recv_until(sock, buffer, RESPONSE.size)
+        except WorkerException:
+            raise WorkerException("The build worker exited without finishing the tool (see the worker log).")
+        return RESPONSE.unpack_from(buffer)
+
+class Worker:
+    def __init__(self, args: WorkerArgs):
+        self.args = args
+        self.children: "set[int]" = set()
+        self.lock_fd: "int | None" = None
+        self.listener: "socket.socket | None" = None
+        self.socket_id: "tuple[int, int] | None" = None
+        self.source_mtimes: "dict[str, int]" = {}
+
+    def serve(self):
+        socket_path = self.args.socket_path
+
+        # Only one worker may own the socket path
+        import fcntl
+        self.lock_fd = os.open(f"{socket_path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Another worker is already running.")
+            return
+
+        self.__preload()
+
+        # Any existing socket was left behind by a worker that didn't exit cleanly
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(socket_path)
+        self.listener.listen(64)
+        self.listener.settimeout(IDLE_POLL_INTERVAL)
+        stat = os.stat(socket_path)
+        self.socket_id = (stat.st_dev, stat.st_ino)
+
+        print(f"Worker {os.getpid()} listening on {socket_path}")
+        sys.stdout.flush()
+
+        last_active = time.monotonic()
+        while True:
+            self.__reap_children()
+            if len(self.children) > 0:
+                last_active = time.monotonic()
+
+            try:
+                (conn, _) = self.listener.accept()
+            except socket.timeout:
+                if not self.__owns_socket():
+                    print("Socket was removed, exiting.")
+                    break
+                if time.monotonic() - last_active >= self.args.idle_timeout:
+                    print("Idle, exiting.")
+                    break
+                continue
+
+            last_active = time.monotonic()
+            if not self.__handle(conn):
+                break
+
+        self.__shutdown()
+
+    def __preload(self):
+        import importlib
+        for module in WORKER_TOOLS:
+            importlib.import_module(module)
+        self.__load_elfs()
+
+        # Remember the source files the worker's code came from, to notice when it's stale
+        paths = [os.path.abspath(__file__)]
+        for (name, module) in list(sys.modules.items()):
+            if name.startswith("tools.") and getattr(module, "__file__", None) != None:
+                paths.append(os.path.abspath(module.__file__))
+        self.source_mtimes = { path: os.stat(path).st_mtime_ns for path in paths }
+
+    def __load_elfs(self):
+        from pathlib import Path
+        from tools.symbol_index import load_symbol_index
+
+        # Forked children inherit the loaded indexes. Tools report any errors themselves.
+        symbol_cache = Path(self.args.symbol_cache) if self.args.symbol_cache != None else None
+        for elf in self.args.preload_elfs:
+            try:
+                load_symbol_index(Path(elf), symbol_cache)
+            except Exception as ex:
+                print(f"WARNING: Couldn't load the symbol index of {elf}: {ex}")
+
+    def __is_stale(self) -> bool:
+        for (path, mtime_ns) in self.source_mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def __owns_socket(self) -> bool:
+        try:
+            stat = os.stat(self.args.socket_path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_dev, stat.st_ino) == self.socket_id
+
+    def __reap_children(self):
+        while len(self.children) > 0:
+            try:
+                (pid, _) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                break
+            if pid == 0:
+                break
+            self.children.discard(pid)
+
+    # Serves one connection. Returns False if the worker should shut down.
+    def __handle(self, conn: socket.socket) -> bool:
+        fds: "list[int]" = []
+        try:
+            conn.settimeout(REQUEST_TIMEOUT)
+            (request, fds) = self.__receive_request(conn)
+
+            if request.get("command") == "stop":
+                print("Stop requested, exiting.")
+                self.__release_socket()
+                conn.sendall(RESPONSE.pack(RESPONSE_EXITED, 0))
+                return False
+
+            if request.get("version") != PROTOCOL_VERSION or self.__is_stale():
+                print("Tool sources changed, exiting.")
+                self.__release_socket()
+                conn.sendall(RESPONSE.pack(RESPONSE_RETRY, 0))
+                return False
+
+            module = request.get("module")
+            if not module in WORKER_TOOLS or len(fds) != 3:
+                raise WorkerException(f"Invalid request for {module}")
+
+            # Pick up changes to the preloaded ELFs before forking, so that children
+            # after this one inherit the result
+            self.__load_elfs()
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                self.__run_child(conn, request, fds)
+            self.children.add(pid)
+        except (OSError, ValueError, WorkerException) as ex:
+            print(f"ERROR: Bad request: {ex}")
+            try:
+                conn.sendall(RESPONSE.pack(RESPONSE_EXITED, 1))
+            except OSError:
+                pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+
+        return True
+
+    def __receive_request(self, conn: socket.socket) -> "tuple[dict, list[int]]":
+        (data, fds, _, _) = socket.recv_fds(conn, MAX_MESSAGE_SIZE, 3)
+        try:
+            buffer = bytearray(data)
+            recv_until(conn, buffer, REQUEST_HEADER.size)
+            (size,) = REQUEST_HEADER.unpack_from(buffer)
+            recv_until(conn, buffer, REQUEST_HEADER.size + size)
+            request = json.loads(buffer[REQUEST_HEADER.size:REQUEST_HEADER.size + size])
+            if not isinstance(request, dict):
+                raise WorkerException("Request is not an object.")
+        except BaseException:
+            for fd in fds:
+                os.close(fd)
+            raise
+        return (request, fds)
+
+    # Runs the requested tool in a forked child. Never returns.
+    def __run_child(self, conn: socket.socket, request: dict, fds: "list[int]"):
+        code = 1
+        try:
+            # The lock is shared with every process that has it open, so the child must not
+            # keep it from being released
+            if self.lock_fd != None:
+                os.close(self.lock_fd)
+            assert self.listener != None
+            self.listener.close()
+            for (target, fd) in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+
+            try:
+                run_local(request["module"], request["argv"])
+                code = 0
+            except SystemExit as ex:
+                code = get_exit_code(ex)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.sendall(RESPONSE.pack(RESPONSE_EXITED, code))
+            finally:
+                os._exit(0)
+
+    # Stops new clients from connecting to this worker and lets another one take its place
+    def __release_socket(self):
+        if self.__owns_socket():
+            os.unlink(self.args.socket_path)
+        if self.lock_fd != None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def __shutdown(self):
+        self.__release_socket()
+
+        # Clients that connected before the socket was removed are told to retry
+        assert self.listener != None
+        self.listener.setblocking(False)
+        while True:
+            try:
+                (conn, _) = self.listener.accept()
+            except BlockingIOError:
+                break
+            with conn:
+                try:
+                    conn.settimeout(REQUEST_TIMEOUT)
+                    (_, fds) = self.__receive_request(conn)
+                    for fd in fds:
+                        os.close(fd)
+                    conn.sendall(RESPONSE.pack(RESPONSE_RETRY, 0))
+                except (OSError, ValueError, WorkerException):
+                    pass
+        self.listener.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs build tools in a resident worker process.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_worker_args(subparser: argparse.ArgumentParser):
+        subparser.add_argument("--socket", type=str, help="Path of the worker's unix socket.", required=True)
+        subparser.add_argument("--idle-timeout", dest="idle_timeout", type=int, default=DEFAULT_IDLE_TIMEOUT,
+                               help=f"Seconds without requests after which the worker exits. Default: {DEFAULT_IDLE_TIMEOUT}")
+        subparser.add_argument("--preload-elf", dest="preload_elfs", type=str, action="append", default=[],
+                               help="Keep the symbol index of this ELF loaded (can be given multiple times).")
+        subparser.add_argument("--symbol-cache", dest="symbol_cache", type=str, help="Directory of cached symbol indexes.")
+
+    run_parser = subparsers.add_parser("run", help="Run a tool in the worker, starting the worker if needed.")
+    add_worker_args(run_parser)
+    run_parser.add_argument("tool", type=str, choices=WORKER_TOOLS, help="Module of the tool to run.")
+    run_parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments for the tool.")
+
+    serve_parser = subparsers.add_parser("serve", help="Run the worker.")
+    add_worker_args(serve_parser)
+
+    stop_parser = subparsers.add_parser("stop", help="Stop a running worker.")
+    stop_parser.add_argument("--socket", type=str, help="Path of the worker's unix socket.", required=True)
+
+    args = parser.parse_args()
+
+    if args.command == "stop":
+        if not WorkerClient(WorkerArgs(args.socket, DEFAULT_IDLE_TIMEOUT, [], None)).stop():
+            print("No worker is running.")
+        return
+
+    worker_args = WorkerArgs(args.socket, args.idle_timeout, args.preload_elfs, args.symbol_cache)
+    if args.command == "serve":
+        Worker(worker_args).serve()
+        return
+
+    code = None
+    if hasattr(socket, "AF_UNIX") and hasattr(socket, "send_fds"):
+        try:
+            code = WorkerClient(worker_args).run(args.tool, args.args)
+        except WorkerException as ex:
+            print(f"ERROR: {ex}")
+            exit(1)
+    if code == None:
+        # No worker, run the tool in this process instead
+        run_local(args.tool, args.args)
+        return
+
+    exit(code)
+
+if __name__ == "__main__":
+    main()
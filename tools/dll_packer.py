@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# Packs/unpacks DLLS.bin and DLLS_tab.bin
+#
+# DLLS_tab.bin layout:
+#   0x00: 4 header words (copied as-is from the original table)
+#   0x10: (u32 offset, u32 bss size) per DLL, followed by one more entry whose offset
+#         is the end of the last DLL, followed by a 0xFFFFFFFF terminated trailer
+# The size of a DLL is the offset of the next entry minus its own offset.
+
+import argparse
+import json
+import os
+from pathlib import Path
+import struct
+
+from tools.fileutil import COPY_CHUNK_SIZE, align, copy_file_into, load_manifest, open_if_changed, save_manifest, scan_manifest_entries, write_if_changed
+from tools.profiling import profiled
+
+DLL_ALIGNMENT = 16
+TAB_HEADER_SIZE = 0x10
+TAB_ENTRY = struct.Struct(">II")
+
+class DLLPackerException(Exception):
+    pass
+
+class DLLTab:
+    def __init__(self, header: bytes, entries: "list[tuple[int, int]]", trailer: bytes):
+        self.header = header
+        # (offset, bss size), including the end entry
+        self.entries = entries
+        self.trailer = trailer
+
+    @staticmethod
+    def parse(data: bytes) -> "DLLTab":
+        header = data[:TAB_HEADER_SIZE]
+        entries: "list[tuple[int, int]]" = []
+        offset = TAB_HEADER_SIZE
+        while offset + TAB_ENTRY.size <= len(data):
+            entry = TAB_ENTRY.unpack_from(data, offset)
+            if entry[0] == 0xFFFFFFFF:
+                break
+            entries.append(entry)
+            offset += TAB_ENTRY.size
+        if len(entries) == 0:
+            raise DLLPackerException("DLL table has no entries.")
+        return DLLTab(header, entries, data[offset:])
+
+    def get_dll_count(self) -> int:
+        return len(self.entries) - 1
+
+    def to_bytes(self) -> bytes:
+        data = bytearray(self.header)
+        for entry in self.entries:
+            data.extend(TAB_ENTRY.pack(*entry))
+        data.extend(self.trailer)
+        return bytes(data)
+
+class DLLSource:
+    def __init__(self, path: Path, bss_path: "Path | None"):
+        self.path = path
+        # Text file containing the BSS size of the DLL, if it differs from the original table
+        self.bss_path = bss_path
+
+# Reads the list of DLLs to pack, written by configure.py. Entry i is DLL number i + 1.
+def load_dll_sources(sources_path: Path) -> "tuple[Path, list[DLLSource]]":
+    with open(sources_path, "r", encoding="utf-8") as sources_file:
+        sources = json.load(sources_file)
+    dlls = [DLLSource(Path(dll["path"]), Path(dll["bss"]) if dll.get("bss") != None else None)
+            for dll in sources["dlls"]]
+    return Path(sources["tab"]), dlls
+
+def read_bss_size(path: Path) -> int:
+    with open(path, "r", encoding="utf-8") as bss_file:
+        return int(bss_file.read().strip(), base=0)
+
+def get_dll_offsets(entries: "list[dict]") -> "list[int]":
+    # Offset of each DLL, plus the end offset
+    offsets: "list[int]" = []
+    offset = 0
+    for entry in entries:
+        offsets.append(offset)
+        offset += align(entry["size"], DLL_ALIGNMENT)
+    offsets.append(offset)
+    return offsets
+
+def write_dll(path: Path, size: int, output):
+    with open(path, "rb") as file:
+        copied = copy_file_into(file, output)
+    if copied != size:
+        raise DLLPackerException(f"DLL changed size while packing: {path}")
+    output.write(bytearray(align(size, DLL_ALIGNMENT) - size))
+
+# Moves length bytes within a file, handling overlapping ranges
+def move_range(file, src: int, dst: int, length: int):
+    if src == dst or length == 0:
+        return
+    buffer = bytearray(min(COPY_CHUNK_SIZE, length))
+    view = memoryview(buffer)
+    moved = 0
+    while moved < length:
+        n = min(len(buffer), length - moved)
+        # Copy front to back when moving down and back to front when moving up
+        pos = moved if dst < src else length - moved - n
+        file.seek(src + pos, os.SEEK_SET)
+        file.readinto(view[:n])
+        file.seek(dst + pos, os.SEEK_SET)
+        file.write(view[:n])
+        moved += n
+
+def pack_dlls(dlls: "list[DLLSource]", entries: "list[dict]", dlls_bin_path: Path):
+    with open_if_changed(dlls_bin_path) as output:
+        for dll, entry in zip(dlls, entries):
+            write_dll(dll.path, entry["size"], output)
+
+# Updates an existing DLLS.bin, only writing the DLLs that changed since the last pack.
+# DLLs after a DLL that changed size are moved within the file rather than rewritten from
+# their sources.
+def update_dlls(dlls: "list[DLLSource]", previous: "list[dict]", entries: "list[dict]", dlls_bin_path: Path):
+    changed = [i for i, entry in enumerate(entries)
+               if entry["hash"] != previous[i]["hash"] or entry["size"] != previous[i]["size"]]
+    if len(changed) == 0:
+        return
+
+    old_offsets = get_dll_offsets(previous)
+    new_offsets = get_dll_offsets(entries)
+    changed_set = set(changed)
+
+    with open(dlls_bin_path, "r+b") as output:
+        # Find runs of unchanged DLLs that need to move
+        runs: "list[tuple[int, int, int]]" = []
+        i = changed[0]
+        while i < len(entries):
+            if i in changed_set or old_offsets[i] == new_offsets[i]:
+                i += 1
+                continue
+            start = i
+            while i < len(entries) and not i in changed_set:
+                i += 1
+            runs.append((old_offsets[start], new_offsets[start], old_offsets[i] - old_offsets[start]))
+
+        # Runs moving down are done first to last and runs moving up last to first so that
+        # nothing is overwritten before it's moved
+        for (src, dst, length) in runs:
+            if dst < src:
+                move_range(output, src, dst, length)
+        for (src, dst, length) in reversed(runs):
+            if dst > src:
+                move_range(output, src, dst, length)
+
+        # Write changed DLLs in their new slots
+        for i in changed:
+            output.seek(new_offsets[i], os.SEEK_SET)
+            write_dll(dlls[i].path, entries[i]["size"], output)
+
+        output.truncate(new_offsets[-1])
+
+def make_tab(template: DLLTab, dlls: "list[DLLSource]", entries: "list[dict]") -> DLLTab:
+    offsets = get_dll_offsets(entries)
+    tab_entries: "list[tuple[int, int]]" = []
+    for i, dll in enumerate(dlls):
+        if dll.bss_path != None:
+            bss_size = read_bss_size(dll.bss_path)
+        else:
+            bss_size = template.entries[i][1]
+        tab_entries.append((offsets[i], bss_size))
+    # End entry
+    tab_entries.append((offsets[-1], template.entries[-1][1]))
+    return DLLTab(template.header, tab_entries, template.trailer)
+
+def pack(sources_path: Path, dlls_bin_path: Path, tab_out_path: Path, incremental: bool):
+    tab_path, dlls = load_dll_sources(sources_path)
+    with open(tab_path, "rb") as tab_file:
+        template = DLLTab.parse(tab_file.read())
+    if template.get_dll_count() != len(dlls):
+        raise DLLPackerException(
+            f"DLL table {tab_path} has {template.get_dll_count()} DLLs but {len(dlls)} were given to pack.")
+
+    dll_ids = [dll.path.as_posix() for dll in dlls]
+    previous = load_manifest(dlls_bin_path, "path", dll_ids) if incremental else None
+    entries = scan_manifest_entries("path", [(id, dll.path) for id, dll in zip(dll_ids, dlls)], previous)
+
+    if previous == None:
+        pack_dlls(dlls, entries, dlls_bin_path)
+    else:
+        update_dlls(dlls, previous, entries, dlls_bin_path)
+
+    write_if_changed(tab_out_path, make_tab(template, dlls, entries).to_bytes())
+
+    if incremental:
+        save_manifest(dlls_bin_path, entries)
+
+def unpack(dlls_bin_path: Path, tab_path: Path, output_dir: Path):
+    with open(tab_path, "rb") as tab_file:
+        tab = DLLTab.parse(tab_file.read())
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(dlls_bin_path, "rb") as dlls_bin:
+        for i in range(tab.get_dll_count()):
+            start = tab.entries[i][0]
+            end = tab.entries[i + 1][0]
+            dlls_bin.seek(start, os.SEEK_SET)
+            with open(output_dir.joinpath(f"{i + 1}.dll"), "wb") as dll_file:
+                dll_file.write(dlls_bin.read(end - start))
+
+@profiled
+def main():
+    parser = argparse.ArgumentParser(description="Packs and unpacks Dinosaur Planet DLLS.bin/DLLS_tab.bin files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pack_parser = subparsers.add_parser("pack", help="Pack DLLs into DLLS.bin and DLLS_tab.bin.")
+    pack_parser.add_argument("sources", type=str, help="JSON file listing the original DLLS_tab.bin and the DLLs to pack.")
+    pack_parser.add_argument("-o", "--output", type=str, help="The path of the DLLS.bin file to output.", required=True)
+    pack_parser.add_argument("--tab-out", dest="tab_out", type=str, help="The path of the DLLS_tab.bin file to output.", required=True)
+    pack_parser.add_argument("--incremental", action="store_true", default=False,
+                             help="Only rewrite the DLLs that changed since the last pack (tracked in a <output>.manifest.json sidecar).")
+
+    unpack_parser = subparsers.add_parser("unpack", help="Extract each DLL from DLLS.bin.")
+    unpack_parser.add_argument("dlls_bin", type=str, help="The DLLS.bin file.")
+    unpack_parser.add_argument("tab", type=str, help="The DLLS_tab.bin file.")
+    unpack_parser.add_argument("-o", "--output", type=str, help="The directory to extract DLLs to.", required=True)
+
+    args = parser.parse_args()
+
+    error = False
+    try:
+        if args.command == "pack":
+            pack(Path(args.sources), Path(args.output), Path(args.tab_out), args.incremental)
+        else:
+            unpack(Path(args.dlls_bin), Path(args.tab), Path(args.output))
+    except DLLPackerException as ex:
+        print(f"ERROR: {ex}")
+        error = True
+
+    if error:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
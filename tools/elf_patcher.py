@@ -2,18 +2,200 @@
 
 import argparse
 import bisect
+from concurrent.futures import ProcessPoolExecutor
 import math
 import re
-from typing import Protocol
+import shlex
+import struct
+from typing import BinaryIO, Protocol
+from elftools.common.exceptions import ELFError
+from elftools.construct.lib.container import Container
+from elftools.elf import enums
 from elftools.elf.elffile import ELFFile
 from elftools.elf.relocation import RelocationSection, Relocation
 from elftools.elf.sections import Section, SymbolTableSection, Symbol
 from io import BufferedReader, BufferedWriter, BytesIO
 import os
 
+from tools.fileutil import open_if_changed, write_if_changed
+from tools.profiling import phase, profiled
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
 class PatcherException(Exception):
     pass
 
+def make_enum_encoding(enum: dict) -> dict:
+    return { name: value for (name, value) in enum.items() if name != "_default_" }
+
+def make_enum_decoding(enum: dict) -> dict:
+    # Same as construct, if multiple names have the same value the last one wins
+    return { value: name for (name, value) in make_enum_encoding(enum).items() }
+
+class TableCodec:
+    # Encodes/decodes whole symbol tables, relocation tables and section headers with
+    # precompiled structs instead of pyelftools' per-entry construct structs. Entries are
+    # the same containers pyelftools produces. ELF64 always uses construct.
+    #
+    # In verify mode, every table is also decoded/encoded with construct and compared.
+    def __init__(self, elf: ELFFile, verify: bool):
+        self.elf = elf
+        self.verify = verify
+        self.fast = elf.elfclass == 32
+
+        endian = "<" if elf.little_endian else ">"
+        self.rel_struct = struct.Struct(endian + "II")
+        self.rela_struct = struct.Struct(endian + "IIi")
+        self.sym_struct = struct.Struct(endian + "IIIBBH")
+        self.shdr_struct = struct.Struct(endian + "10I")
+
+        self.bind_encoding = make_enum_encoding(enums.ENUM_ST_INFO_BIND)
+        self.bind_decoding = make_enum_decoding(enums.ENUM_ST_INFO_BIND)
+        self.type_encoding = make_enum_encoding(enums.ENUM_ST_INFO_TYPE)
+        self.type_decoding = make_enum_decoding(enums.ENUM_ST_INFO_TYPE)
+        self.local_encoding = make_enum_encoding(enums.ENUM_ST_LOCAL)
+        self.local_decoding = make_enum_decoding(enums.ENUM_ST_LOCAL)
+        self.visibility_encoding = make_enum_encoding(enums.ENUM_ST_VISIBILITY)
+        self.visibility_decoding = make_enum_decoding(enums.ENUM_ST_VISIBILITY)
+        self.shndx_encoding = make_enum_encoding(enums.ENUM_ST_SHNDX)
+        self.shndx_decoding = make_enum_decoding(enums.ENUM_ST_SHNDX)
+        # sh_type values depend on the machine, so take them from pyelftools' struct
+        sh_type_enum = next(s for s in elf.structs.Elf_Shdr.subcons if s.name == "sh_type")
+        self.sh_type_encoding: dict = sh_type_enum.encoding
+
+    def decode_relocations(self, section: RelocationSection) -> list[Relocation]:
+        if not self.fast:
+            return [r for r in section.iter_relocations()]
+        
+        is_rela = section.is_RELA()
+        entry_struct = self.rela_struct if is_rela else self.rel_struct
+        data = section.data()
+        data = data[:len(data) - (len(data) % entry_struct.size)]
+
+        relocations: list[Relocation] = []
+        for fields in entry_struct.iter_unpack(data):
+            r_info = fields[1]
+            entry = Container(r_offset=fields[0], r_info=r_info,
+                              r_info_sym=(r_info >> 8) & 0xFFFFFF, r_info_type=r_info & 0xFF)
+            if is_rela:
+                entry["r_addend"] = fields[2]
+            relocations.append(Relocation(entry, self.elf))
+
+        if self.verify:
+            expected = [r.entry for r in section.iter_relocations()]
+            if [r.entry for r in relocations] != expected:
+                raise PatcherException(f"Fast decoding of relocation section '{section.name}' does not match pyelftools.")
+
+        return relocations
+
+    def encode_relocations(self, section: RelocationSection, relocations: list[Relocation]) -> bytes:
+        if not self.fast:
+            return self.__build_all(section.entry_struct, [r.entry for r in relocations])
+        
+        if section.is_RELA():
+            entry_struct = self.rela_struct
+            data = b"".join([entry_struct.pack(r.entry["r_offset"], r.entry["r_info"], r.entry["r_addend"]) 
+                             for r in relocations])
+        else:
+            entry_struct = self.rel_struct
+            data = b"".join([entry_struct.pack(r.entry["r_offset"], r.entry["r_info"]) for r in relocations])
+
+        if self.verify:
+            self.__verify_encoding(data, section.entry_struct, [r.entry for r in relocations], section.name)
+
+        return data
+
+    def decode_symbols(self, section: SymbolTableSection) -> list[Symbol]:
+        if not self.fast or section.header["sh_entsize"] != self.sym_struct.size:
+            return [s for s in section.iter_symbols()]
+        
+        data = section.data()[:section.num_symbols() * self.sym_struct.size]
+        stringtable = section.stringtable
+
+        syms: list[Symbol] = []
+        for (st_name, st_value, st_size, st_info, st_other, st_shndx) in self.sym_struct.iter_unpack(data):
+            bind = st_info >> 4
+            type = st_info & 0xF
+            local = st_other >> 5
+            visibility = st_other & 0x7
+            entry = Container(
+                st_name=st_name,
+                st_value=st_value,
+                st_size=st_size,
+                st_info=Container(bind=self.bind_decoding.get(bind, bind), type=self.type_decoding.get(type, type)),
+                st_other=Container(local=self.local_decoding.get(local, local),
+                                   visibility=self.visibility_decoding.get(visibility, visibility)),
+                st_shndx=self.shndx_decoding.get(st_shndx, st_shndx))
+            syms.append(Symbol(entry, stringtable.get_string(st_name)))
+
+        if self.verify:
+            expected = [(s.name, s.entry) for s in section.iter_symbols()]
+            if [(s.name, s.entry) for s in syms] != expected:
+                raise PatcherException(f"Fast decoding of symbol table '{section.name}' does not match pyelftools.")
+
+        return syms
+
+    def encode_symbols(self, section: SymbolTableSection, syms: list[Symbol]) -> bytes:
+        if not self.fast:
+            return self.__build_all(self.elf.structs.Elf_Sym, [s.entry for s in syms])
+        
+        pack = self.sym_struct.pack
+        chunks: list[bytes] = []
+        for sym in syms:
+            entry = sym.entry
+            st_info = entry["st_info"]
+            st_other = entry["st_other"]
+            st_shndx = entry["st_shndx"]
+            bind = self.bind_encoding.get(st_info["bind"], st_info["bind"])
+            type = self.type_encoding.get(st_info["type"], st_info["type"])
+            local = self.local_encoding.get(st_other["local"], st_other["local"])
+            visibility = self.visibility_encoding.get(st_other["visibility"], st_other["visibility"])
+            chunks.append(pack(
+                entry["st_name"], 
+                entry["st_value"], 
+                entry["st_size"],
+                ((bind & 0xF) << 4) | (type & 0xF),
+                ((local & 0x7) << 5) | (visibility & 0x7),
+                self.shndx_encoding.get(st_shndx, st_shndx)))
+        data = b"".join(chunks)
+
+        if self.verify:
+            self.__verify_encoding(data, self.elf.structs.Elf_Sym, [s.entry for s in syms], section.name)
+
+        return data
+
+    def encode_section_headers(self, headers: list[Container]) -> bytes:
+        if not self.fast:
+            return self.__build_all(self.elf.structs.Elf_Shdr, headers)
+        
+        pack = self.shdr_struct.pack
+        data = b"".join([pack(
+            h["sh_name"], 
+            self.sh_type_encoding.get(h["sh_type"], h["sh_type"]), 
+            h["sh_flags"], 
+            h["sh_addr"],
+            h["sh_offset"], 
+            h["sh_size"], 
+            h["sh_link"], 
+            h["sh_info"], 
+            h["sh_addralign"], 
+            h["sh_entsize"]) for h in headers])
+
+        if self.verify:
+            self.__verify_encoding(data, self.elf.structs.Elf_Shdr, headers, "section headers")
+
+        return data
+
+    def __build_all(self, entry_struct, entries: list) -> bytes:
+        stream = BytesIO()
+        for entry in entries:
+            entry_struct.build_stream(entry, stream)
+        return stream.getvalue()
+
+    def __verify_encoding(self, data: bytes, entry_struct, entries: list, name: str):
+        if data != self.__build_all(entry_struct, entries):
+            raise PatcherException(f"Fast encoding of {name} does not match pyelftools.")
+
 class EditedSection(Protocol):
     def __init__(self, section: Section):
         self.section = section
@@ -31,43 +213,157 @@ class EditedRawSection(EditedSection):
         writer.write(self.data.read())
         self.section.header['sh_size'] = self.data.tell()
 
-class EditedRelocationSection(EditedSection):
+class EditedPassthroughSection(EditedSection):
+    # A section that is never modified. Its contents aren't loaded, they're copied
+    # straight from the input ELF when writing.
     def __init__(self, section):
+        super().__init__(section)
+        self.offset = section.header['sh_offset']
+        self.size = section.header['sh_size']
+    
+    def write(self, writer: BufferedWriter):
+        stream = self.section.stream
+        stream.seek(self.offset, os.SEEK_SET)
+        remaining = self.size
+        while remaining > 0:
+            chunk = stream.read(min(COPY_CHUNK_SIZE, remaining))
+            if len(chunk) == 0:
+                raise PatcherException(f"Section '{self.section.name}' extends past the end of the ELF file.")
+            writer.write(chunk)
+            remaining -= len(chunk)
+
+# A replacement of all relocations with an offset within [start, end) by new relocations
+RelocationReplacement = tuple[int, int, list[Relocation]]
+
+# Applies non-overlapping replacements (sorted by start) to a relocation table in one pass.
+# Relocations outside the replaced ranges keep their order, since it isn't always by offset
+# (gas moves each R_MIPS_HI16 to just before its matching R_MIPS_LO16). The new relocations
+# of a range, in their own order, go where its first overwritten relocation was, or before
+# the first relocation past the range if it didn't overwrite any.
+def replace_relocation_ranges(relocations: list[Relocation], replacements: list[RelocationReplacement]) -> list[Relocation]:
+    starts = [start for (start, _, _) in replacements]
+    offsets = [reloc.entry["r_offset"] for reloc in relocations]
+    positions: list[int | None] = [None] * len(replacements)
+    removed = [False] * len(relocations)
+    for idx, reloc_offset in enumerate(offsets):
+        i = bisect.bisect_right(starts, reloc_offset) - 1
+        if i >= 0 and reloc_offset < replacements[i][1]:
+            removed[idx] = True
+            if positions[i] == None:
+                positions[i] = idx
+
+    # Ranges that didn't overwrite anything, by end
+    unplaced = sorted((end, i) for i, (_, end, _) in enumerate(replacements) if positions[i] == None)
+    j = 0
+    for idx, reloc_offset in enumerate(offsets):
+        while j < len(unplaced) and unplaced[j][0] <= reloc_offset:
+            positions[unplaced[j][1]] = idx
+            j += 1
+    for (_, i) in unplaced[j:]:
+        positions[i] = len(relocations)
+
+    inserts: dict[int, list[int]] = {}
+    for i, position in enumerate(positions):
+        inserts.setdefault(position, []).append(i)
+
+    result: list[Relocation] = []
+    for idx, reloc in enumerate(relocations):
+        for i in inserts.get(idx, ()):
+            result.extend(replacements[i][2])
+        if not removed[idx]:
+            result.append(reloc)
+    for i in inserts.get(len(relocations), ()):
+        result.extend(replacements[i][2])
+    return result
+
+class EditedRelocationSection(EditedSection):
+    def __init__(self, section, codec: TableCodec):
         assert isinstance(section, RelocationSection)
         super().__init__(section)
-        self.relocations = [r for r in section.iter_relocations()]
+        self.codec = codec
+        self.__relocations = codec.decode_relocations(section)
+        # Replacements not applied to the table yet (sorted by start, never overlapping), so
+        # that many patches into one section only take one pass over its relocations
+        self.pending: list[RelocationReplacement] = []
+        self.pending_starts: list[int] = []
+
+    @property
+    def relocations(self) -> list[Relocation]:
+        self.apply_replacements()
+        return self.__relocations
+
+    def replace_range(self, start: int, end: int, relocations: list[Relocation]):
+        # Replaces all relocations with an offset within [start, end) with the given relocations,
+        # which must also be within that range
+        i = bisect.bisect_right(self.pending_starts, start)
+        if (i > 0 and self.pending[i - 1][1] > start) or (i < len(self.pending) and self.pending_starts[i] < end):
+            # Overlaps an earlier patch, which has to replace its range first
+            self.apply_replacements()
+            i = 0
+        self.pending.insert(i, (start, end, relocations))
+        self.pending_starts.insert(i, start)
+
+    def apply_replacements(self):
+        if len(self.pending) > 0:
+            self.__relocations = replace_relocation_ranges(self.__relocations, self.pending)
+            self.pending = []
+            self.pending_starts = []
     
     def write(self, writer: BufferedWriter):
-        start = writer.tell()
         for reloc in self.relocations:
             reloc.entry["r_info"] = ((reloc.entry["r_info_sym"] & 0xFFFFFF) << 8) | (reloc.entry["r_info_type"] & 0xFF)
-            self.section.entry_struct.build_stream(reloc.entry, writer)
-        self.section.header['sh_size'] = writer.tell() - start
+        data = self.codec.encode_relocations(self.section, self.relocations)
+        writer.write(data)
+        self.section.header['sh_size'] = len(data)
 
 class EditedSymbolTableSection(EditedSection):
-    def __init__(self, section):
+    def __init__(self, section, codec: TableCodec):
         assert isinstance(section, SymbolTableSection)
         super().__init__(section)
-        self.syms = [s for s in section.iter_symbols()]
+        self.codec = codec
+        self.syms = codec.decode_symbols(section)
         self.original_sym_indexes: dict[Symbol, int] = {}
         self.syms_by_name: dict[str, Symbol] = {}
+        # Symbols in each section (dicts are used as ordered sets for O(1) removal)
+        self.syms_by_shndx: dict[int | str, dict[Symbol, None]] = {}
+        # Symbols removed from self.syms on the next compact()
+        self.removed_syms: set[Symbol] = set()
         for i, sym in enumerate(self.syms):
             self.original_sym_indexes[sym] = i
             existing_by_name = self.syms_by_name.get(sym.name)
             # If there are duplicate symbols, take the first defined version if possible
             if existing_by_name == None or existing_by_name.entry['st_shndx'] == 'SHN_UNDEF':
                 self.syms_by_name[sym.name] = sym
+            self.syms_by_shndx.setdefault(sym.entry['st_shndx'], {})[sym] = None
+
+    def get_section_syms(self, shndx: int) -> list[Symbol]:
+        return list(self.syms_by_shndx.get(shndx, ()))
+
+    def move_sym(self, sym: Symbol, shndx: int):
+        del self.syms_by_shndx[sym.entry['st_shndx']][sym]
+        sym.entry['st_shndx'] = shndx
+        self.syms_by_shndx.setdefault(shndx, {})[sym] = None
+
+    def remove_sym(self, sym: Symbol):
+        del self.syms_by_shndx[sym.entry['st_shndx']][sym]
+        self.removed_syms.add(sym)
+
+    def compact(self):
+        # Drop removed symbols from the symbol list in one pass
+        if len(self.removed_syms) > 0:
+            self.syms = [s for s in self.syms if not s in self.removed_syms]
+            self.removed_syms.clear()
 
     def write(self, writer: BufferedWriter):
-        start = writer.tell()
-        for sym in self.syms:
-            self.section.elffile.structs.Elf_Sym.build_stream(sym.entry, writer)
-        self.section.header['sh_size'] = writer.tell() - start
+        data = self.codec.encode_symbols(self.section, self.syms)
+        writer.write(data)
+        self.section.header['sh_size'] = len(data)
 
 class EditedELF:
-    def __init__(self, elf: ELFFile, sections: list[EditedSection]):
+    def __init__(self, elf: ELFFile, sections: list[EditedSection], codec: TableCodec):
         self.elf = elf
         self.sections = sections
+        self.codec = codec
         self.original_section_indexes: dict[EditedSection, int] = {}
         self.sections_by_name: dict[str, EditedSection] = {}
         self.symtab = None
@@ -90,6 +386,7 @@ VALID_PATCH_SECTION_TARGETS = set([".text", ".rodata", ".data", ".exports"])
 def do_patching(elf: EditedELF):
     shstrtab: EditedRawSection = elf.sections[elf.elf.header['e_shstrndx']]
     patch_sections: list[EditedSection] = []
+    patch_section_indexes: list[int] = []
 
     for idx, section in enumerate(elf.sections):
         section_name = section.section.name
@@ -97,6 +394,7 @@ def do_patching(elf: EditedELF):
         if match != None:
             assert isinstance(section, EditedRawSection)
             patch_sections.append(section)
+            patch_section_indexes.append(idx)
 
             # Lookup symbol that the patch is relative to
             symbol_name = match.group(1)
@@ -116,11 +414,11 @@ def do_patching(elf: EditedELF):
             if sym_shndx < 0 or sym_shndx >= len(elf.sections):
                 raise PatcherException(f"Patch section '{section_name}' references symbol '{symbol_name}' which has an invalid section index.")
             sym_section = elf.sections[sym_shndx]
-            assert isinstance(sym_section, EditedRawSection)
             patch_section_name: str = sym_section.section.name
             if not patch_section_name in VALID_PATCH_SECTION_TARGETS:
                 raise PatcherException(
                     f"Patch section '{section_name}' references symbol '{symbol_name}' which is in an invalid section: '{patch_section_name}'")
+            assert isinstance(sym_section, EditedRawSection)
             patch_section_name = patch_section_name.lstrip(".")
 
             # Calculate section relative offset
@@ -146,7 +444,8 @@ def do_patching(elf: EditedELF):
                         RelocationSection(
                             reloc_section.section.header.copy(),
                             target_reloc_section_name,
-                            reloc_section.section.elffile))
+                            reloc_section.section.elffile),
+                        reloc_section.codec)
                     shstrtab.data.seek(0, os.SEEK_END)
                     sh_name = shstrtab.data.tell()
                     shstrtab.data.write(target_reloc_section_name.encode())
@@ -157,45 +456,43 @@ def do_patching(elf: EditedELF):
                     elf.sections_by_name[target_reloc_section_name] = target_reloc_section
                     elf.original_section_indexes[target_reloc_section] = len(elf.sections) - 1
 
-                # Remove relocations overwritten by patch
-                relocs_to_remove: list[Relocation] = []
-                for reloc in target_reloc_section.relocations:
-                    base_offset = reloc["r_offset"]
-                    if base_offset >= offset and base_offset < (offset + size):
-                        relocs_to_remove.append(reloc)
-                for reloc in relocs_to_remove:
-                    target_reloc_section.relocations.remove(reloc)
-
                 for reloc in reloc_section.relocations:
                     # Relocate reloc to patched location relative to the section being patched
                     reloc.entry["r_offset"] += offset
-                    bisect.insort(target_reloc_section.relocations, reloc, key=lambda r: r.entry["r_offset"])
+
+                # Replace relocations overwritten by patch
+                target_reloc_section.replace_range(offset, offset + size, reloc_section.relocations)
             
             # Migrate symbols to target section
-            for sym in elf.symtab.syms:
-                if sym.entry["st_shndx"] == idx and sym.entry["st_info"]["type"] != "STT_SECTION":
+            for sym in elf.symtab.get_section_syms(idx):
+                if sym.entry["st_info"]["type"] != "STT_SECTION":
                     sym.entry["st_value"] += offset
-                    sym.entry["st_shndx"] = sym_shndx
+                    elf.symtab.move_sym(sym, sym_shndx)
             
     # Remove patch sections (clean up)
     for section in patch_sections:
         elf.sections.remove(section)
     
-    section_symbols: list[Symbol] = []
-    for sym in elf.symtab.syms:
-        if sym.entry["st_info"]["type"] == "STT_SECTION" and PATCH_SECTION_NAME_REGEX.match(sym.name) != None:
-            section_symbols.append(sym)
-    for sym in section_symbols:
-        elf.symtab.syms.remove(sym)
+    # Section symbols of patch sections are the only symbols left in them
+    for idx in patch_section_indexes:
+        for sym in elf.symtab.get_section_syms(idx):
+            if sym.entry["st_info"]["type"] == "STT_SECTION" and PATCH_SECTION_NAME_REGEX.match(sym.name) != None:
+                elf.symtab.remove_sym(sym)
 
 def remap(elf: EditedELF):
-    # Re-sort symbols (local symbols must always be first)
-    elf.symtab.syms.sort(key=lambda s: 0 if s.entry["st_info"]["bind"] == "STB_LOCAL" else 1)
+    elf.symtab.compact()
 
-    last_local_sym = 0
-    for i, sym in enumerate(elf.symtab.syms):
+    # Re-order symbols (local symbols must always be first), keeping their relative order
+    local_syms: list[Symbol] = []
+    other_syms: list[Symbol] = []
+    for sym in elf.symtab.syms:
         if sym.entry["st_info"]["bind"] == "STB_LOCAL":
-            last_local_sym = i
+            local_syms.append(sym)
+        else:
+            other_syms.append(sym)
+    elf.symtab.syms = local_syms + other_syms
+
+    last_local_sym = max(len(local_syms) - 1, 0)
 
     # sh_info of .symtab is one plus the index of the last local symbol
     elf.symtab.section.header["sh_info"] = last_local_sym + 1
@@ -230,25 +527,47 @@ def remap(elf: EditedELF):
                 reloc_symidx = reloc.entry['r_info_sym']
                 reloc.entry['r_info_sym'] = sym_remap.get(reloc_symidx, 0) # 0 = STN_UNDEF
 
-def patch_file(elf_file: BufferedReader, output: BufferedWriter):
+def is_edited_raw_section(elf: ELFFile, idx: int, section: Section) -> bool:
+    # Only patch sections, patch targets and the section name table are modified,
+    # everything else (debug info, .comment, etc.) is passed through
+    return idx == elf.header['e_shstrndx'] \
+        or section.name in VALID_PATCH_SECTION_TARGETS \
+        or PATCH_SECTION_NAME_REGEX.match(section.name) != None
+
+# Reads and patches an ELF. The input file must stay open until the result is written.
+def patch_elf(elf_file: BinaryIO, verify_encoding: bool = False) -> EditedELF:
     # Read base ELF
-    elf = ELFFile(elf_file)
-
-    sections: list[EditedSection] = []
-    for section in elf.iter_sections():
-        if isinstance(section, RelocationSection):
-            sections.append(EditedRelocationSection(section))
-        elif isinstance(section, SymbolTableSection):
-            sections.append(EditedSymbolTableSection(section))
-        else:
-            sections.append(EditedRawSection(section))
+    with phase("parse"):
+        elf = ELFFile(elf_file)
+        codec = TableCodec(elf, verify_encoding)
+
+        sections: list[EditedSection] = []
+        for idx, section in enumerate(elf.iter_sections()):
+            if isinstance(section, RelocationSection):
+                sections.append(EditedRelocationSection(section, codec))
+            elif isinstance(section, SymbolTableSection):
+                sections.append(EditedSymbolTableSection(section, codec))
+            elif is_edited_raw_section(elf, idx, section):
+                sections.append(EditedRawSection(section))
+            else:
+                sections.append(EditedPassthroughSection(section))
 
     # Patch
-    edited_elf: EditedELF = EditedELF(elf, sections)
-    do_patching(edited_elf)
-    remap(edited_elf)
+    edited_elf: EditedELF = EditedELF(elf, sections, codec)
+    with phase("patch"):
+        do_patching(edited_elf)
+    with phase("remap"):
+        remap(edited_elf)
+
+    return edited_elf
+
+def write_elf(edited_elf: EditedELF, output: BinaryIO):
+    with phase("write"):
+        write_sections(edited_elf, output)
 
-    # Write patched ELF
+def write_sections(edited_elf: EditedELF, output: BinaryIO):
+    elf = edited_elf.elf
+    
     sections_by_file_order: list[EditedSection] = edited_elf.sections.copy()
     sections_by_file_order.sort(key=lambda s: s.section.header['sh_offset'])
     
@@ -266,27 +585,88 @@ def patch_file(elf_file: BufferedReader, output: BufferedWriter):
     
     elf.header['e_shoff'] = output.tell()
     elf.header['e_shnum'] = len(edited_elf.sections)
-    for section in edited_elf.sections:
-        elf.structs.Elf_Shdr.build_stream(section.section.header, output)
+    output.write(edited_elf.codec.encode_section_headers([section.section.header for section in edited_elf.sections]))
 
     output.seek(0, os.SEEK_SET)
     elf.structs.Elf_Ehdr.build_stream(elf.header, output)
 
+def patch_file(elf_file: BufferedReader, output: BufferedWriter, verify_encoding: bool = False):
+    write_elf(patch_elf(elf_file, verify_encoding), output)
+
+# Patches an ELF in memory, returning the patched ELF file contents
+def patch_to_bytes(elf_file: BinaryIO, verify_encoding: bool = False) -> bytes:
+    output = BytesIO()
+    write_elf(patch_elf(elf_file, verify_encoding), output)
+    return output.getvalue()
+
+# Reads a batch file of whitespace separated (shell quoted) input and output path pairs
+def read_batch_file(path: str) -> list[tuple[str, str]]:
+    with open(path, "r", encoding="utf-8") as batch_file:
+        paths = shlex.split(batch_file.read())
+    if len(paths) % 2 != 0:
+        raise PatcherException(f"Batch file {path} must contain pairs of input and output paths.")
+    return list(zip(paths[0::2], paths[1::2]))
+
+# Patches one ELF of a batch, returning an error message if it failed
+def patch_batch_entry(entry: tuple[str, str, bool]) -> str | None:
+    (input_path, output_path, verify_encoding) = entry
+    try:
+        with open(input_path, "rb") as elf_file:
+            data = patch_to_bytes(elf_file, verify_encoding)
+        # Leave unchanged outputs alone so later build steps don't re-run
+        write_if_changed(output_path, data)
+    except (PatcherException, ELFError, OSError) as ex:
+        return f"{input_path}: {ex}"
+    return None
+
+def patch_batch(pairs: list[tuple[str, str]], jobs: int, verify_encoding: bool = False) -> list[str]:
+    entries = [(input_path, output_path, verify_encoding) for (input_path, output_path) in pairs]
+    if jobs == 1 or len(entries) <= 1:
+        errors = [patch_batch_entry(entry) for entry in entries]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(entries))) as executor:
+            errors = list(executor.map(patch_batch_entry, entries))
+    return [error for error in errors if error != None]
+
+@profiled
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("elf", type=argparse.FileType("rb"), help="The ELF file containing patch sections.")
-    parser.add_argument("-o", "--output", type=argparse.FileType("wb"), help="The path of the patched ELF file to output.", required=True)
+    parser.add_argument("elf", type=argparse.FileType("rb"), nargs="?", help="The ELF file containing patch sections.")
+    parser.add_argument("-o", "--output", type=str, help="The path of the patched ELF file to output (only written if it changed).")
+    parser.add_argument("--batch", type=str, action="append", default=[],
+                        help="Patch every pair of input and output ELF paths listed in this file (instead of a single ELF). " +
+                             "Outputs are only written if they changed.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes to patch a batch with (0 = CPU count).")
+    parser.add_argument("--verify-encoding", dest="verify_encoding", action="store_true", default=False,
+                        help="Check the fast symbol/relocation table encoding against pyelftools (slow).")
     args = parser.parse_args()
 
+    if len(args.batch) > 0:
+        if args.elf != None or args.output != None:
+            parser.error("an ELF and -o/--output can't be given with --batch")
+    elif args.elf == None or args.output == None:
+        parser.error("an ELF and -o/--output are required without --batch")
+
     error = False
-    try:
-        patch_file(args.elf, args.output)
-    except PatcherException as ex:
-        print(f"ERROR: {ex}")
-        error = True
-    finally:
-        args.elf.close()
-        args.output.close()
+    if len(args.batch) > 0:
+        try:
+            pairs = [pair for path in args.batch for pair in read_batch_file(path)]
+            jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+            for message in patch_batch(pairs, jobs, args.verify_encoding):
+                print(f"ERROR: {message}")
+                error = True
+        except PatcherException as ex:
+            print(f"ERROR: {ex}")
+            error = True
+    else:
+        try:
+            with open_if_changed(args.output) as output:
+                patch_file(args.elf, output, args.verify_encoding)
+        except PatcherException as ex:
+            print(f"ERROR: {ex}")
+            error = True
+        finally:
+            args.elf.close()
     
     if error:
         exit(1)
@@ -0,0 +1,218 @@
+# File helpers shared by configure.py and the build tools
+
+import contextlib
+import hashlib
+from io import BufferedReader, BufferedWriter
+import json
+import math
+import os
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from tools.profiling import count
+
+COMPARE_CHUNK_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+MANIFEST_VERSION = 1
+
+def align(n: int, alignment: int) -> int:
+    return math.ceil(n / alignment) * alignment
+
+# Writes data to path, unless the file already contains exactly that data. Leaving
+# unchanged files alone keeps their mtime, which lets ninja skip dependent steps.
+# Returns whether the file was written.
+def write_if_changed(path: "Path | str", data: bytes) -> bool:
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, "rb") as file:
+                if file.read() == data:
+                    return False
+    except FileNotFoundError:
+        pass
+
+    # Write to a temporary file first so that the output is never left half written
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+    return True
+
+# Writes a ninja depfile listing the files output depends on
+def write_depfile(path: "Path | str", output: str, deps: "list[Path]"):
+    def escape(path: Path) -> str:
+        return path.as_posix().replace("$", "$$").replace(" ", "\\ ").replace("#", "\\#")
+
+    lines = [f"{output}: \\\n"]
+    lines.extend(f"  {escape(dep)} \\\n" for dep in deps[:-1])
+    lines.append(f"  {escape(deps[-1])}\n")
+    write_if_changed(path, "".join(lines).encode())
+
+# Compares the contents of an open file with the file at path
+def file_equals(file: BinaryIO, path: "Path | str") -> bool:
+    try:
+        if os.fstat(file.fileno()).st_size != os.path.getsize(path):
+            return False
+        with open(path, "rb") as other:
+            file.seek(0, os.SEEK_SET)
+            while True:
+                chunk = file.read(COMPARE_CHUNK_SIZE)
+                if chunk != other.read(COMPARE_CHUNK_SIZE):
+                    return False
+                if not chunk:
+                    return True
+    except FileNotFoundError:
+        return False
+
+# Same as write_if_changed, but for outputs that are streamed rather than built in
+# memory. Yields a temporary file (opened for reading and writing) that replaces path
+# once the block exits, unless path already has the same contents.
+@contextlib.contextmanager
+def open_if_changed(path: "Path | str") -> Iterator[BinaryIO]:
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w+b") as file:
+            yield file
+            file.flush()
+            unchanged = file_equals(file, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+    if unchanged:
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+# Writes the contents of src into dst at its current position without loading
+# the whole file into memory. Returns the number of bytes copied.
+def copy_file_into(src: BufferedReader, dst: BufferedWriter) -> int:
+    size = os.fstat(src.fileno()).st_size
+    copied = 0
+
+    # Let the kernel copy directly between the files if possible
+    dst.flush()
+    start = dst.tell()
+    try:
+        dst_fd = dst.fileno()
+        if hasattr(os, "copy_file_range"):
+            while copied < size:
+                n = os.copy_file_range(src.fileno(), dst_fd, size - copied, copied, start + copied)
+                if n == 0:
+                    break
+                copied += n
+        elif hasattr(os, "sendfile"):
+            os.lseek(dst_fd, start, os.SEEK_SET)
+            while copied < size:
+                n = os.sendfile(dst_fd, src.fileno(), copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+    except OSError:
+        # Not supported for these files, finish with a normal copy
+        pass
+
+    # Fixed-size chunked copy of whatever is left
+    src.seek(copied, os.SEEK_SET)
+    dst.seek(start + copied, os.SEEK_SET)
+    buffer = bytearray(min(COPY_CHUNK_SIZE, max(size - copied, 1)))
+    view = memoryview(buffer)
+    while True:
+        n = src.readinto(buffer)
+        if not n:
+            break
+        dst.write(view[:n])
+        copied += n
+    dst.flush()
+
+    count("bytes_read", copied)
+    count("bytes_written", copied)
+    return copied
+
+# Gets the SHA-1 of a file's contents, read in chunks
+def hash_file(path: Path) -> str:
+    sha1 = hashlib.sha1()
+    buffer = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buffer)
+    read = 0
+    with open(path, "rb") as file:
+        while True:
+            n = file.readinto(buffer)
+            if not n:
+                break
+            sha1.update(view[:n])
+            read += n
+    count("bytes_read", read)
+    return sha1.hexdigest()
+
+# Incremental packers keep a <output>.manifest.json sidecar with the size, mtime and hash of
+# each packed file. Entries are identified by entry[key] (e.g. an asset name or a path).
+
+def get_manifest_path(output_path: Path) -> Path:
+    return output_path.with_name(output_path.name + ".manifest.json")
+
+# Loads the entries of the manifest saved with output_path, if it still describes the output
+# file and has an entry for each of ids, in order
+def load_manifest(output_path: Path, key: str, ids: "list[str]") -> "list[dict] | None":
+    try:
+        with open(get_manifest_path(output_path), "r", encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        output_stat = output_path.stat()
+    except (OSError, ValueError):
+        return None
+
+    # Anything that isn't shaped like a manifest this version wrote means a full repack
+    try:
+        if manifest.get("version") != MANIFEST_VERSION:
+            return None
+        if manifest["output_size"] != output_stat.st_size or manifest["output_mtime_ns"] != output_stat.st_mtime_ns:
+            return None
+        entries: "list[dict]" = manifest["entries"]
+        if [entry[key] for entry in entries] != ids:
+            return None
+        for entry in entries:
+            if not isinstance(entry["size"], int) or not isinstance(entry["mtime_ns"], int) \
+                    or not isinstance(entry["hash"], (str, type(None))):
+                return None
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+    return entries
+
+def save_manifest(output_path: Path, entries: "list[dict]"):
+    output_stat = output_path.stat()
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "output_size": output_stat.st_size,
+        "output_mtime_ns": output_stat.st_mtime_ns,
+        "entries": entries
+    }
+    with open(get_manifest_path(output_path), "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+
+# Gets the size, mtime and hash of each (id, path) file to pack. Files are only re-hashed if
+# their size or mtime differs from the previous manifest. Missing files get a size of 0 and
+# no hash.
+def scan_manifest_entries(key: str, files: "list[tuple[str, Path | None]]",
+                          previous: "list[dict] | None") -> "list[dict]":
+    entries: "list[dict]" = []
+    for i, (id, path) in enumerate(files):
+        try:
+            if path == None:
+                raise FileNotFoundError()
+            stat = path.stat()
+        except FileNotFoundError:
+            entries.append({ key: id, "size": 0, "mtime_ns": 0, "hash": None })
+            continue
+
+        prev_entry = previous[i] if previous != None else None
+        if prev_entry != None and prev_entry[key] == id \
+                and prev_entry["size"] == stat.st_size and prev_entry["mtime_ns"] == stat.st_mtime_ns:
+            hash = prev_entry["hash"]
+        else:
+            hash = hash_file(path)
+
+        entries.append({ key: id, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": hash })
+
+    return entries
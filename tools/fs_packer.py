@@ -1,10 +1,13 @@
 import argparse
-from io import BufferedReader
-import math
+from io import BufferedWriter
+import json
 import os
 from pathlib import Path
 import struct
 
+from tools.fileutil import align, copy_file_into, load_manifest, open_if_changed, save_manifest, scan_manifest_entries
+from tools.profiling import phase, profiled
+
 FS_MAP = [
     "AUDIO_tab.bin", # 00
     "AUDIO.bin", # 01
@@ -82,13 +85,27 @@ FS_MAP = [
     "ENVFXACT.bin", # 49
 ]
 
-def align(n: int, alignment: int) -> int:
-    return math.ceil(n / alignment) * alignment
+def get_fst_byte_size() -> int:
+    return align((len(FS_MAP) + 2) * 4, 16)
+
+# Gets the path of each FS_MAP entry from a directory containing all of them
+def get_asset_paths_from_dir(assets_path: Path) -> "list[Path | None]":
+    return [assets_path.joinpath(filename) for filename in FS_MAP]
+
+# Gets the path of each FS_MAP entry from a JSON file mapping entry names to paths.
+# Entries that are missing or null are packed as empty.
+def load_asset_sources(sources_path: Path) -> "list[Path | None]":
+    with open(sources_path, "r", encoding="utf-8") as sources_file:
+        sources: "dict[str, str | None]" = json.load(sources_file)
+    for name in sources.keys():
+        if not name in FS_MAP:
+            raise ValueError(f"Unknown asset in {sources_path}: {name}")
+    return [Path(sources[filename]) if sources.get(filename) != None else None for filename in FS_MAP]
 
-def repack(assets_path: Path, output_writer: BufferedReader):
+def repack(asset_paths: "list[Path | None]", output_writer: BufferedWriter):
     file_count = len(FS_MAP)
 
-    output_writer.write(bytearray(align((file_count + 2) * 4, 16)))
+    output_writer.write(bytearray(get_fst_byte_size()))
 
     fst_byte_size = output_writer.tell()
     assert(fst_byte_size == (0xA4AA0 - 0xA4970))
@@ -97,13 +114,11 @@ def repack(assets_path: Path, output_writer: BufferedReader):
     fst: list[int] = []
     fst.append(file_count)
 
-    for filename in FS_MAP:
+    for filepath in asset_paths:
         fst.append(offset)
-        filepath = assets_path.joinpath(filename)
-        if filepath.exists():
+        if filepath != None and filepath.exists():
             with open(filepath, "rb") as file:
-                output_writer.write(file.read())
-                offset += file.tell()
+                offset += copy_file_into(file, output_writer)
         #else:
         #    print(f"not found {filepath.absolute()}")
 
@@ -118,15 +133,90 @@ def repack(assets_path: Path, output_writer: BufferedReader):
     for offset in fst:
         output_writer.write(struct.pack(">I", offset))
 
+# Updates an existing packed FS, only rewriting the entries that changed since the last repack.
+# Entries that keep their size are patched in place. If an entry changes size, everything
+# from that entry onward is rewritten.
+def repack_incremental(asset_paths: "list[Path | None]", output_path: Path):
+    with phase("scan"):
+        previous = load_manifest(output_path, "name", FS_MAP)
+        entries = scan_manifest_entries("name", list(zip(FS_MAP, asset_paths)), previous)
+
+    if previous == None:
+        # Nothing to update, do a full repack
+        with phase("write"), open_if_changed(output_path) as output_writer:
+            repack(asset_paths, output_writer)
+        save_manifest(output_path, entries)
+        return
+
+    changed = [i for i, entry in enumerate(entries)
+               if entry["hash"] != previous[i]["hash"] or entry["size"] != previous[i]["size"]]
+    if len(changed) == 0:
+        save_manifest(output_path, entries)
+        return
+
+    first_resized = next((i for i in changed if entries[i]["size"] != previous[i]["size"]), len(entries))
+
+    fst_byte_size = get_fst_byte_size()
+    fst: list[int] = [len(FS_MAP)]
+    offset = 0
+    for entry in entries:
+        fst.append(offset)
+        offset += entry["size"]
+    fst.append(offset)
+
+    with phase("write"), open(output_path, "r+b") as output_writer:
+        # Patch same size entries in place
+        for i in changed:
+            if i >= first_resized:
+                break
+            if entries[i]["size"] == 0:
+                continue
+            output_writer.seek(fst_byte_size + fst[i + 1], os.SEEK_SET)
+            with open(asset_paths[i], "rb") as file:
+                copy_file_into(file, output_writer)
+
+        if first_resized < len(entries):
+            # Rewrite everything after the first resized entry
+            output_writer.seek(fst_byte_size + fst[first_resized + 1], os.SEEK_SET)
+            for i in range(first_resized, len(entries)):
+                if entries[i]["hash"] != None:
+                    with open(asset_paths[i], "rb") as file:
+                        copy_file_into(file, output_writer)
+
+            # Same ENVFXACT hack as repack
+            fst[len(fst) - 1] += 4
+            output_writer.write(bytearray(4))
+            output_writer.truncate()
+
+            output_writer.seek(0, os.SEEK_SET)
+            for offset in fst:
+                output_writer.write(struct.pack(">I", offset))
+
+    save_manifest(output_path, entries)
+
+@profiled
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("assets", type=str, help="The directory of assets to repack.")
-    parser.add_argument("-o", "--output", type=argparse.FileType("wb"), help="The path of the assets binary file to output.", required=True)
+    parser.add_argument("assets", type=str, nargs="?", help="The directory of assets to repack.")
+    parser.add_argument("-s", "--sources", type=str,
+                        help="A JSON file mapping each asset name to the path of the file to pack, instead of an assets directory.")
+    parser.add_argument("-o", "--output", type=str, help="The path of the assets binary file to output.", required=True)
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="Only rewrite the entries that changed since the last repack (tracked in a <output>.manifest.json sidecar).")
     args = parser.parse_args()
 
-    repack(Path(args.assets), args.output)
-    
-    args.output.close()
+    if args.sources != None:
+        asset_paths = load_asset_sources(Path(args.sources))
+    elif args.assets != None:
+        asset_paths = get_asset_paths_from_dir(Path(args.assets))
+    else:
+        parser.error("either an assets directory or --sources is required")
+
+    if args.incremental:
+        repack_incremental(asset_paths, Path(args.output))
+    else:
+        with phase("write"), open_if_changed(args.output) as output:
+            repack(asset_paths, output)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
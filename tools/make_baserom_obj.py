@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Converts the decomp's ELF into a relocatable object containing its ROM image, which
+# the precomp ELF is linked on top of (equivalent to `objcopy -O binary` with section
+# removals, followed by `objcopy -I binary -O elf32-big`)
+#
+# The object is only written if its contents changed, so changes to the decomp ELF
+# that don't affect the ROM (such as debug info) don't cause a relink.
+
+import argparse
+import re
+import struct
+
+from tools.fileutil import write_if_changed
+from tools.make_z64 import layout_rom
+from tools.profiling import profiled
+
+ELF_HEADER = struct.Struct(">16sHHIIIIIHHHHHH")
+SECTION_HEADER = struct.Struct(">10I")
+SYMBOL = struct.Struct(">IIIBBH")
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHN_ABS = 0xFFF1
+STB_GLOBAL = 1
+
+def align(n: int, alignment: int) -> int:
+    return (n + alignment - 1) // alignment * alignment
+
+# Builds an ELF32 big-endian relocatable with data in .data, laid out the same as
+# objcopy -I binary, including the _binary_<name>_start/_end/_size symbols
+def make_binary_object(data: bytes, name: str) -> bytes:
+    symbol_base = "_binary_" + re.sub(r"[^0-9A-Za-z_]", "_", name)
+
+    # String tables
+    strtab = bytearray(b"\0")
+    symbols: "list[tuple[int, int, int]]" = [] # (st_name, st_value, st_shndx)
+    for (suffix, value, shndx) in [("_start", 0, 1), ("_end", len(data), 1), ("_size", len(data), SHN_ABS)]:
+        symbols.append((len(strtab), value, shndx))
+        strtab.extend(f"{symbol_base}{suffix}".encode() + b"\0")
+    shstrtab = b"\0.symtab\0.strtab\0.shstrtab\0.data\0"
+    (symtab_name, strtab_name, shstrtab_name, data_name) = (1, 9, 17, 27)
+
+    symtab = bytearray(SYMBOL.size) # Null symbol
+    for (st_name, st_value, st_shndx) in symbols:
+        symtab.extend(SYMBOL.pack(st_name, st_value, 0, (STB_GLOBAL << 4), 0, st_shndx))
+
+    # Layout
+    data_offset = ELF_HEADER.size
+    symtab_offset = align(data_offset + len(data), 4)
+    strtab_offset = symtab_offset + len(symtab)
+    shstrtab_offset = strtab_offset + len(strtab)
+    shoff = align(shstrtab_offset + len(shstrtab), 4)
+
+    sections = [
+        SECTION_HEADER.pack(0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+        SECTION_HEADER.pack(data_name, SHT_PROGBITS, SHF_WRITE | SHF_ALLOC, 0, data_offset, len(data), 0, 0, 1, 0),
+        SECTION_HEADER.pack(symtab_name, SHT_SYMTAB, 0, 0, symtab_offset, len(symtab), 3, 1, 4, SYMBOL.size),
+        SECTION_HEADER.pack(strtab_name, SHT_STRTAB, 0, 0, strtab_offset, len(strtab), 0, 0, 1, 0),
+        SECTION_HEADER.pack(shstrtab_name, SHT_STRTAB, 0, 0, shstrtab_offset, len(shstrtab), 0, 0, 1, 0),
+    ]
+
+    ident = b"\x7fELF" + bytes([1, 2, 1, 0]) + bytes(8) # ELF32, big endian, version 1, System V
+    header = ELF_HEADER.pack(ident, 1, 0, 1, 0, 0, shoff, 0, ELF_HEADER.size, 0, 0, SECTION_HEADER.size, len(sections), 4)
+
+    output = bytearray(header)
+    output.extend(data)
+    output.extend(bytes(symtab_offset - len(output)))
+    output.extend(symtab)
+    output.extend(strtab)
+    output.extend(shstrtab)
+    output.extend(bytes(shoff - len(output)))
+    for section in sections:
+        output.extend(section)
+    return bytes(output)
+
+@profiled
+def main():
+    parser = argparse.ArgumentParser(description="Converts a linked ELF's ROM image to a relocatable object.")
+    parser.add_argument("elf", type=argparse.FileType("rb"), help="The linked ELF (e.g. the decomp's dino.elf).")
+    parser.add_argument("-o", "--output", type=str, help="The path of the object file to output.", required=True)
+    parser.add_argument("-R", "--remove-section", dest="remove_sections", type=str, action="append", default=[],
+                        help="Leave a section out of the ROM image (can be given multiple times).")
+    parser.add_argument("--name", type=str, help="Name the _binary_<name>_* symbols are derived from. Default: the output path.")
+    args = parser.parse_args()
+
+    try:
+        rom = layout_rom(args.elf, set(args.remove_sections))
+    finally:
+        args.elf.close()
+
+    name = args.name if args.name != None else args.output
+    write_if_changed(args.output, make_binary_object(rom, name))
+
+if __name__ == "__main__":
+    main()
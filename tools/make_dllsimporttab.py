@@ -1,64 +1,75 @@
 import argparse
 import struct
-from elftools.elf.elffile import ELFFile
-from elftools.elf.sections import SymbolTableSection
-from io import BufferedReader, BufferedWriter
+from io import BufferedReader, BufferedWriter, BytesIO, StringIO
+from pathlib import Path
 import re
 from typing import TextIO
 
+from tools.fileutil import write_if_changed
+from tools.profiling import phase, profiled
+from tools.symbol_index import SymbolIndexException, load_symbol_index
+
 symbol_pattern = re.compile(r"(\S+)\s*=\s*(\S+);")
 
 class ScriptException(Exception):
     pass
 
-def make(base: BufferedReader, elf_file: BufferedReader, syms_file: TextIO, output: BufferedWriter, linker_script: TextIO):
+def make(base: BufferedReader, elf_path: Path, syms_file: TextIO, output: BufferedWriter, linker_script: TextIO,
+         symbol_cache_dir: "Path | None" = None):
     syms = [s.strip() for s in syms_file.readlines() if len(s.strip()) > 0 and not s.lstrip().startswith("#")]
 
-    elf = ELFFile(elf_file)
-    symtab = elf.get_section_by_name(".symtab")
-    assert isinstance(symtab, SymbolTableSection)
+    with phase("load symbols"):
+        symtab = load_symbol_index(elf_path, symbol_cache_dir)
 
     output.write(base.read())
 
     i = 0x80000000 + (base.tell() // 4) + 1
     for sym_name in syms:
-        sym = symtab.get_symbol_by_name(sym_name)
-        if sym == None:
+        sym = symtab.get_symbols_by_name(sym_name)
+        if len(sym) == 0:
             raise ScriptException(f"Unknown symbol to export: '{sym_name}'")
         if len(sym) > 1:
             raise ScriptException(f"Export symbol '{sym_name}' is ambiguous.")
         sym = sym[0]
-        if sym.entry["st_shndx"] == "SHN_UNDEF":
+        if sym.is_undefined():
             raise ScriptException(f"Export symbol '{sym_name}' is undefined.")
 
-        output.write(struct.pack(">I", sym.entry["st_value"]))
+        output.write(struct.pack(">I", sym.value))
         linker_script.write("{} = 0x{:X};\n".format(sym_name, i))
         i += 1
 
+@profiled
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("dllsimporttab", type=argparse.FileType("rb"), help="Path to the original DLLSIMPORTTAB file.")
-    parser.add_argument("-e", "--elf", type=argparse.FileType("rb"), help="Path to the base ELF file.", required=True)
+    parser.add_argument("-e", "--elf", type=str, help="Path to the base ELF file.", required=True)
     parser.add_argument("-s", "--symbols", type=argparse.FileType("r"), help="Path to a file containing new symbols to export to DLLs.", required=True)
-    parser.add_argument("-o", "--output", type=argparse.FileType("wb"), help="The path of the new DLLSIMPORTTAB file to output.", required=True)
-    parser.add_argument("-l", "--linker-script", dest="linker_script", type=argparse.FileType("w"), help="The path of the linker script containing the new symbols to output.", required=True)
+    parser.add_argument("-o", "--output", type=str, help="The path of the new DLLSIMPORTTAB file to output.", required=True)
+    parser.add_argument("-l", "--linker-script", dest="linker_script", type=str, help="The path of the linker script containing the new symbols to output.", required=True)
+    parser.add_argument("--symbol-cache", dest="symbol_cache", type=str, help="Directory to cache the base ELF's symbol index in.")
     args = parser.parse_args()
 
+    # Outputs are built in memory and only written if they changed
+    output = BytesIO()
+    linker_script = StringIO()
+
     error = False
     try:
-        make(args.dllsimporttab, args.elf, args.symbols, args.output, args.linker_script)
-    except ScriptException as ex:
+        make(args.dllsimporttab, Path(args.elf), args.symbols, output, linker_script,
+             Path(args.symbol_cache) if args.symbol_cache != None else None)
+    except (ScriptException, SymbolIndexException) as ex:
         print(f"ERROR: {ex}")
         error = True
     finally:
         args.dllsimporttab.close()
-        args.elf.close()
         args.symbols.close()
-        args.output.close()
-        args.linker_script.close()
     
     if error:
         exit(1)
 
+    with phase("write"):
+        write_if_changed(args.output, output.getvalue())
+        write_if_changed(args.linker_script, linker_script.getvalue().encode("utf-8"))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
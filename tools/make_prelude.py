@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Writes the prelude header of a group of C files, to be precompiled and force included
+# (-include) when compiling them
+#
+# The prelude is the longest run of #include lines that every file starts with, so force
+# including it first doesn't change what any file sees. Includes of headers next to a
+# source file end the run, since they wouldn't resolve the same way from the prelude.
+# The prelude is only written if it changed.
+
+import argparse
+import os
+from pathlib import Path
+import re
+
+from tools.fileutil import write_if_changed
+from tools.profiling import profiled
+
+include_pattern = re.compile(r"#\s*include\s*(<([^>]+)>|\"([^\"]+)\")\s*$")
+block_comment_pattern = re.compile(r"/\*.*?\*/")
+
+# Gets the includes at the top of a source file, before any other code or directive
+def get_leading_includes(path: Path) -> "list[str]":
+    includes: "list[str]" = []
+    in_comment = False
+    with open(path, "r", encoding="utf-8", errors="replace") as source:
+        for line in source:
+            # Strip comments
+            if in_comment:
+                end = line.find("*/")
+                if end == -1:
+                    continue
+                line = line[end + 2:]
+                in_comment = False
+            line = block_comment_pattern.sub(" ", line)
+            start = line.find("/*")
+            if start != -1:
+                line = line[:start]
+                in_comment = True
+            line = line.split("//", 1)[0].strip()
+
+            if len(line) == 0:
+                continue
+            match = include_pattern.match(line)
+            if match == None:
+                break
+            (include, _, local_header) = match.groups()
+            if local_header != None and path.parent.joinpath(local_header).exists():
+                break
+            includes.append(include)
+    return includes
+
+def get_common_prefix(lists: "list[list[str]]") -> "list[str]":
+    if len(lists) == 0:
+        return []
+    prefix = lists[0]
+    for items in lists[1:]:
+        length = 0
+        while length < min(len(prefix), len(items)) and prefix[length] == items[length]:
+            length += 1
+        prefix = prefix[:length]
+    return prefix
+
+# Gets the includes that every source file starts with
+def get_prelude_includes(sources: "list[Path]") -> "list[str]":
+    return get_common_prefix([get_leading_includes(source) for source in sources])
+
+def format_prelude(includes: "list[str]") -> str:
+    lines = ["// Generated by tools/make_prelude.py: the includes every source file of this group starts with\n"]
+    lines.extend(f"#include {include}\n" for include in includes)
+    return "".join(lines)
+
+@profiled
+def main():
+    parser = argparse.ArgumentParser(description="Writes a header with the includes shared by the start of every given C file.",
+                                     fromfile_prefix_chars="@")
+    parser.add_argument("sources", type=str, nargs="+", help="The C files (or @file listing them, one per line).")
+    parser.add_argument("-o", "--output", type=str, help="The path of the header to output.", required=True)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    includes = get_prelude_includes([Path(source) for source in args.sources])
+    write_if_changed(args.output, format_prelude(includes).encode())
+
+if __name__ == "__main__":
+    main()
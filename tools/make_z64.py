@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Converts a linked ROM ELF into a checksummed .z64 in one pass
+# (equivalent to `objcopy -O binary` followed by n64cksum)
+
+import argparse
+from io import BufferedReader
+from elftools.elf.constants import SH_FLAGS
+from elftools.elf.elffile import ELFFile
+
+from tools.fileutil import write_if_changed
+from tools.n64cksum import CIC_SEEDS, DEFAULT_CIC, sm64_update_checksums
+from tools.profiling import profiled
+
+def get_section_lma(elf: ELFFile, section) -> int:
+    # Same as objcopy, the LMA of a section comes from the physical address
+    # of the segment that loads it
+    for segment in elf.iter_segments("PT_LOAD"):
+        if segment.section_in_segment(section):
+            return segment["p_paddr"] + (section["sh_offset"] - segment["p_offset"])
+    return section["sh_addr"]
+
+# Sections in removed_sections are left out, same as objcopy's --remove-section
+def layout_rom(elf_file: BufferedReader, removed_sections: "set[str]" = set()) -> bytearray:
+    elf = ELFFile(elf_file)
+
+    # Find all loadable sections that have contents
+    placements: "list[tuple[int, int, int]]" = []
+    for section in elf.iter_sections():
+        if (section["sh_flags"] & SH_FLAGS.SHF_ALLOC) == 0:
+            continue
+        if section.name in removed_sections:
+            continue
+        if section["sh_type"] == "SHT_NOBITS" or section["sh_size"] == 0:
+            continue
+        placements.append((get_section_lma(elf, section), section["sh_offset"], section["sh_size"]))
+
+    if len(placements) == 0:
+        return bytearray()
+
+    start = min(lma for (lma, _, _) in placements)
+    end = max(lma + size for (lma, _, size) in placements)
+
+    # Read each section straight into its place in the image
+    rom = bytearray(end - start)
+    view = memoryview(rom)
+    for (lma, offset, size) in sorted(placements):
+        elf_file.seek(offset)
+        elf_file.readinto(view[lma - start:lma - start + size])
+
+    return rom
+
+@profiled
+def main():
+    parser = argparse.ArgumentParser(description="Converts a linked ELF to a checksummed N64 ROM.")
+    parser.add_argument("elf", type=argparse.FileType("rb"), help="The linked ROM ELF.")
+    parser.add_argument("-o", "--output", type=str, help="The path of the ROM to output (only written if it changed).", required=True)
+    parser.add_argument("--cic", type=int, choices=sorted(CIC_SEEDS.keys()), default=DEFAULT_CIC, help="The boot chip the ROM is checksummed for.")
+    args = parser.parse_args()
+
+    try:
+        rom = layout_rom(args.elf)
+        sm64_update_checksums(rom, args.cic)
+    finally:
+        args.elf.close()
+
+    write_if_changed(args.output, rom)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,22 @@
 #!/usr/bin/env python3
 
+import argparse
+from array import array
+from functools import reduce
+from itertools import accumulate, repeat
+import mmap
+from operator import and_, xor
 import sys
 import struct
 
+from tools.fileutil import write_if_changed
+from tools.profiling import phase, profiled
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Original code from: https://gist.github.com/dkosmari/ee7bb471ea12c21b008d0ecffebd6384
 # Modified to not print
 
@@ -13,6 +27,20 @@ import struct
 
 mask32 = 0xffffffff
 
+# The boot code checksums the 1 MiB following IPL3
+CHECKSUM_START = 0x1000
+CHECKSUM_END = 0x101000
+
+# Boot code seed inputs (s6, multiplier) per CIC. The seed is (s6 * multiplier) + 1.
+CIC_SEEDS = {
+    6101: (0x3f, 0x5d588b65),
+    6102: (0x3f, 0x5d588b65),
+    6103: (0x78, 0x6c078965),
+    6105: (0x91, 0x5d588b65),
+    6106: (0x85, 0x6c078965),
+}
+DEFAULT_CIC = 6102
+
 
 def read_u32_be(buffer : bytearray, offset):
     return struct.unpack_from(">I", buffer, offset)[0]
@@ -22,7 +50,23 @@ def write_u32_be(buffer : bytearray, offset, value):
     struct.pack_into(">I", buffer, offset, value)
 
 
-def sm64_calc_checksums(buf : bytearray):
+def cic_seed(cic: int) -> int:
+    s6, multiplier = CIC_SEEDS[cic]
+    return ((s6 * multiplier) + 1) & mask32
+
+
+def combine_checksums(cic: int, a3, t2, t3, s0, a2, t4):
+    if cic == 6103:
+        return ((a3 ^ t2) + t3) & mask32, ((s0 ^ a2) + t4) & mask32
+    if cic == 6106:
+        return ((a3 * t2) + t3) & mask32, ((s0 * a2) + t4) & mask32
+    return a3 ^ t2 ^ t3, s0 ^ a2 ^ t4
+
+
+def sm64_calc_checksums_reference(buf : bytearray, cic: int = DEFAULT_CIC):
+    # Scalar, word-at-a-time version that mirrors the boot code. Kept as the
+    # reference for sm64_calc_checksums (see --reference).
+
     #local t0, t1, t2, t3, t4, t5, t6, t7, t8, t9
     #local s0, s6
     #local a0, a1, a2, a3, at
@@ -31,10 +75,10 @@ def sm64_calc_checksums(buf : bytearray):
     #local ra
 
     # derived from the SM64 boot code
-    s6 = 0x3f
+    s6, at = CIC_SEEDS[cic]
     a0 = 0x1000                     # 59c:   8d640008    lw a0,8(t3)
     a1 = s6                         # 5a0:   02c02825    move  a1,s6
-    at = 0x5d588b65                 # 5a4:   3c015d58    lui   at,0x5d58
+                                    # 5a4:   3c015d58    lui   at,0x5d58
                                     # 5a8:   34218b65    ori   at,at,0x8b65
     lo = (a1 * at) & mask32         # 5ac:   00a10019    multu a1,at    16 F8CA 4DDB
 
@@ -77,72 +121,201 @@ def sm64_calc_checksums(buf : bytearray):
             a2 = (a2 ^ a0) & mask32 # 63c: 00c43026    xor   a2,a2,a0
 
         t0 += 4                     # 640: 25080004    addiu t0,t0,4
-        t7 = (v0 ^ s0) & mask32     # 644: 00507826    xor   t7,v0,s0
+        if cic == 6105:
+            # 6105 mixes in the IPL3 words at 0x750 instead of the running sum
+            t7 = (v0 ^ read_u32_be(buf, 0x750 + ((t0 - 4) & 0xFF))) & mask32
+        else:
+            t7 = (v0 ^ s0) & mask32 # 644: 00507826    xor   t7,v0,s0
         t1 += 4                     # 648: 25290004    addiu t1,t1,4
         t4 = (t4 + t7) & mask32     # 650: 01ec6021    addu  t4,t7,t4 branch delay
                                     # 64c: 151fffe8    bne   t0,ra,0x5f0
 
-    t6 = (a3 ^ t2) & mask32         # 654: 00ea7026    xor   t6,a3,t2
-    a3 = (t6 ^ t3) & mask32         # 658: 01cb3826    xor   a3,t6,t3
-    t8 = (s0 ^ a2) & mask32         # 65c: 0206c026    xor   t8,s0,a2
-    s0 = (t8 ^ t4) & mask32         # 660: 030c8026    xor   s0,t8,t4
+                                    # 654: 00ea7026    xor   t6,a3,t2
+                                    # 658: 01cb3826    xor   a3,t6,t3
+                                    # 65c: 0206c026    xor   t8,s0,a2
+                                    # 660: 030c8026    xor   s0,t8,t4
+    return combine_checksums(cic, a3, t2, t3, s0, a2, t4)
 
-    return a3, s0
 
+def load_checksum_words(buf) -> array:
+    # Decode the whole checksum window at once as big-endian u32s
+    words = array("I")
+    assert words.itemsize == 4
+    words.frombytes(buf[CHECKSUM_START:CHECKSUM_END])
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words
 
-def sm64_update_checksums(buf: bytearray):
-    cksum_offsets = [0x10, 0x14]
-    read_cksum = [0, 0]
-    calc_cksum = [0, 0]
 
-    # assume CIC-NUS-6102
-    # print("BootChip: CIC-NUS-6102");
+def calc_bulk_terms(buf, cic: int, seed: int):
+    # Computes every term that is an independent sum/xor over the checksum window.
+    # Also returns the per-word inputs of the sequential a2 term: the word, the
+    # running sum xor'd with the word and the rotated word.
+    words = load_checksum_words(buf)
 
-    # calculate new N64 header checksum
-    calc_cksum = sm64_calc_checksums(buf)
+    # Running sum (a3) and the number of times it carried out (t2)
+    sums = list(accumulate(words, initial=seed))
+    a3 = sums[-1] & mask32
+    t2 = (seed + (sums[-1] >> 32)) & mask32
 
-    # mimic the n64sums output
-    for i in range(2):
-        read_cksum[i] = read_u32_be(buf, cksum_offsets[i])
-        # print("CRC{}: 0x{:08X} ".format(i+1, read_cksum[i]), end="")
-        # print("Calculated: 0x{:08X} ".format(calc_cksum[i]), end="")
+    # Xor of every word (t3)
+    t3 = reduce(xor, words, seed)
 
-    # write checksums into header
-    # print("Writing back calculated Checksum")
-    write_u32_be(buf, cksum_offsets[0], calc_cksum[0])
-    write_u32_be(buf, cksum_offsets[1], calc_cksum[1])
+    # Running sum of each word rotated left by its low 5 bits (s0)
+    rotated = [((v << (v & 0x1F)) | (v >> (32 - (v & 0x1F)))) & mask32 for v in words]
+    rotated_sums = list(accumulate(rotated, initial=seed))
+    s0 = rotated_sums[-1] & mask32
 
+    # Sum of each word xor'd with the running rotated sum, or with IPL3 words for 6105 (t4)
+    if cic == 6105:
+        ipl3 = [read_u32_be(buf, 0x750 + (i * 4)) for i in range(64)]
+        t4 = seed + sum(ipl3[i & 0x3F] ^ v for i, v in enumerate(words))
+    else:
+        t4 = seed + sum(map(xor, words, map(and_, rotated_sums[1:], repeat(mask32))))
 
+    summed = list(map(xor, words, map(and_, sums[1:], repeat(mask32))))
 
-def print_usage():
-    print("TODO: show help")
+    return a3, t2, t3, s0, t4 & mask32, (words, summed, rotated)
 
 
-def read_file(fname):
-    with open(fname, "rb") as f:
-        return bytearray(f.read())
+def calc_bulk_terms_numpy(buf, cic: int, seed: int):
+    # Same as calc_bulk_terms, vectorized with NumPy. Running sums fit in 64 bits
+    # since the window is only 2^18 words.
+    words = numpy.frombuffer(buf, dtype=">u4", count=(CHECKSUM_END - CHECKSUM_START) // 4,
+                             offset=CHECKSUM_START).astype(numpy.uint64)
 
+    sums = numpy.cumsum(words) + seed
+    total = int(sums[-1])
+    a3 = total & mask32
+    t2 = (seed + (total >> 32)) & mask32
 
-def write_file(fname, data):
-    with open(fname, "wb") as f:
-        f.write(data)
+    t3 = seed ^ int(numpy.bitwise_xor.reduce(words))
+
+    shift = words & 0x1F
+    rotated = ((words << shift) | (words >> (32 - shift))) & mask32
+    rotated_sums = numpy.cumsum(rotated) + seed
+    s0 = int(rotated_sums[-1]) & mask32
+
+    if cic == 6105:
+        ipl3 = numpy.frombuffer(buf, dtype=">u4", count=64, offset=0x750).astype(numpy.uint64)
+        t4 = seed + int(numpy.sum(numpy.resize(ipl3, words.shape) ^ words))
+    else:
+        t4 = seed + int(numpy.sum(words ^ (rotated_sums & mask32)))
+
+    summed = words ^ (sums & mask32)
+
+    return a3, t2, t3, s0, t4 & mask32, (words.tolist(), summed.tolist(), rotated.tolist())
+
+
+def sm64_calc_checksums(buf : bytearray, cic: int = DEFAULT_CIC):
+    # Batched version of sm64_calc_checksums_reference
+    seed = cic_seed(cic)
+    if numpy != None:
+        a3, t2, t3, s0, t4, a2_inputs = calc_bulk_terms_numpy(buf, cic, seed)
+    else:
+        a3, t2, t3, s0, t4, a2_inputs = calc_bulk_terms(buf, cic, seed)
 
+    # a2 depends on its own previous value, so it stays sequential
+    a2 = seed
+    for v, summed, rotated in zip(*a2_inputs):
+        a2 ^= summed if a2 < v else rotated
 
+    return combine_checksums(cic, a3, t2, t3, s0, a2, t4)
 
 
-if len(sys.argv) < 2:
-    print_usage()
-    sys.exit(1)
+CKSUM_OFFSETS = [0x10, 0x14]
 
 
-input_name = sys.argv[1]
-output_name = input_name
-if len(sys.argv) > 2:
-    output_name = sys.argv[2]
+def calc_checksums(buf, cic: int = DEFAULT_CIC, reference: bool = False):
+    with phase("checksum"):
+        if reference:
+            return sm64_calc_checksums_reference(buf, cic)
+        else:
+            return sm64_calc_checksums(buf, cic)
+
+
+def read_checksums(buf):
+    return [read_u32_be(buf, offset) for offset in CKSUM_OFFSETS]
+
+
+def sm64_update_checksums(buf: bytearray, cic: int = DEFAULT_CIC, reference: bool = False) -> bool:
+    # defaults to CIC-NUS-6102 (see --cic)
+    # print("BootChip: CIC-NUS-6102");
+
+    # calculate new N64 header checksum
+    calc_cksum = calc_checksums(buf, cic, reference)
+
+    # mimic the n64sums output
+    read_cksum = read_checksums(buf)
+    # print("CRC{}: 0x{:08X} ".format(i+1, read_cksum[i]), end="")
+    # print("Calculated: 0x{:08X} ".format(calc_cksum[i]), end="")
+
+    if list(calc_cksum) == read_cksum:
+        return False
+
+    # write checksums into header
+    # print("Writing back calculated Checksum")
+    write_u32_be(buf, CKSUM_OFFSETS[0], calc_cksum[0])
+    write_u32_be(buf, CKSUM_OFFSETS[1], calc_cksum[1])
+    return True
+
+
+def update_file_in_place(fname, cic: int = DEFAULT_CIC, reference: bool = False) -> bool:
+    # Memory map the ROM so that only the checksum window is read and only
+    # the two header words are written (and only if they changed)
+    with open(fname, "r+b") as f:
+        with mmap.mmap(f.fileno(), 0) as rom:
+            changed = sm64_update_checksums(rom, cic, reference)
+            if changed:
+                rom.flush(0, mmap.PAGESIZE)
+            return changed
+
 
+def verify_file(fname, cic: int = DEFAULT_CIC, reference: bool = False) -> bool:
+    with open(fname, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as rom:
+            read_cksum = read_checksums(rom)
+            calc_cksum = calc_checksums(rom, cic, reference)
+
+    for i in range(2):
+        status = "OK" if read_cksum[i] == calc_cksum[i] else "MISMATCH"
+        print("CRC{}: 0x{:08X} Calculated: 0x{:08X} {}".format(i + 1, read_cksum[i], calc_cksum[i], status))
 
-rom_data = read_file(input_name)
+    return list(calc_cksum) == read_cksum
 
-sm64_update_checksums(rom_data)
 
-write_file(output_name, rom_data)
\ No newline at end of file
+def read_file(fname):
+    with open(fname, "rb") as f:
+        return bytearray(f.read())
+
+
+def write_file(fname, data):
+    write_if_changed(fname, data)
+
+
+@profiled
+def main():
+    parser = argparse.ArgumentParser(description="Recalculates the CRC1/CRC2 checksums in an N64 ROM header.")
+    parser.add_argument("input", type=str, help="The ROM to checksum.")
+    parser.add_argument("output", type=str, nargs="?", help="Where to write the updated ROM (defaults to updating the input).")
+    parser.add_argument("--cic", type=int, choices=sorted(CIC_SEEDS.keys()), default=DEFAULT_CIC, help="The boot chip the ROM is checksummed for.")
+    parser.add_argument("--reference", action="store_true", help="Use the slow, scalar reference checksum implementation.", default=False)
+    parser.add_argument("--verify", action="store_true", help="Only report whether the stored checksums are correct, without writing anything.", default=False)
+    args = parser.parse_args()
+
+    if args.verify:
+        if not verify_file(args.input, args.cic, args.reference):
+            exit(1)
+    elif args.output == None or args.output == args.input:
+        update_file_in_place(args.input, args.cic, args.reference)
+    else:
+        with phase("read"):
+            rom_data = read_file(args.input)
+
+        sm64_update_checksums(rom_data, args.cic, args.reference)
+
+        with phase("write"):
+            write_file(args.output, rom_data)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# Patches a DLL's linked ELF and converts it to a Dinosaur Planet DLL in one process
+# (equivalent to elf_patcher followed by the decomp's elf2dll.py)
+#
+# The patched ELF is handed to elf2dll in memory rather than written to the build
+# directory, and elf2dll runs in this interpreter instead of a new one. Outputs are
+# only written if they changed.
+#
+# Since elf2dll isn't a program of its own, the files its output depends on besides the
+# ELF (elf2dll.py, the decomp tools modules it imported and pyelftools) can be written
+# to a depfile, so that ninja and the build cache notice when they change.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import os
+from pathlib import Path
+import runpy
+import sys
+import tempfile
+from typing import Iterator
+import elftools
+from elftools.common.exceptions import ELFError
+
+from tools.elf_patcher import PatcherException, patch_to_bytes, read_batch_file
+from tools.fileutil import write_depfile, write_if_changed
+from tools.profiling import profiled
+
+class PatchDLLException(Exception):
+    pass
+
+# Yields a path to a file containing data. On Linux this is a memfd, which never
+# touches the disk, otherwise it's a temporary file.
+@contextlib.contextmanager
+def memory_file(name: str, data: bytes = b"") -> Iterator[str]:
+    use_memfd = hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd")
+    if use_memfd:
+        fd = os.memfd_create(name)
+        path = f"/proc/self/fd/{fd}"
+    else:
+        fd, path = tempfile.mkstemp(prefix=f"{name}.")
+    try:
+        with open(fd, "wb", closefd=False) as file:
+            file.write(data)
+        yield path
+    finally:
+        os.close(fd)
+        if not use_memfd:
+            os.remove(path)
+
+def read_path(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+# Runs elf2dll.py in this interpreter. Returns the DLL, BSS size text and symbol map.
+def run_elf2dll(elf2dll_path: Path, elf_data: bytes) -> "tuple[bytes, bytes, bytes]":
+    with memory_file("elf", elf_data) as elf_path, \
+            memory_file("dll") as dll_path, \
+            memory_file("bss") as bss_path, \
+            memory_file("syms") as syms_path:
+        old_argv = sys.argv
+        old_path = sys.path
+        # Same as running the script directly (its directory comes first for imports)
+        sys.argv = [str(elf2dll_path), "-o", dll_path, "-b", bss_path, "-s", syms_path, elf_path]
+        sys.path = [str(elf2dll_path.parent)] + sys.path
+        try:
+            runpy.run_path(str(elf2dll_path), run_name="__main__")
+        except SystemExit as ex:
+            if ex.code != None and ex.code != 0:
+                raise PatchDLLException(f"elf2dll exited with {ex.code}")
+        finally:
+            sys.argv = old_argv
+            sys.path = old_path
+
+        return (read_path(dll_path), read_path(bss_path), read_path(syms_path))
+
+# Gets the files of the loaded modules that are in dir, as paths under dir
+def get_loaded_module_files(dir: Path) -> "list[Path]":
+    resolved_dir = dir.resolve()
+    files: "set[Path]" = set()
+    for module in list(sys.modules.values()):
+        file = getattr(module, "__file__", None)
+        if file != None and Path(file).resolve().is_relative_to(resolved_dir):
+            files.add(dir.joinpath(Path(file).resolve().relative_to(resolved_dir)))
+    return sorted(files)
+
+# Gets the files that elf2dll's output depends on, other than the ELF. Only complete
+# once elf2dll has been run.
+def get_elf2dll_deps(elf2dll_path: Path) -> "list[Path]":
+    deps = [elf2dll_path] \
+        + get_loaded_module_files(elf2dll_path.parent) \
+        + get_loaded_module_files(Path(elftools.__file__).parent)
+    return list(dict.fromkeys(deps))
+
+def get_patched_elf_path(elf_path: str) -> str:
+    return Path(elf_path).with_suffix(".patched.elf").as_posix()
+
+# Patches an ELF and converts it to <dll_path>, <dll_path>.bss.txt and <dll_path>.syms.txt
+def convert_dll(elf_path: str, dll_path: str, elf2dll_path: Path, keep_patched_elf: bool):
+    with open(elf_path, "rb") as elf_file:
+        patched = patch_to_bytes(elf_file)
+
+    if keep_patched_elf:
+        write_if_changed(get_patched_elf_path(elf_path), patched)
+
+    (dll, bss, syms) = run_elf2dll(elf2dll_path, patched)
+    write_if_changed(dll_path, dll)
+    write_if_changed(f"{dll_path}.bss.txt", bss)
+    write_if_changed(f"{dll_path}.syms.txt", syms)
+
+# Converts one DLL of a batch, returning an error message if it failed
+def convert_batch_entry(entry: "tuple[str, str, Path, bool]") -> "str | None":
+    (elf_path, dll_path, elf2dll_path, keep_patched_elf) = entry
+    try:
+        convert_dll(elf_path, dll_path, elf2dll_path, keep_patched_elf)
+    except (PatcherException, PatchDLLException, ELFError, OSError) as ex:
+        return f"{elf_path}: {ex}"
+    except Exception as ex:
+        # Anything else elf2dll raised (e.g. a KeyError or failed assert) fails only this DLL
+        return f"{elf_path}: {type(ex).__name__}: {ex}"
+    return None
+
+def convert_batch(pairs: "list[tuple[str, str]]", elf2dll_path: Path, keep_patched_elf: bool, jobs: int) -> "list[str]":
+    entries = [(elf_path, dll_path, elf2dll_path, keep_patched_elf) for (elf_path, dll_path) in pairs]
+    if jobs == 1 or len(entries) <= 1:
+        errors = [convert_batch_entry(entry) for entry in entries]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(entries))) as executor:
+            errors = list(executor.map(convert_batch_entry, entries))
+    return [error for error in errors if error != None]
+
+@profiled
+def main():
+    parser = argparse.ArgumentParser(description="Applies patches to DLL ELFs and converts them to Dinosaur Planet DLLs.")
+    parser.add_argument("elf", type=str, nargs="?", help="The linked DLL ELF file containing patch sections.")
+    parser.add_argument("-o", "--output", type=str, help="The path of the DLL to output (.bss.txt and .syms.txt files are written next to it).")
+    parser.add_argument("--batch", type=str, action="append", default=[],
+                        help="Convert every pair of ELF and DLL paths listed in this file (instead of a single ELF).")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes to convert a batch with (0 = CPU count).")
+    parser.add_argument("--elf2dll", type=str, help="Path to the decomp's elf2dll.py.", required=True)
+    parser.add_argument("--keep-patched-elf", dest="keep_patched_elf", action="store_true", default=False,
+                        help="Also write each patched ELF next to its input ELF as <name>.patched.elf (for debugging).")
+    parser.add_argument("--depfile", type=str,
+                        help="Write a depfile listing the files the output depends on besides the ELF (elf2dll and the modules it loaded).")
+    args = parser.parse_args()
+
+    if len(args.batch) > 0:
+        if args.elf != None or args.output != None or args.depfile != None:
+            parser.error("an ELF, -o/--output and --depfile can't be given with --batch")
+    elif args.elf == None or args.output == None:
+        parser.error("an ELF and -o/--output are required without --batch")
+
+    elf2dll_path = Path(args.elf2dll)
+
+    error = False
+    try:
+        if len(args.batch) > 0:
+            pairs = [pair for path in args.batch for pair in read_batch_file(path)]
+            jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+            for message in convert_batch(pairs, elf2dll_path, args.keep_patched_elf, jobs):
+                print(f"ERROR: {message}")
+                error = True
+        else:
+            convert_dll(args.elf, args.output, elf2dll_path, args.keep_patched_elf)
+            if args.depfile != None:
+                write_depfile(args.depfile, args.output, get_elf2dll_deps(elf2dll_path))
+    except (PatcherException, PatchDLLException) as ex:
+        print(f"ERROR: {ex}")
+        error = True
+
+    if error:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
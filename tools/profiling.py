@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# Opt-in profiling of the build tools
+#
+# Tool entry points are wrapped with @profiled and mark their phases with `with phase(...)`
+# and count(...). Nothing is recorded unless DP_PROFILE is set, to a comma separated list of:
+#   1 (or phases): phase timings, counters and peak RSS
+#   cprofile: also a cProfile dump (implies phases)
+#   tracemalloc: also the peak traced memory and the top allocation sites (implies phases, slow)
+#   all: all of the above
+# Each run writes <tool>-<id>.json (and <tool>-<id>.prof with cprofile) to DP_PROFILE_DIR
+# (default: build/profiles), where the id identifies the command line, so there is one
+# profile per build step. `report` merges the profiles into one report.
+
+import argparse
+from datetime import datetime, timezone
+import functools
+import hashlib
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Callable
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_ENV = "DP_PROFILE"
+PROFILE_DIR_ENV = "DP_PROFILE_DIR"
+DEFAULT_PROFILE_DIR = "build/profiles"
+PROFILE_OPTIONS = ["phases", "cprofile", "tracemalloc"]
+TRACEMALLOC_TOP = 15
+
+class ProfilingException(Exception):
+    pass
+
+class Profile:
+    def __init__(self, tool: str, options: "set[str]"):
+        self.tool = tool
+        self.options = options
+        self.phases: "dict[str, float]" = {}
+        self.counters: "dict[str, int]" = {}
+
+# The profile of the running tool, None if profiling is off
+active: "Profile | None" = None
+
+class Phase:
+    def __init__(self, profile: Profile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        elapsed = time.perf_counter() - self.start
+        self.profile.phases[self.name] = self.profile.phases.get(self.name, 0.0) + elapsed
+
+class NullPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *_):
+        pass
+
+NULL_PHASE = NullPhase()
+
+# Times a phase of the running tool (phases with the same name add up)
+def phase(name: str) -> "Phase | NullPhase":
+    if active == None:
+        return NULL_PHASE
+    return Phase(active, name)
+
+# Adds to a counter of the running tool (e.g. bytes read)
+def count(name: str, amount: int):
+    if active != None:
+        active.counters[name] = active.counters.get(name, 0) + amount
+
+def parse_options(value: str) -> "set[str]":
+    options: "set[str]" = set()
+    for option in value.lower().split(","):
+        option = option.strip()
+        if option in ("", "0"):
+            continue
+        elif option in ("1", "phases"):
+            options.add("phases")
+        elif option == "all":
+            options.update(PROFILE_OPTIONS)
+        elif option in PROFILE_OPTIONS:
+            options.update(["phases", option])
+        else:
+            raise ProfilingException(f"Unknown {PROFILE_ENV} option: {option} (expected {', '.join(PROFILE_OPTIONS)} or all)")
+    return options
+
+def get_peak_rss() -> "int | None":
+    if resource == None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Wraps a tool's main() to profile it when DP_PROFILE is set
+def profiled(main: Callable[[], None]) -> Callable[[], None]:
+    # Named by file since tools run with -m are all __main__
+    tool = Path(main.__code__.co_filename).stem
+
+    @functools.wraps(main)
+    def wrapper():
+        value = os.environ.get(PROFILE_ENV)
+        # Tools called from other profiled tools are part of their profile
+        if not value or active != None:
+            return main()
+        try:
+            options = parse_options(value)
+        except ProfilingException as ex:
+            print(f"WARNING: {ex}", file=sys.stderr)
+            return main()
+        if len(options) == 0:
+            return main()
+        run_profiled(tool, options, main)
+
+    return wrapper
+
+def run_profiled(tool: str, options: "set[str]", main: Callable[[], None]):
+    global active
+
+    profiler = None
+    if "cprofile" in options:
+        import cProfile
+        profiler = cProfile.Profile()
+    if "tracemalloc" in options:
+        import tracemalloc
+        tracemalloc.start()
+
+    active = Profile(tool, options)
+    exit_code: "int | str | None" = 0
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        if profiler != None:
+            profiler.runcall(main)
+        else:
+            main()
+    except SystemExit as ex:
+        exit_code = ex.code
+        raise
+    except BaseException:
+        exit_code = "exception"
+        raise
+    finally:
+        profile = active
+        active = None
+        record = {
+            "tool": tool,
+            "argv": sys.argv,
+            "cwd": os.getcwd(),
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "exit_code": exit_code,
+            "wall_time": time.perf_counter() - start_time,
+            "cpu_time": time.process_time() - start_cpu,
+            "phases": profile.phases,
+            "counters": profile.counters,
+            "peak_rss": get_peak_rss(),
+        }
+        if "tracemalloc" in options:
+            record["tracemalloc"] = get_tracemalloc_stats()
+        try:
+            write_profile(record, profiler)
+        except OSError as ex:
+            print(f"WARNING: Couldn't write profile: {ex}", file=sys.stderr)
+
+def get_tracemalloc_stats() -> dict:
+    import tracemalloc
+    snapshot = tracemalloc.take_snapshot()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    top = snapshot.statistics("lineno")[:TRACEMALLOC_TOP]
+    return {
+        "peak": peak,
+        "top": [{ "where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", "size": stat.size, "count": stat.count }
+                for stat in top],
+    }
+
+def get_profile_dir() -> Path:
+    return Path(os.environ.get(PROFILE_DIR_ENV) or DEFAULT_PROFILE_DIR)
+
+def write_profile(record: dict, profiler):
+    # Named by the arguments (and directory) so that each build step has one profile, whether
+    # it was run directly or by the build worker
+    run_id = hashlib.sha1(json.dumps([record["cwd"], record["argv"][1:]]).encode()).hexdigest()[:16]
+    profile_dir = get_profile_dir()
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    stem = profile_dir.joinpath(f"{record['tool']}-{run_id}")
+    if profiler != None:
+        profiler.dump_stats(f"{stem}.prof")
+        record["cprofile"] = f"{stem.name}.prof"
+    tmp_path = f"{stem}.json.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as profile_file:
+        json.dump(record, profile_file, indent=1)
+    os.replace(tmp_path, f"{stem}.json")
+
+def load_profiles(profile_dir: Path) -> "list[dict]":
+    profiles: "list[dict]" = []
+    for path in sorted(profile_dir.glob("*.json")):
+        try:
+            with open(path, "r", encoding="utf-8") as profile_file:
+                profiles.append(json.load(profile_file))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+def format_size(size: "int | None") -> str:
+    if size == None:
+        return "-"
+    for (suffix, scale) in [("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)]:
+        if size >= scale:
+            return f"{size / scale:.1f}{suffix}"
+    return str(size)
+
+def format_counter(name: str, value: int) -> str:
+    return format_size(value) if name.startswith("bytes") else str(value)
+
+def print_report(profiles: "list[dict]", profile_dir: Path, top: int, functions: int):
+    tools: "dict[str, list[dict]]" = {}
+    for profile in profiles:
+        tools.setdefault(profile["tool"], []).append(profile)
+
+    print(f"{len(profiles)} profiles in {profile_dir}")
+    print()
+    print(f"  {'tool':<20} {'runs':>5} {'total':>9} {'max':>8} {'peak RSS':>9}")
+    by_time = sorted(tools.items(), key=lambda item: -sum(p["wall_time"] for p in item[1]))
+    for (tool, runs) in by_time:
+        peaks = [p["peak_rss"] for p in runs if p.get("peak_rss") != None]
+        print(f"  {tool:<20} {len(runs):>5} {sum(p['wall_time'] for p in runs):>8.2f}s "
+              f"{max(p['wall_time'] for p in runs):>7.2f}s {format_size(max(peaks) if peaks else None):>9}")
+
+    for (tool, runs) in by_time:
+        phases: "dict[str, float]" = {}
+        counters: "dict[str, int]" = {}
+        for run in runs:
+            for (name, value) in run.get("phases", {}).items():
+                phases[name] = phases.get(name, 0.0) + value
+            for (name, value) in run.get("counters", {}).items():
+                counters[name] = counters.get(name, 0) + value
+        if len(phases) == 0 and len(counters) == 0:
+            continue
+        print()
+        print(f"{tool}:")
+        for (name, value) in phases.items():
+            print(f"  {name:<28} {value:>8.2f}s")
+        for (name, value) in counters.items():
+            print(f"  {name:<28} {format_counter(name, value):>9}")
+
+    print()
+    print("Slowest steps:")
+    for profile in sorted(profiles, key=lambda p: -p["wall_time"])[:top]:
+        command = " ".join(profile["argv"][1:])
+        print(f"  {profile['wall_time']:>7.2f}s  {profile['tool']:<20} {command[:80]}")
+
+    allocations = [(profile, site) for profile in profiles for site in profile.get("tracemalloc", {}).get("top", [])]
+    if len(allocations) > 0:
+        print()
+        print("Largest allocation sites (at exit):")
+        for (profile, site) in sorted(allocations, key=lambda item: -item[1]["size"])[:top]:
+            print(f"  {format_size(site['size']):>8}  {profile['tool']:<20} {site['where']}")
+
+    if functions > 0:
+        import pstats
+        for (tool, runs) in by_time:
+            prof_paths = [profile_dir.joinpath(run["cprofile"]) for run in runs if "cprofile" in run]
+            prof_paths = [path for path in prof_paths if path.exists()]
+            if len(prof_paths) == 0:
+                continue
+            print()
+            print(f"{tool} (cProfile, {len(prof_paths)} runs):")
+            stats = pstats.Stats(*[str(path) for path in prof_paths], stream=sys.stdout)
+            stats.sort_stats("cumulative").print_stats(functions)
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Reports on the profiles the build tools write when {PROFILE_ENV} is set.")
+    parser.add_argument("--dir", type=str, default=None, help=f"The profile directory. Default: ${PROFILE_DIR_ENV} or {DEFAULT_PROFILE_DIR}")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="Merge all profiles into one report.")
+    report_parser.add_argument("--top", type=int, default=10, help="Number of slowest steps to list.")
+    report_parser.add_argument("--functions", type=int, default=15,
+                               help="Number of functions to list per tool from merged cProfile dumps (0 = none).")
+    subparsers.add_parser("clear", help="Delete all profiles.")
+    args = parser.parse_args()
+
+    profile_dir = Path(args.dir) if args.dir != None else get_profile_dir()
+    if args.command == "report":
+        profiles = load_profiles(profile_dir)
+        if len(profiles) == 0:
+            print(f"ERROR: No profiles in {profile_dir}, build with {PROFILE_ENV}=1 first.")
+            exit(1)
+        print_report(profiles, profile_dir, args.top, args.functions)
+    else:
+        for path in list(profile_dir.glob("*.json")) + list(profile_dir.glob("*.prof")):
+            path.unlink()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Cached symbol lookups for large ELFs (such as the decomp's dino.elf)
+#
+# The symbol table of an ELF is indexed once and saved to a sidecar file in a cache
+# directory, keyed by the ELF's size, mtime and hash. Later lookups (from any tool) just
+# load the index instead of parsing the ELF.
+#
+# Index file layout (big endian):
+#   header: magic, ELF size, ELF mtime (ns), ELF SHA-1, symbol count, names size
+#   names: NUL separated symbol names, sorted
+#   symbols: (value, size, shndx, info) per symbol, in the same order as the names
+#   by_address: symbol indexes sorted by value
+
+import argparse
+import bisect
+import hashlib
+import os
+from pathlib import Path
+import struct
+
+from tools.fileutil import hash_file, write_if_changed
+from tools.profiling import profiled
+
+INDEX_MAGIC = b"SYMIDX01"
+INDEX_HEADER = struct.Struct(">8sQQ20sII")
+INDEX_SYMBOL = struct.Struct(">IIHBx")
+SHN_UNDEF = 0
+
+class SymbolIndexException(Exception):
+    pass
+
+class IndexedSymbol:
+    def __init__(self, name: str, value: int, size: int, shndx: int, info: int):
+        self.name = name
+        self.value = value
+        self.size = size
+        # Raw section index (special indexes such as SHN_ABS are not mapped to names)
+        self.shndx = shndx
+        self.info = info
+
+    def is_undefined(self) -> bool:
+        return self.shndx == SHN_UNDEF
+
+class SymbolIndex:
+    def __init__(self, names: "list[bytes]", symbols: bytes, by_address: "tuple[int, ...]"):
+        self.names = names
+        self.symbols = symbols
+        self.by_address = by_address
+        self.addresses = [INDEX_SYMBOL.unpack_from(symbols, i * INDEX_SYMBOL.size)[0] for i in by_address]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __get(self, i: int) -> IndexedSymbol:
+        (value, size, shndx, info) = INDEX_SYMBOL.unpack_from(self.symbols, i * INDEX_SYMBOL.size)
+        return IndexedSymbol(self.names[i].decode("utf-8", errors="replace"), value, size, shndx, info)
+
+    # Gets all symbols with the given name (there may be duplicates, e.g. static symbols)
+    def get_symbols_by_name(self, name: str) -> "list[IndexedSymbol]":
+        key = name.encode("utf-8")
+        start = bisect.bisect_left(self.names, key)
+        end = bisect.bisect_right(self.names, key, start)
+        return [self.__get(i) for i in range(start, end)]
+
+    # Gets the defined symbol with the highest address at or before the given address
+    def get_symbol_at_address(self, address: int) -> "IndexedSymbol | None":
+        i = bisect.bisect_right(self.addresses, address)
+        while i > 0:
+            i -= 1
+            sym = self.__get(self.by_address[i])
+            if not sym.is_undefined():
+                return sym
+        return None
+
+def read_elf_symbols(elf_path: Path) -> "list[tuple[bytes, int, int, int, int]]":
+    # pyelftools is only imported when an index needs building, cached lookups don't need it
+    from elftools.elf.elffile import ELFFile
+    from elftools.elf.sections import SymbolTableSection
+
+    # Unpacks the symbol table directly, which is much faster than pyelftools' iter_symbols
+    with open(elf_path, "rb") as elf_file:
+        elf = ELFFile(elf_file)
+        symtab = elf.get_section_by_name(".symtab")
+        if not isinstance(symtab, SymbolTableSection):
+            raise SymbolIndexException(f"{elf_path} has no symbol table.")
+        strtab = symtab.stringtable.data()
+
+        if elf.elfclass != 32:
+            raise SymbolIndexException(f"{elf_path} is not a 32-bit ELF.")
+        sym_struct = struct.Struct(("<" if elf.little_endian else ">") + "IIIBBH")
+
+        data = symtab.data()[:symtab.num_symbols() * sym_struct.size]
+        symbols: "list[tuple[bytes, int, int, int, int]]" = []
+        for (st_name, value, size, info, _, shndx) in sym_struct.iter_unpack(data):
+            name = strtab[st_name:strtab.index(b"\0", st_name)]
+            symbols.append((name, value, size, shndx, info))
+        return symbols
+
+def build_index(elf_path: Path, elf_size: int, elf_mtime_ns: int, elf_hash: bytes) -> bytes:
+    symbols = read_elf_symbols(elf_path)
+    # Stable sort keeps duplicate names in symbol table order
+    symbols.sort(key=lambda s: s[0])
+
+    names = b"\0".join(name for (name, _, _, _, _) in symbols)
+    table = b"".join(INDEX_SYMBOL.pack(value, size, shndx, info) for (_, value, size, shndx, info) in symbols)
+    by_address = sorted(range(len(symbols)), key=lambda i: symbols[i][1])
+
+    header = INDEX_HEADER.pack(INDEX_MAGIC, elf_size, elf_mtime_ns, elf_hash, len(symbols), len(names))
+    return header + names + table + struct.pack(f">{len(by_address)}I", *by_address)
+
+# Parses an index file, returning the ELF size, mtime and hash it was built from along
+# with the index. Returns None if the file isn't a valid index.
+def parse_index(data: bytes) -> "tuple[tuple[int, int, bytes], SymbolIndex] | None":
+    if len(data) < INDEX_HEADER.size:
+        return None
+    (magic, elf_size, elf_mtime_ns, elf_hash, count, names_size) = INDEX_HEADER.unpack_from(data, 0)
+    if magic != INDEX_MAGIC:
+        return None
+    if len(data) != INDEX_HEADER.size + names_size + count * (INDEX_SYMBOL.size + 4):
+        return None
+
+    offset = INDEX_HEADER.size
+    names = data[offset:offset + names_size].split(b"\0") if count > 0 else []
+    offset += names_size
+    symbols = data[offset:offset + count * INDEX_SYMBOL.size]
+    offset += count * INDEX_SYMBOL.size
+    by_address = struct.unpack_from(f">{count}I", data, offset)
+
+    if len(names) != count:
+        return None
+
+    return ((elf_size, elf_mtime_ns, elf_hash), SymbolIndex(names, symbols, by_address))
+
+def get_index_path(elf_path: Path, cache_dir: Path) -> Path:
+    # Include the ELF's location so that different ELFs with the same name don't collide
+    path_hash = hashlib.sha1(str(elf_path.absolute()).encode()).hexdigest()[:12]
+    return cache_dir.joinpath(f"{elf_path.name}.{path_hash}.symidx")
+
+# Indexes already loaded by this process, by absolute ELF path: (ELF size, ELF mtime, index).
+# Lets long running processes (such as the build worker) skip reloading them.
+loaded_indexes: "dict[Path, tuple[int, int, SymbolIndex]]" = {}
+
+# Loads the symbol index of an ELF from the cache directory, (re)building it if the
+# ELF changed since it was indexed. Without a cache directory, the index is just built.
+def load_symbol_index(elf_path: Path, cache_dir: "Path | None") -> SymbolIndex:
+    stat = elf_path.stat()
+    key = elf_path.absolute()
+    loaded = loaded_indexes.get(key)
+    if loaded != None and loaded[0] == stat.st_size and loaded[1] == stat.st_mtime_ns:
+        return loaded[2]
+
+    index = read_symbol_index(elf_path, cache_dir, stat)
+    loaded_indexes[key] = (stat.st_size, stat.st_mtime_ns, index)
+    return index
+
+def read_symbol_index(elf_path: Path, cache_dir: "Path | None", stat: os.stat_result) -> SymbolIndex:
+    if cache_dir == None:
+        parsed = parse_index(build_index(elf_path, stat.st_size, stat.st_mtime_ns, bytes(20)))
+        assert parsed != None
+        return parsed[1]
+
+    index_path = get_index_path(elf_path, cache_dir)
+
+    cached = None
+    try:
+        with open(index_path, "rb") as index_file:
+            data = index_file.read()
+        cached = parse_index(data)
+    except FileNotFoundError:
+        pass
+
+    elf_hash: "bytes | None" = None
+    if cached != None:
+        ((size, mtime_ns, hash), index) = cached
+        if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+            return index
+        # The ELF may have been rebuilt without changing, only the mtime needs updating then
+        if size == stat.st_size:
+            elf_hash = bytes.fromhex(hash_file(elf_path))
+            if elf_hash == hash:
+                header = list(INDEX_HEADER.unpack_from(data, 0))
+                header[2] = stat.st_mtime_ns
+                write_if_changed(index_path, INDEX_HEADER.pack(*header) + data[INDEX_HEADER.size:])
+                return index
+
+    if elf_hash == None:
+        elf_hash = bytes.fromhex(hash_file(elf_path))
+    data = build_index(elf_path, stat.st_size, stat.st_mtime_ns, elf_hash)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    write_if_changed(index_path, data)
+
+    parsed = parse_index(data)
+    assert parsed != None
+    return parsed[1]
+
+@profiled
+def main():
+    parser = argparse.ArgumentParser(description="Looks up symbols in an ELF using a cached symbol index.")
+    parser.add_argument("elf", type=str, help="The ELF file.")
+    parser.add_argument("symbols", type=str, nargs="*", help="Names of symbols to look up.")
+    parser.add_argument("-a", "--address", type=lambda s: int(s, 0), action="append", default=[],
+                        help="Look up the symbol containing this address.")
+    parser.add_argument("--cache-dir", dest="cache_dir", type=str, help="Directory to store symbol indexes in.", default="build/symbol_index")
+    args = parser.parse_args()
+
+    error = False
+    try:
+        index = load_symbol_index(Path(args.elf), Path(args.cache_dir))
+        for name in args.symbols:
+            syms = index.get_symbols_by_name(name)
+            if len(syms) == 0:
+                print(f"{name}: not found")
+                error = True
+            for sym in syms:
+                print(f"{sym.name}: 0x{sym.value:08X} size 0x{sym.size:X} shndx {sym.shndx}")
+        for address in args.address:
+            sym = index.get_symbol_at_address(address)
+            if sym == None:
+                print(f"0x{address:08X}: not found")
+                error = True
+            else:
+                print(f"0x{address:08X}: {sym.name}+0x{address - sym.value:X}")
+    except SymbolIndexException as ex:
+        print(f"ERROR: {ex}")
+        error = True
+
+    if error:
+        exit(1)
+
+if __name__ == "__main__":
+    main()